@@ -16,6 +16,40 @@
 
 # *********** METHODS:
 
+# PPMI databases are read in chunks of rows, so that memory use is bounded by the chunk size
+# rather than by the size of the file.  Only the columns that are needed are read, and test
+# columns are read as text, and converted by numerify_column - so that the values do not depend
+# on how the file is split into chunks.
+
+CHUNK_SIZE = 50000
+
+# Open a PPMI database (.CSV format) for reading in chunks.
+#
+# Parameters:
+# fileinfo - path & filename of database
+# columns - function that selects the columns to read from the list of column headers
+#           (default: all columns)
+# dtype - dictionary column : data type, for columns whose type is known in advance
+# chunk_size - number of rows per chunk
+#
+# Returns:  iterator over dataframes (chunks of rows, in file order)
+
+def read_PPMI_chunks(fileinfo, columns = None, dtype = None, chunk_size = CHUNK_SIZE):
+
+    # Read column headers first, then restrict the columns:
+
+    usecols = None
+
+    if (columns is not None):
+        header = pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False, nrows = 0).columns.tolist()
+        usecols = columns(header)
+
+    if (dtype is not None) and (usecols is not None):
+        dtype = dict((col, dtype[col]) for col in dtype if (col in usecols))
+
+    return pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False, usecols = usecols,
+                                    dtype = dtype, chunksize = chunk_size)
+
 # Read the study subject database, and return a list of subject IDs,
 # as well as a dictionary {subject_ID : condition}
 #
@@ -24,32 +58,32 @@
 
 def subject_list_conditions(fileinfo = '../PPMI Data/Subject_Characteristics/Patient_Status.csv'):
     
+    # For our purpose, we are really only interested in the IDs of subjects that
+    # are enrolled in the study, and their condition (as determined by imaging)
+
+    columns = ['PATNO', 'ENROLL_STATUS', 'ENROLL_CAT']
+
     # Read Patient Status file:
     
     try:
-        patientdata = pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False)
+        patientdata = read_PPMI_chunks(fileinfo, lambda header: columns,
+                                       {'ENROLL_STATUS' : str, 'ENROLL_CAT' : str})
 
     except IOError:
         print 'ERROR:  Could not open subject master file'
         raise IOError
 
-    # For our purpose, we are really only interested in the IDs of subjects that
-    # are enrolled in the study, and their condition (as determined by imaging)
-    
-    dropcols = patientdata.columns.values.tolist()[1:4]
-    patientdata = patientdata.drop(dropcols, axis = 1)
-    
-    # Purge subject database - enrolled subjects only, please
-    
-    patientdata = patientdata[['PATNO','ENROLL_CAT']][(patientdata['ENROLL_STATUS'] == 'Enrolled')]
-    subject_count = len(patientdata)
-    
-    # Extract ID : Condition dictionary
+    # Extract ID : Condition dictionary (later entries for a subject take precedence)
     
     subject_condition = {}
     
-    for pat in range(0, subject_count):
-        subject_condition[patientdata.iloc[pat][0]] = patientdata.iloc[pat][1]
+    for chunk in patientdata:
+
+        # Purge subject database - enrolled subjects only, please
+
+        chunk = chunk[(chunk['ENROLL_STATUS'] == 'Enrolled')]
+
+        subject_condition.update(zip(chunk['PATNO'].tolist(), chunk['ENROLL_CAT'].tolist()))
     
     # Extract list of actual study subjects, count them
     
@@ -133,6 +167,282 @@ def extract_test_information(fileinfo = '../PPMI Analysis/selectdata.json'):
 # Subject ID - Event ID - Test#1 - Test#2 - etc. 
 #
 # For databases in different format (Biomarkers), use a conversion algorithm first.
+#
+# The readout works on whole columns at once:  Subject and event IDs are translated into
+# array coordinates by dictionary lookup, the test columns are converted to numbers in bulk,
+# and the results are reduced to a set of array cells and values before being stored.
+#
+# Entries are combined in the order they appear in the file (row by row, column by column),
+# exactly as if they were added one at a time:
+#
+# - Columns (and repeated rows) that translate into the same array cell are added together
+# - A missing or non-numerical entry marks the cell as invalid (NaN)
+# - A valid entry that follows an invalid one starts the sum over from zero
+
+# Modes for storing reduced entries in the data array:
+
+ENTRY_ADD     = 1   # Add value to existing array entry (treat NaN as zero)
+ENTRY_REPLACE = 2   # Overwrite existing array entry with value
+
+# Create lookup tables for array coordinates:
+#
+# Parameters:  list of labels along an array axis
+# Returns:     dictionary label : position
+
+def label_index(label_list):
+
+    return dict((label, position) for position, label in enumerate(label_list))
+
+# Translate a data column into floating point numbers.
+#
+# Numerical columns are passed through; for text columns, each distinct entry is converted
+# only once.  The entry 'below detection limit' counts as zero.
+#
+# Parameters:  pandas Series object (data column)
+# Returns:     numpy array of values, boolean numpy array marking non-numerical entries
+
+def numerify_column(column):
+
+    if (column.dtype != object):
+        values = column.values.astype(float)
+        return values, np.zeros(len(values), dtype = bool)
+
+    # Find distinct entries, convert them:
+
+    codes, uniques = pd.factorize(column.values)
+
+    unique_values = np.empty(len(uniques))
+    unique_trouble = np.zeros(len(uniques), dtype = bool)
+
+    # Usually, all entries are numbers - convert them at once:
+
+    try:
+        unique_values[:] = np.where(uniques == 'below detection limit', '0', uniques).astype(float)
+
+    except (ValueError, TypeError):
+
+        # Find the troublesome ones:
+
+        for position, entry in enumerate(uniques):
+            try:
+                if entry == 'below detection limit':
+                    entry = 0
+
+                unique_values[position] = float(entry)
+
+            except ValueError:
+                unique_values[position] = np.nan
+                unique_trouble[position] = True
+
+    # Broadcast back onto column (missing entries have code -1, and pick the appended NaN):
+
+    values = np.append(unique_values, np.nan)[codes]
+    trouble = np.append(unique_trouble, False)[codes]
+
+    return values, trouble
+
+# Combine a sequence of entries destined for the data array into one value per array cell.
+#
+# Parameters:
+# cells - flat array index of each entry, in the order the entries are to be added
+# values - numerical values of the entries (NaN for invalid entries)
+#
+# Returns:
+# cell_list - array of distinct flat array indices
+# value_list - combined value for each cell
+# mode_list - ENTRY_ADD if the value is to be added to the existing entry,
+#             ENTRY_REPLACE if it supersedes it (an invalid entry was encountered)
+
+def reduce_entries(cells, values):
+
+    order = np.arange(len(cells))
+    cell_list, group = np.unique(cells, return_inverse = True)
+
+    # Find the last invalid entry and the last entry overall for each cell:
+
+    invalid = np.isnan(values)
+
+    last_invalid = -np.ones(len(cell_list), dtype = int)
+    np.maximum.at(last_invalid, group[invalid], order[invalid])
+
+    last_entry = -np.ones(len(cell_list), dtype = int)
+    np.maximum.at(last_entry, group, order)
+
+    # Sum up all valid entries following the last invalid one:
+
+    keep = (order > last_invalid[group])
+    value_list = np.bincount(group[keep], weights = values[keep], minlength = len(cell_list)).astype(float)
+
+    # Cells whose last entry is invalid remain invalid:
+
+    value_list[last_invalid == last_entry] = np.nan
+
+    mode_list = np.where(last_invalid >= 0, ENTRY_REPLACE, ENTRY_ADD)
+
+    return cell_list, value_list, mode_list
+
+# Reduce the contents of a PPMI data file to a list of array cells and values.
+#
+# Parameters:
+# ppmi_data - dataframe containing the PPMI data file
+# fileinfo - path & filename to PPMI data file (for log output)
+# infolog - file handle (file object open with write access) for logfile output
+# shape - shape of the three-dimensional data array
+# subject_index - dictionary subject ID : array position
+# event_index - dictionary event ID : array position
+# test_index - dictionary descriptor : array position
+# test_dict - translation dictionary PPMI abbreviation : descriptor
+#
+# Returns:  cell list, value list, mode list (see reduce_entries)
+
+def reduce_PPMI_data(ppmi_data, fileinfo, infolog, shape, subject_index, event_index, test_index, test_dict):
+
+    # Locate subjects and events - is the data entry recognizable?
+
+    subject_pos = ppmi_data['PATNO'].map(subject_index)
+    event_pos = ppmi_data['EVENT_ID'].map(event_index)
+
+    rows = np.flatnonzero((subject_pos.notnull() & event_pos.notnull()).values)
+
+    subject_pos = subject_pos.values[rows].astype(int)
+    event_pos = event_pos.values[rows].astype(int)
+
+    # Check for columns of interest, translate descriptions:
+
+    columns = [col for col in ppmi_data.columns if (col in test_dict)]
+    test_pos = np.array([test_index[test_dict[col]] for col in columns], dtype = int)
+
+    # Read values column by column:
+
+    values = np.empty((len(rows), len(columns)))
+    trouble = np.zeros((len(rows), len(columns)), dtype = bool)
+
+    for position, col in enumerate(columns):
+        values[:, position], trouble[:, position] = numerify_column(ppmi_data[col].iloc[rows])
+
+    # Give detailed error information about non-numerical data, in order of appearance
+    # (the entries were already marked as not present):
+
+    for row, position in zip(*np.nonzero(trouble)):
+        col = columns[position]
+        entry = ppmi_data[col].iat[rows[row]]
+
+        infolog.write('\t\t TROUBLE:  Encountered non-numerical data while trying to import\n')
+        infolog.write('\t\t\t Offending entry: ' + str(entry) + '\n')
+        infolog.write('\t\t\t File: ' + fileinfo + '\n')
+        infolog.write('\t\t\t Subject: ' + str(ppmi_data['PATNO'].iat[rows[row]]) + ' - Test: ' + test_dict[col] +
+                      ' - Event: ' + ppmi_data['EVENT_ID'].iat[rows[row]] + '\n')
+
+    # Find array cell for each entry (row by row, then column by column):
+
+    cells = np.ravel_multi_index((event_pos[:, np.newaxis], subject_pos[:, np.newaxis], test_pos[np.newaxis, :]), shape)
+
+    return reduce_entries(cells.ravel(), values.ravel())
+
+# Store reduced entries in the data array.
+#
+# Parameters:
+# data_array - three-dimensional array to store data
+# cell_list, value_list, mode_list - reduced entries (see reduce_entries)
+
+def store_entries(data_array, cell_list, value_list, mode_list):
+
+    # Overwrite superseded entries:
+
+    replace = (mode_list == ENTRY_REPLACE)
+    data_array[np.unravel_index(cell_list[replace], data_array.shape)] = value_list[replace]
+
+    # Add to existing entries, initialize entries if encountered for the first time:
+
+    add = np.unravel_index(cell_list[~replace], data_array.shape)
+    current = data_array[add]
+    current[np.isnan(current)] = 0
+
+    data_array[add] = current + value_list[~replace]
+
+    return data_array
+
+# Combine the reduced entries of two consecutive parts of a data file (e.g., chunks of rows)
+# into the reduced entries of both parts together.
+#
+# Idea:  Reduced entries are turned back into a sequence of entries with the same effect -
+#        a replacement as an invalid entry followed by the value, an addition as the value
+#        alone - and reduced again.
+#
+# Parameters:  first, second - tuples (cell list, value list, mode list), see reduce_entries
+# Returns:     cell list, value list, mode list
+
+def merge_entries(first, second):
+
+    cells = []
+    values = []
+
+    for cell_list, value_list, mode_list in [first, second]:
+        replace = (mode_list == ENTRY_REPLACE)
+        valid = ~np.isnan(value_list)
+
+        cells.extend([cell_list[replace], cell_list[valid]])
+        values.extend([np.nan * np.ones(replace.sum()), value_list[valid]])
+
+    return reduce_entries(np.concatenate(cells), np.concatenate(values))
+
+# Read a PPMI data file, and reduce it to array entries (see reduce_PPMI_data)
+#
+# Parameters:
+# fileinfo - path & filename to PPMI data file
+# infolog - file handle (file object open with write access) for logfile output
+# shape - shape of the three-dimensional data array
+# subject_index, event_index, test_index - dictionaries label : array position
+# test_dict - translation dictionary PPMI abbreviation : descriptor
+#
+# Returns:  cell list, value list, mode list
+#
+# The file is read in chunks of rows (only subject ID, event ID, and the columns listed in the
+# translation dictionary);  each chunk is reduced on its own, and merged with the entries of the
+# chunks before it.
+
+def reduce_PPMI_file(fileinfo, infolog, shape, subject_index, event_index, test_index, test_dict):
+
+    # Open database (test columns as text):
+
+    dtype = dict((col, str) for col in test_dict)
+    dtype['EVENT_ID'] = str
+
+    try:
+        ppmi_data = read_PPMI_chunks(fileinfo,
+            lambda header: [col for col in header if (col in ['PATNO', 'EVENT_ID']) or (col in test_dict)], dtype)
+
+    except IOError:
+        print 'ERROR:  Could not open PPMI database file', fileinfo
+        raise IOError
+
+    entries = (np.zeros(0, dtype = int), np.zeros(0), np.zeros(0, dtype = int))
+    row_count = 0
+
+    for chunk in ppmi_data:
+        chunk_entries = reduce_PPMI_data(chunk, fileinfo, infolog, shape, subject_index, event_index, test_index, test_dict)
+
+        entries = merge_entries(entries, chunk_entries)
+        row_count += len(chunk)
+
+    # Deliver success message:
+    
+    infolog.write('\t Read ' + str(row_count) + ' entries in database ' + fileinfo + '\n')
+
+    return entries
+
+# Worker process version of reduce_PPMI_file:  Log output is collected in a string
+# and handed back with the entries, so that it can be written out in order.
+#
+# Parameters:  tuple (fileinfo, shape, subject_index, event_index, test_index, test_dict)
+# Returns:     (cell list, value list, mode list), log output string
+
+def reduce_PPMI_worker(arguments):
+
+    infolog = StringIO.StringIO()
+    entries = reduce_PPMI_file(arguments[0], infolog, *arguments[1:])
+
+    return entries, infolog.getvalue()
 
 def read_PPMI_data(fileinfo, infolog, data_array, subject_list, event_list, test_list, test_dict):
     
@@ -146,89 +456,12 @@ def read_PPMI_data(fileinfo, infolog, data_array, subject_list, event_list, test
     # test_list - list of desired data columns (readable descriptors)
     # test_dict - translation dictionary PPMI abbreviation : descriptor
 
-    # Open database:
-    try:
-        ppmi_data = pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False)
+    # Reduce data to array entries, and store them:
 
-    except IOError:
-        print 'ERROR:  Could not open PPMI database file', fileinfo
-        raise IOError
+    cell_list, value_list, mode_list = reduce_PPMI_file(fileinfo, infolog, data_array.shape,
+        label_index(subject_list), label_index(event_list), label_index(test_list), test_dict)
 
-    # Find dimensions of data file:
-
-    rowcount = len(ppmi_data)
-    
-    columns  = ppmi_data.columns.tolist()
-    colcount = len(columns)
-
-    colset   = set(test_dict.keys())
-    
-    # Read PPMI data, row by row:
-    
-    for row in range(0, rowcount):
-        
-        # Find subject and event IDs first:
-        
-        subject_ID = ppmi_data.ix[row,'PATNO']
-        event_ID = ppmi_data.ix[row,'EVENT_ID']
-    
-        # Is the data entry recognizable?
-        
-        if ((subject_ID in subject_list) and (event_ID in event_list)):
-            subject_index = subject_list.index(subject_ID)
-            event_index = event_list.index(event_ID)
-           
-            # Yes, check for columns of interest:
-            
-            for col in columns:
-                if (col in colset):
-                    
-                    # Translate Description:
-                    
-                    test_index = test_list.index(test_dict[col])
-                    
-                    # Read & store value in array:
-                    
-                    entry = ppmi_data.ix[row, col]
-                    
-                    # Initialize entry if encountered for the first time:
-                    
-                    if (np.isnan(data_array[event_index, subject_index, test_index]) == True):
-                        data_array[event_index, subject_index, test_index] = 0
-                    
-                    # Columns that are translated to the same descriptions are added together.
-                    # This requires purely numerical input ... try to catch scattered mal-formed text entries here:
-                    
-                    try:
-                        if entry == 'below detection limit':
-                            entry = 0
-
-                        entry = float(entry)
-                        data_array[event_index, subject_index, test_index] += entry
-                    
-                    except ValueError:
-                        
-                        # Give detailed error information
-                        
-                        infolog.write('\t\t TROUBLE:  Encountered non-numerical data while trying to import\n')
-                        infolog.write('\t\t\t Offending entry: ' + entry + '\n')
-                        infolog.write('\t\t\t File: ' + fileinfo + '\n')
-                        infolog.write('\t\t\t Subject: ' + str(subject_ID) + ' - Test: ' + test_dict[col] + ' - Event: ' + event_ID + '\n')
-                        
-                        # To recover, just mark the value as not present
-                        
-                        data_array[event_index, subject_index, test_index] = np.nan
-                            
-                    except:
-                        
-                        # Something else happened, so fail gracefully...
-                        
-                        print "Unexpected error:", sys.exc_info()[0]
-                        raise
-             
-    # Deliver success message:
-    
-    infolog.write('\t Read ' + str(rowcount) + ' entries in database ' + fileinfo + '\n')
+    store_entries(data_array, cell_list, value_list, mode_list)
     
     return data_array
 
@@ -242,8 +475,13 @@ def read_PPMI_data(fileinfo, infolog, data_array, subject_list, event_list, test
 #             test_list - list of recognized tests (cleartext descriptors)
 #             test_dict - dictionary PPMI test code : cleartext descriptors
 #             infolog - file handle (file object open with write access) for logfile output
+#             workers - number of worker processes (default: 1, read files one after another)
+#
+# With several workers, each file is read and reduced in a separate process.  The results
+# are stored in the order of file_list, so the data array (and the log file) does not depend
+# on the number of workers.
 
-def get_PPMI_data(subject_list, event_list, file_list, test_list, test_dict, infolog):
+def get_PPMI_data(subject_list, event_list, file_list, test_list, test_dict, infolog, workers = 1):
     
     # Create storage for the data panel.  By default, we assume that all entries are numerical.
     # Also, mark every entry initially as invalid - we'll divide zero by zero:
@@ -251,14 +489,315 @@ def get_PPMI_data(subject_list, event_list, file_list, test_list, test_dict, inf
     data_array = np.zeros((len(event_list), len(subject_list), len(test_list))) / 0
 
     # (Note:  This is a workaround for storing data in the pandas Panel structure directly - that is just *way* slow.)
+
+    return load_PPMI_files(data_array, subject_list, event_list, file_list, test_list, test_dict, infolog, workers)
+
+# Add the contents of a list of PPMI data files to an existing data array.
+# (Parameters as in get_PPMI_data; data_array is the three-dimensional array to store data.)
+
+def load_PPMI_files(data_array, subject_list, event_list, file_list, test_list, test_dict, infolog, workers = 1):
+
+    if (workers < 2) or (len(file_list) < 2):
+
+        # Loop thru data files, parse for test results:
     
-    # Loop thru data files, parse for test results:
-    
-    for datafile in file_list:
-        read_PPMI_data(datafile, infolog, data_array, subject_list, event_list, test_list, test_dict)
+        for datafile in file_list:
+            read_PPMI_data(datafile, infolog, data_array, subject_list, event_list, test_list, test_dict)
+
+        return data_array
+
+    # Parse files in parallel:
+
+    indices = (label_index(subject_list), label_index(event_list), label_index(test_list))
+    arguments = [(datafile, data_array.shape) + indices + (test_dict,) for datafile in file_list]
+
+    pool = multiprocessing.Pool(processes = min(workers, len(file_list)))
+
+    try:
+        results = pool.map(reduce_PPMI_worker, arguments)
+    finally:
+        pool.close()
+        pool.join()
+
+    # Merge results in file order:
+
+    for entries, log_output in results:
+        infolog.write(log_output)
+        store_entries(data_array, *entries)
         
     return data_array
 
+
+# Incremental builds:
+#
+# Alongside the data object, we keep a 'build manifest' (JSON format) that records
+#
+# - for each PPMI data file:  modification time, size, MD5 hash of the contents, column headers
+# - for each dataset in the control file:  MD5 hash of its entry
+# - for each test descriptor:  the ordered list of (file, PPMI test code) pairs it is read from
+#
+# An incremental build compares the current state to the manifest, and re-reads only the
+# tests whose sources have changed.  All other tests are copied over from the stored data object.
+
+# Find the fingerprint of a PPMI data file.
+# If modification time and size match a previous fingerprint, the file is not read again.
+#
+# Parameters:  path & filename of data file, previous fingerprint (dictionary, or None)
+# Returns:     dictionary {'mtime', 'size', 'md5', 'columns'}
+
+def file_fingerprint(fileinfo, previous = None):
+
+    try:
+        status = os.stat(fileinfo)
+
+    except OSError:
+        print 'ERROR:  Could not open PPMI database file', fileinfo
+        raise IOError
+
+    if (previous is not None) and (previous['mtime'] == status.st_mtime) and (previous['size'] == status.st_size):
+        return previous
+
+    # Hash file contents in blocks:
+
+    digest = hashlib.md5()
+
+    with open(fileinfo, 'rb') as datafile:
+        for block in iter(lambda: datafile.read(1 << 20), b''):
+            digest.update(block)
+
+    # Read column headers only:
+
+    columns = pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False, nrows = 0).columns.tolist()
+
+    return {'mtime' : status.st_mtime, 'size' : status.st_size, 'md5' : digest.hexdigest(), 'columns' : columns}
+
+# Find the fingerprints of the datasets listed in the control file.
+#
+# Parameters:  Test information as JSON file
+# Returns:     dictionary {dataset identifier : {'md5', 'tests'}}, where 'tests' lists all descriptors
+#              referenced by the dataset
+
+def dataset_fingerprints(fileinfo = '../PPMI Analysis/selectdata.json'):
+
+    try:
+        with open(fileinfo, 'r') as overview:
+            selection = js.load(overview)['selectdata']
+
+    except IOError:
+        print 'ERROR:  Could not open PPMI test information file', fileinfo
+        raise IOError
+
+    datasets = {}
+
+    for entry in selection.keys():
+        contents = js.dumps(selection[entry], sort_keys = True)
+        tests = set(selection[entry]['testlist']) | set(selection[entry]['testdict'].values())
+
+        datasets[entry] = {'md5' : hashlib.md5(contents.encode('utf-8')).hexdigest(), 'tests' : sorted(tests)}
+
+    return datasets
+
+# Create the build manifest for the current data selection.
+#
+# Parameters:
+# file_list - list of PPMI data files
+# test_dict - dictionary PPMI test code : cleartext descriptors
+# datasets - dataset fingerprints (see dataset_fingerprints)
+# previous - manifest of the previous build (or None)
+#
+# Returns:  manifest dictionary {'files', 'datasets', 'sources'}
+
+def build_manifest(file_list, test_dict, datasets, previous = None):
+
+    previous_files = {}
+    if (previous is not None):
+        previous_files = previous['files']
+
+    files = {}
+    sources = {}
+
+    for datafile in file_list:
+        files[datafile] = file_fingerprint(datafile, previous_files.get(datafile))
+
+        # Record where each descriptor is read from, in the order entries are added up:
+
+        for col in files[datafile]['columns']:
+            if (col in test_dict):
+                sources.setdefault(test_dict[col], []).append([datafile, col])
+
+    return {'files' : files, 'datasets' : datasets, 'sources' : sources}
+
+# Read a build manifest from disk.
+#
+# Parameters:  path & filename of manifest
+# Returns:     manifest dictionary, or None if no manifest is available
+
+def read_manifest(fileinfo):
+
+    try:
+        with open(fileinfo, 'r') as manifest:
+            return js.load(manifest)
+
+    except (IOError, ValueError):
+        return None
+
+# Compare the current build to the previous one, and find the tests that need to be read again.
+#
+# Parameters:
+# test_list - list of recognized tests (cleartext descriptors)
+# previous_tests - list of tests in the stored data object
+# manifest - current build manifest
+# previous - manifest of the previous build
+#
+# Returns:  set of tests to be re-read
+
+def find_changed_tests(test_list, previous_tests, manifest, previous):
+
+    changed_tests = set(test_list) - set(previous_tests)
+
+    # Tests referenced by new or modified datasets:
+
+    for entry, fingerprint in manifest['datasets'].items():
+        if (previous['datasets'].get(entry, {}).get('md5') != fingerprint['md5']):
+            changed_tests.update(fingerprint['tests'])
+
+    # Tests read from new or modified files, or from a different set of columns:
+
+    changed_files = set(datafile for datafile, fingerprint in manifest['files'].items()
+                        if (previous['files'].get(datafile, {}).get('md5') != fingerprint['md5']))
+
+    for test in test_list:
+        test_sources = manifest['sources'].get(test, [])
+
+        if (test_sources != previous['sources'].get(test, [])):
+            changed_tests.add(test)
+
+        elif any((datafile in changed_files) for datafile, col in test_sources):
+            changed_tests.add(test)
+
+    return changed_tests & set(test_list)
+
+# Update a stored data array:  Copy unchanged tests, and re-read only the changed ones.
+#
+# Parameters:
+# previous_array - data array of the stored data object
+# previous_tests - list of tests in the stored data object
+# changed_tests - set of tests to be read again
+# manifest - current build manifest
+# (other parameters as in get_PPMI_data)
+#
+# Returns:  updated data array
+
+def update_PPMI_data(previous_array, previous_tests, changed_tests, manifest,
+                     subject_list, event_list, file_list, test_list, test_dict, infolog, workers = 1):
+
+    data_array = np.zeros((len(event_list), len(subject_list), len(test_list))) / 0
+
+    # Patch in unchanged tests from the stored array:
+
+    previous_index = label_index(previous_tests)
+    kept_tests = [position for position, test in enumerate(test_list) if (test not in changed_tests)]
+
+    data_array[:, :, kept_tests] = previous_array[:, :, [previous_index[test_list[position]] for position in kept_tests]]
+
+    # Re-read changed tests, from the files that contain them only:
+
+    changed_dict = dict((code, test) for code, test in test_dict.items() if (test in changed_tests))
+    changed_files = [datafile for datafile in file_list
+                     if any((col in changed_dict) for col in manifest['files'][datafile]['columns'])]
+
+    return load_PPMI_files(data_array, subject_list, event_list, changed_files, test_list, changed_dict, infolog, workers)
+
+# Storage of the data object:
+#
+# The data object can be written in two formats, selected by the extension of the output file:
+#
+# - '.pkl':  the pickled tuple (subject_list, subject_condition, event_list, test_list, test_dict, PPMI_array)
+# - '.npy':  the data array as a raw numpy file, which readers can memory-map and page in
+#            slice by slice, plus a small JSON sidecar file ('.json', same base name) that holds
+#            the axis labels, subject conditions, test dictionary, and availability index
+#
+# In the numpy format, both files are first written under temporary names and then moved into
+# place, so processes that have the previous version open are not disturbed.
+
+# Count subjects with data for each event and test, in total and for each cohort.
+#
+# Parameters:  data array, list of subject IDs, subject:condition dictionary
+# Returns:     dictionary {'subjects' : counts, cohort : counts, ...}, where counts
+#              are nested lists (events x tests)
+
+def availability_index(PPMI_array, subject_list, subject_condition):
+
+    conditions = np.array([subject_condition[subj] for subj in subject_list], dtype = object)
+    valid = ~np.isnan(PPMI_array)
+
+    counts = {'subjects' : valid.sum(axis = 1).tolist()}
+
+    for group in set(conditions):
+        counts[group] = valid[:, (conditions == group), :].sum(axis = 1).tolist()
+
+    return counts
+
+# Write the data object to disk.
+#
+# Parameters:  path & filename of data object, tuple of data object contents (see above)
+
+def write_PPMI_object(fileinfo, results):
+
+    subject_list, subject_condition, event_list, test_list, test_dict, PPMI_array = results
+
+    if (os.path.splitext(fileinfo)[1] != '.npy'):
+        with open(fileinfo, 'wb') as output:
+            pickle.dump(results, output)
+
+        return
+
+    # Axis labels & condition map, in native Python types:
+
+    subjects = np.asarray(subject_list).tolist()
+
+    sidecar = {'array'      : os.path.basename(fileinfo),
+               'shape'      : list(PPMI_array.shape),
+               'subjects'   : subjects,
+               'conditions' : [subject_condition[subj] for subj in subject_list],
+               'events'     : list(event_list),
+               'tests'      : list(test_list),
+               'testdict'   : test_dict,
+               'availability' : availability_index(PPMI_array, subject_list, subject_condition)}
+
+    sidefile = os.path.splitext(fileinfo)[0] + '.json'
+
+    with open(fileinfo + '.tmp', 'wb') as output:
+        np.save(output, np.ascontiguousarray(PPMI_array, dtype = float))
+
+    with open(sidefile + '.tmp', 'w') as output:
+        js.dump(sidecar, output, sort_keys = True)
+
+    os.rename(fileinfo + '.tmp', fileinfo)
+    os.rename(sidefile + '.tmp', sidefile)
+
+# Read the data object from disk (either format).
+#
+# Parameters:  path & filename of data object
+# Returns:     tuple (subject_list, subject_condition, event_list, test_list, test_dict, PPMI_array)
+#              (in the numpy format, PPMI_array is a read-only memory map)
+
+def read_PPMI_object(fileinfo):
+
+    if (os.path.splitext(fileinfo)[1] != '.npy'):
+        with open(fileinfo, 'rb') as datafile:
+            return pickle.load(datafile)
+
+    with open(os.path.splitext(fileinfo)[0] + '.json', 'r') as sidefile:
+        sidecar = js.load(sidefile)
+
+    subject_list = sidecar['subjects']
+    subject_condition = dict(zip(subject_list, sidecar['conditions']))
+
+    PPMI_array = np.load(fileinfo, mmap_mode = 'r')
+
+    return subject_list, subject_condition, sidecar['events'], sidecar['tests'], sidecar['testdict'], PPMI_array
+
 # ********** MAIN SCRIPT
 
 # Run only if called directly:
@@ -270,14 +809,20 @@ if __name__ == '__main__':
     import json as js
     import pickle
     import sys
+    import multiprocessing
+    import StringIO
+    import hashlib
+    import os
 
     # Default settings for JSON control script, subject master record,
-    # pickled data object, log file:
+    # data object, log file, build mode:
  
     ctrlfile = '../PPMI Analysis/selectdata.json'
     subjfile = '../PPMI Data/Subject_Characteristics/Patient_Status.csv'
-    objfile  = '../PPMI Analysis/PPMI_data.pkl'
+    objfile  = '../PPMI Analysis/PPMI_data.npy'
     logfile  = '../PPMI Analysis/PPMI_data_structures.log'    
+    workers  = 1
+    build    = 'full'
 
     # Settings may be overridden by options:
     #
@@ -285,6 +830,8 @@ if __name__ == '__main__':
     #   -s = subjectfile
     #   -o = objectfile
     #   -l = logfile
+    #   -w = number of worker processes for reading data files
+    #   -b = build mode ('full' or 'incremental')
     #
     # First, check whether file names are supplied:
 
@@ -337,6 +884,30 @@ if __name__ == '__main__':
             elif (code == 's'):
                 subjfile = value
 
+            elif (code == 'w'):
+
+                # Number of workers must be a positive integer
+
+                try:
+                    workers = int(value)
+
+                except ValueError:
+                    workers = 0
+
+                if (workers < 1):
+                    print 'ERROR:  Invalid number of workers', entry
+                    raise SystemExit(0)
+
+            elif (code == 'b'):
+
+                # Build mode must be either 'full' or 'incremental'
+
+                if not (value in ['full', 'incremental']):
+                    print 'ERROR:  Unknown build mode', entry
+                    raise SystemExit(0)
+
+                build = value
+
             else:
                 # Unrecognized option
 
@@ -374,21 +945,69 @@ if __name__ == '__main__':
     file_list, test_list, test_dict = extract_test_information(ctrlfile)
     infolog.write('SUCCESS:  Read PPMI database dictionary\n')
 
+    # The build manifest is stored next to the data object:
+
+    manfile = os.path.splitext(objfile)[0] + '_manifest.json'
+    previous = None
+
+    if (build == 'incremental'):
+        previous = read_manifest(manfile)
+
+    manifest = build_manifest(file_list, test_dict, dataset_fingerprints(ctrlfile), previous)
+
+    # For an incremental build, recover the stored data object.
+    # The subject and event axes must be unchanged, otherwise we need to start from scratch:
+
+    previous_data = None
+
+    if (previous is not None):
+        try:
+            previous_data = read_PPMI_object(objfile)
+
+        except (IOError, ValueError, EOFError, pickle.UnpicklingError):
+            previous_data = None
+
+    if (previous_data is not None) and ((previous_data[0] != subject_list) or (previous_data[2] != event_list)):
+        previous_data = None
+
     # Ingest PPMI data:
 
-    PPMI_array = get_PPMI_data(subject_list, event_list, file_list, test_list, test_dict, infolog)
-    infolog.write('SUCCESS:  Loaded PPMI databases\n')
+    if (previous_data is None):
+        if (build == 'incremental'):
+            infolog.write('WARNING:  No matching PPMI data object found, performing full build\n')
+
+        PPMI_array = get_PPMI_data(subject_list, event_list, file_list, test_list, test_dict, infolog, workers)
+        infolog.write('SUCCESS:  Loaded PPMI databases\n')
+
+    else:
+        previous_tests = previous_data[3]
+        changed_tests = find_changed_tests(test_list, previous_tests, manifest, previous)
+
+        PPMI_array = update_PPMI_data(previous_data[5], previous_tests, changed_tests, manifest,
+                                      subject_list, event_list, file_list, test_list, test_dict, infolog, workers)
+        infolog.write('SUCCESS:  Updated ' + str(len(changed_tests)) + ' of ' + str(len(test_list)) + ' tests from PPMI databases\n')
 
     # The work is really now all done ... store away results for later use:
     
     try:
-        with open(objfile, 'wb') as output:
-            results = (subject_list, subject_condition, event_list, test_list, test_dict, PPMI_array)
-            pickle.dump(results, output)
+        results = (subject_list, subject_condition, event_list, test_list, test_dict, PPMI_array)
+        write_PPMI_object(objfile, results)
 
     except IOError:
         print 'ERROR:  Could not create PPMI data object', objfile
         raise IOError
 
-    infolog.write('SUCCESS:  Wrote PPMI data object to file ' + objfile + '\n\n')
+    infolog.write('SUCCESS:  Wrote PPMI data object to file ' + objfile + '\n')
+
+    # Record sources for the next incremental build:
+
+    try:
+        with open(manfile, 'w') as output:
+            js.dump(manifest, output, sort_keys = True, indent = 1)
+
+    except IOError:
+        print 'ERROR:  Could not create build manifest', manfile
+        raise IOError
+
+    infolog.write('SUCCESS:  Wrote build manifest to file ' + manfile + '\n\n')
     infolog.close()
\ No newline at end of file
@@ -13,24 +13,45 @@
 import pandas as pd
 import numpy as np
 
+# Translation dictionary for the Event column into PPMI standard form (see clean_event_column):
+
+event_dict = {'Screening Visit':'SC', 'Baseline Collection':'BL', 'Visit 01':'V01', 'Visit 02':'V02', 
+			  'Visit 03':'V03', 'Visit 04':'V04', 'Visit 05':'V05', 'Visit 06':'V06',
+			  'Visit 07':'V07', 'Visit 08':'V08', 'Visit 09':'V09', 'Visit 10':'V10',
+			  'Visit 11':'V11', 'Visit 12':'V12'}
+
+# Raw data files are read in chunks of this many rows, so that only the rows that are used (results
+# for recognized events) are kept in memory.  Only the columns used below are read;  text columns are
+# read as text, so that the column types do not depend on the contents of a chunk.
+
+CHUNK_SIZE = 50000
+
+raw_columns = ['PATNO', 'CLINICAL_EVENT', 'TYPE', 'TESTNAME', 'TESTVALUE', 'RUNDATE']
+
 # Read in a raw data set from the study (.CSV format)
 # Argument: Path & filename
-# Returns:  Dataframe object, containing the file contents
+# Returns:  Dataframe object, containing the file contents (results for recognized events)
 
-def read_raw_data(fileinfo):
+def read_raw_data(fileinfo, chunk_size = CHUNK_SIZE):
 	
+	dtype = {column : str for column in raw_columns if column != 'PATNO'}
+
 	try:
-		data_raw = pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False)
+		reader = pd.io.parsers.read_table(fileinfo, sep =',', header = 0, index_col = False, 
+										  usecols = raw_columns, dtype = dtype, chunksize = chunk_size)
+
+		chunks = [chunk[chunk['CLINICAL_EVENT'].isin(event_dict.keys())] for chunk in reader]
 
 	except IOError:
 		print 'ERROR:  Could not open biomarker database', fileinfo
 		raise IOError
 	
-	return data_raw
+	return pd.concat(chunks, ignore_index = True)
 
 # Some files contain multiple results for the same measurement or test because the analysis needed to
 # be re-run.  This method eliminates obsolete entries for such tests, and only keeps the most recent
 # results.  The data is supplied as a dataframe, and returned as a cleaned dataframe, sorted by patient ID. 
+# The number of obsolete (superseded) results is reported for each test.
 
 def discard_obsolete_data(database):
 	
@@ -39,29 +60,23 @@ def discard_obsolete_data(database):
 	# Idea:  Sort database by entries expected to be identical for repeated tests, expect for the data of analysis
 
 	testlist = database.sort(['PATNO', 'CLINICAL_EVENT', 'TYPE', 'TESTNAME', 'RUNDATE'], ascending = False) 
-	test_size = len(testlist)
-
-	# Extract a subset of columns that will be matching for tests that are redone:
 
-	comparelist = testlist[['PATNO', 'CLINICAL_EVENT', 'TYPE', 'TESTNAME']]
+	# In the sorted list, repeated tests follow each other, newest result first.  Keep a row only if
+	# the columns that match for tests that are redone differ from all rows before it (missing
+	# entries count as equal):
 
-	# Now, step thru the sorted list line by line.  If the columns match up, only keep the newest result.
-	# (The list last_entry stores the rows in the sorted database to be kept.)
+	row_keep = ~testlist.duplicated(['PATNO', 'CLINICAL_EVENT', 'TYPE', 'TESTNAME'], keep = 'first').values
 
-	row_keep = []
-	last_entry = []
+	# Report the number of obsolete results, by test:
 
-	for row in range(0, test_size):
-		entry = comparelist.iloc[row].tolist()
-				
-		if (entry != last_entry):
-			row_keep.append(row)
+	superseded = testlist['TESTNAME'][~row_keep].value_counts()
 
-		last_entry = entry
+	for testname in sorted(superseded.index):
+		print 'Discarded', superseded[testname], 'obsolete result(s) for test', testname
 
 	# Eliminate the duplicate/obsolete rows
 
-	testlist = testlist.take(row_keep, axis = 0)
+	testlist = testlist[row_keep]
 
 	# Sort the database again, in a more user-friendly ascending format, and return:
 
@@ -71,14 +86,7 @@ def discard_obsolete_data(database):
 
 def clean_event_column(database):
 
-	# Translation Dictionary:
-
-	event_dict = {'Screening Visit':'SC', 'Baseline Collection':'BL', 'Visit 01':'V01', 'Visit 02':'V02', 
-				  'Visit 03':'V03', 'Visit 04':'V04', 'Visit 05':'V05', 'Visit 06':'V06',
-				  'Visit 07':'V07', 'Visit 08':'V08', 'Visit 09':'V09', 'Visit 10':'V10',
-				  'Visit 11':'V11', 'Visit 12':'V12'}
-
-	# Prepare list of recognized keys:
+	# Prepare list of recognized keys (see event_dict):
 	
 	event_list = event_dict.keys()
 
@@ -97,59 +105,109 @@ def clean_event_column(database):
 	return database
 
 # Rewrite the file contents into standard PPMI format:
-# Read out a list of all tests performed
-# Create dataframes containing rows with each test individually
-# Append the data as columns to a new dataframe
+# Turn the list of test results (one row per subject, event, and test) into a table with one
+# row per subject and event, and one column per test, in a single pivot.
 
 def rewrite_biomarker_data(database):
 
-	# Read test types performed:
-	test_list = database['TESTNAME'].tolist()
+	keys = ['PATNO', 'EVENT_ID', 'TESTNAME']
 
-	# Eliminate Duplicates:
-	test_set = set(test_list)
+	# Each test should have one result per subject and event.  Repeated entries (e.g., the same
+	# test performed on different sample types) cannot be told apart in the standard format - keep
+	# the most recent result, and report the others:
 
-	# Write back into list form:
-	test_list = sorted(list(test_set))
+	database = database.sort('RUNDATE', kind = 'mergesort')
+	repeated = database.duplicated(keys, keep = 'last')
 
-	# Extract results for first test in list only - extract subject IDs and test values, rename the column after the test:
+	if repeated.any():
+		repeat_count = database['TESTNAME'][repeated].value_counts()
 
-	cleanbase = database[['PATNO', 'EVENT_ID', 'TESTVALUE']][(database['TESTNAME'] == test_list[0])]
-	cleanbase = cleanbase.rename(columns = {'TESTVALUE' : test_list[0]})
-	
-	# Do the same thing for all other named tests, but merge the result with the initial result:
+		for testname in sorted(repeat_count.index):
+			print 'WARNING:  Ignored', repeat_count[testname], 'repeated result(s) for test', testname
+
+		database = database[~repeated]
+
+	# Pivot:  test results, by (subject ID, event) and test name (tests in alphabetical order):
 
-	for i in range(1, len(test_list)):
-		auxbase = database[['PATNO', 'EVENT_ID', 'TESTVALUE']][(database['TESTNAME'] == test_list[i])]
-	 	auxbase = auxbase.rename(columns = {'TESTVALUE' : test_list[i]})
-	 	
-	 	cleanbase = pd.merge(cleanbase, auxbase, on = ['PATNO','EVENT_ID'], how = 'outer')
+	cleanbase = database.set_index(keys)['TESTVALUE'].unstack('TESTNAME', fill_value = np.nan)
+	cleanbase.columns.name = None
+
+	cleanbase = cleanbase.reset_index()
 
 	# Return the standardized database for biomarkers, sorted by subject ID and event:
 
 	return cleanbase.sort(['PATNO', 'EVENT_ID'])
 
+# Replacement rules for text entries in numerical columns:
+# A dictionary {column : {text entry : value}}, where the column '*' holds rules for all columns.
+# Rules for a column take precedence over the general ones.  A value of None stands for a missing
+# value (np.nan).  The rules may be replaced by the key 'replacements' in the JSON control file.
+
+default_replacements = {'*' : {'below detection limit' : 0},
+
+						# This entry occurs in the 'CSF Hemoglobin' column:
+
+						'CSF Hemoglobin' : {'>12500 ng/ml' : 12500.0, '>12500ng/ml' : 12500.0}}
+
+# Genetic data is given as text, and translated by the methods below (numerify_snca_multiplication,
+# numerify_apo_e, numerify_snps):
+
+genetic_columns = ['SNCA_multiplication', 'ApoE_Genotype', 'APOE GENOTYPE']
+
+def is_genetic_column(column):
+
+	return (column in genetic_columns) or (column[0:2] == 'rs')
+
 # This takes care of entries of 'below detection limit' and similar in a numerical column.
+# Only test columns containing text are examined, and each of them as a whole:  entries with a replacement
+# rule are replaced, numbers are kept as they are.  Any other text is unknown - it is reported, and
+# replaced by a missing value.
+#
+# Arguments:  database, replacements - replacement rules (optional, see default_replacements)
+# Returns:  cleaned database
 
-def clean_entries(database):
+def clean_entries(database, replacements = None):
 
-	# Translation Dictionary:
+	if (replacements is None):
+		replacements = default_replacements
 
-	def clean_string_entries(data_value):
+	for column in database.columns:
 
-		if (data_value == 'below detection limit'):
-			return 0
-		
-		# This entry occurs in the 'CSF Hemoglobin' column:
+		if (database[column].dtype != object) or (column in ['PATNO', 'EVENT_ID']) or is_genetic_column(column):
+			continue
+
+		values = database[column]
+
+		# Rules for this column:
+
+		rules = dict(replacements.get('*', {}))
+		rules.update(replacements.get(column, {}))
+
+		for token in rules:
+			if (rules[token] is None):
+				rules[token] = np.nan
+
+		# Replace known text entries (keeping the type of the replacement value):
+
+		known = values.isin(rules.keys())
+
+		if known.any():
+			rule_values = pd.Series(np.array(rules.values(), dtype = object), index = rules.keys())
+			values = values.copy()
+			values[known] = values[known].map(rule_values)
+
+		# Find unknown text entries - neither replaced, nor a number, nor missing:
 
-		if ((data_value == '>12500 ng/ml') or (data_value == '>12500ng/ml')):
-			return 12500.0
+		unknown = values.notnull() & ~known & pd.to_numeric(values, errors = 'coerce').isnull()
 
-		return data_value
+		if unknown.any():
+			tokens = values[unknown].value_counts()
+			print 'WARNING:  Discarded', unknown.sum(), 'unknown entries in column', column, ':', ', '.join(["'%s' (%d)" % (token, tokens[token]) for token in sorted(tokens.index)])
 
-	# Clean non-numerical entries:
+			values = values.copy()
+			values[unknown] = np.nan
 
-	database = database.applymap(clean_string_entries)
+		database[column] = values
 
 	return database
 
@@ -167,21 +225,14 @@ def numerify_apo_e(database):
 
 	# Numerify data - create three numerical columns that list the number of 
 	# ApoE e2, e3, e4 alleles in the genotype
+	# Entries are of the form 'e2/e4' etc., so we'll just count occurrences of
+	# allele names in the string (missing entries stay missing)
 
-	def count_alleles(genotype, allele):
-
-		# Hacky workaround - 'nan' is type(float), all valid entries are strings.
-		# Entries are of the form 'e2/e4' etc., so we'll just count occurrences of
-		# allele names in the string
-	
-		if (type(genotype) == str):
-			return float(genotype.count(allele))
+	for allele in ['e2', 'e3', 'e4']:
+		if (database['ApoE'].dtype == object):
+			database['ApoE ' + allele + ' Count'] = database['ApoE'].str.count(allele).astype(float)
 		else:
-			return np.nan
-
-	database['ApoE e2 Count'] = database['ApoE'].apply(lambda x: count_alleles(x, 'e2'))
-	database['ApoE e3 Count'] = database['ApoE'].apply(lambda x: count_alleles(x, 'e3'))
-	database['ApoE e4 Count'] = database['ApoE'].apply(lambda x: count_alleles(x, 'e4'))
+			database['ApoE ' + allele + ' Count'] = np.nan
 
 	# Remove the original column:
 	return database.drop('ApoE', axis = 1)
@@ -203,6 +254,7 @@ def numerify_apo_e(database):
 #
 # (This method guarantees a value of 0 for mixed genotype.)
 # The column names are amended to indicate the type of polymorphism, and assigned values.
+# Entries that are not of the form (base)/(base) are reported, and left out.
 
 def numerify_snps(database):
 
@@ -216,84 +268,84 @@ def numerify_snps(database):
 		if column[0:2] == 'rs':
 			SNP_list.append(column)
 
-	# Helper function:  Lexicographical model for numerical encoding of SNPs
-	# Idea:  All SNPs are of the form --, -+, ++, where - and + stand for two nucleotides
-	# We'll give a value of +1/2 to '+' and -1/2 to '-'
-	# By definition, - and + are assigned in the sequence A < C < G < T
-	# Let's include a 'hint' about which letter - and + stand for in the column header
+	if (len(SNP_list) == 0):
+		return database
 
-	def find_nucleotid_values(data_table, snp):
-	
-		# Step #1: Find the nucleotids involved in a SNP:
-		
-		nucleotid_dict = {'A' : 0, 'C' : 0, 'G' : 0, 'T' : 0}
-		nucleotids = nucleotid_dict.keys()
-		
-		# Count nucleotids for SNP in database:
-		
-		for entry in data_table[snp]:
-	 
-			# Hacky workaround - 'nan' is type(float), all valid entries are strings:
-			
-			if (type(entry) == str):
-				# Tally up nucleotids - look for letters in '(base 1)/(base 2)':
-				
-				for nuc in nucleotids:
-					nucleotid_dict[nuc] += entry.count(nuc)
-		
-		# Now, assign values of +1/2 or -1/2 to nucleotids:
-		# Also, generate symbolic code '-(base 1)+(base 2)' that indicates the pair of
-		# bases involved in the SNP, and the assignment of negative/positive values:
-		
-		current_value = -0.5
-		code = ' '
-		
-		for nuc in 'ACGT':
-			if nucleotid_dict[nuc] > 0:
-				
-				# Add symbolic code: (+) or (-) nucleotid
-				
-				if current_value < 0:
-					code = code + '-' + nuc
-				else:
-					code = code + '+' + nuc
+	# All SNP columns are treated together:  collect the genotype entries of all columns in a single
+	# list (with the row and column position of each entry), and find the distinct genotypes
+	# ('A/A', 'A/C', ...) among them:
 
-				# Assign value of -0.5 for first nucleotid, +0.5 for second nucleotid
-					
-				nucleotid_dict[nuc] = current_value
-				current_value += 1.0
-				
-		return nucleotid_dict, code
+	snp_table = database[SNP_list].values
 
-	# Helper function - find numerical code for genotype in SNP
+	rows, cols = np.nonzero(pd.notnull(snp_table))
+	genotype_codes, genotypes = pd.factorize(snp_table[rows, cols])
 
-	def snp_to_value(genotype, nuc_values):
+	# Split the genotypes into nucleotids '(base 1)/(base 2)' by a single string extraction:
 
-		# Add the values of the pair of nucleotids together, but leave 'NaN' for absent values intact.
-		# Hacky workaround - 'nan' is type(float), all valid entries are strings:
-		
-		if (type(genotype) == str):
-			return float(nuc_values[genotype[0]] + nuc_values[genotype[2]])
-		else:
-			return np.nan
+	bases = pd.Series(genotypes).astype(str).str.extract('^([ACGT])/([ACGT])$', expand = True)
+	valid = bases[0].notnull().values
 
-	# Helper function - rewrite SNP biomarker column in numerical form: 
+	if not valid.all():
+		print 'WARNING:  Discarded', (~valid[genotype_codes]).sum(), 'unrecognized SNP entries:', ', '.join(sorted(map(str, genotypes[~valid])))
 
-	def assign_snp_value(data_table, snp):
-		nuc_vals, code = find_nucleotid_values(data_table, snp)
-		
-		# Assign numerical values for SNPs, drop original columns
-		
-		data_table['SNP ' + snp + code] = data_table[snp].apply(lambda x: snp_to_value(x, nuc_vals))
-		
-		return data_table.drop(snp, axis = 1)
+	# Translate nucleotids into numbers 0 - 3 (in the sequence A < C < G < T) via a lookup array,
+	# then assign them to the entries:
 
-	# Numerify each SNP data column:
-	
-	for snp in SNP_list:
-		database = assign_snp_value(database, snp)
+	lookup = np.zeros(256, dtype = int)
+	lookup[np.frombuffer(b'ACGT', dtype = np.uint8)] = np.arange(4)
 
-	return database
+	bases = bases.fillna('A')
+
+	base_1 = lookup[bases[0].values.astype('S1').view(np.uint8)][genotype_codes]
+	base_2 = lookup[bases[1].values.astype('S1').view(np.uint8)][genotype_codes]
+
+	# Keep recognized entries only:
+
+	keep = valid[genotype_codes]
+	rows, cols, base_1, base_2 = rows[keep], cols[keep], base_1[keep], base_2[keep]
+
+	# Find the nucleotids involved in each SNP:
+
+	present = np.zeros((len(SNP_list), 4), dtype = bool)
+	present[cols, base_1] = True
+	present[cols, base_2] = True
+
+	# Now, assign values of +1/2 or -1/2 to nucleotids - -1/2 to the first nucleotid of a SNP,
+	# +1/2 to the second one (absent nucleotids keep the value 0):
+
+	nuc_values = np.where(present, np.cumsum(present, axis = 1) - 1.5, 0.0)
+
+	# Numerical code for each genotype - the sum of the values of its pair of nucleotids
+	# (absent values stay 'NaN'):
+
+	snp_values = np.empty(snp_table.shape)
+	snp_values.fill(np.nan)
+
+	snp_values[rows, cols] = nuc_values[cols, base_1] + nuc_values[cols, base_2]
+
+	# Also, generate symbolic code '-(base 1)+(base 2)' for the column header, that indicates
+	# the pair of bases involved in the SNP, and the assignment of negative/positive values:
+
+	snp_names = []
+
+	for snp, snp_present, snp_nuc_values in zip(SNP_list, present, nuc_values):
+
+		code = ' '
+
+		for nuc, nuc_present, value in zip('ACGT', snp_present, snp_nuc_values):
+			if nuc_present:
+				if value < 0:
+					code = code + '-' + nuc
+				else:
+					code = code + '+' + nuc
+
+		snp_names.append('SNP ' + snp + code)
+
+	# Replace the original columns by the numerical ones, all at once:
+
+	snp_data = pd.DataFrame(snp_values, index = database.index, columns = snp_names)
+
+	return pd.concat([database.drop(SNP_list, axis = 1), snp_data], axis = 1)
 
 # Numerify SNCA multiplication codes
 # 'SNCA multiplication' is a data column containing text descriptors.
@@ -309,21 +361,18 @@ def numerify_snca_multiplication(database):
 
 	snca_dict = {'NormalCopyNumber' : 0.0, 'CopyNumberChange' : 1.0, 'NotAssessed' : np.nan}
 
-	# Helper function - replace SNCA code
+	snca_codes = database['SNCA_multiplication']
 
-	def snca_to_value(snca_type, snca_dict):
+	# Unknown codes are reported, and treated as missing values:
 
-		# Translate into numerical values, but leave 'NaN' for absent values intact.
-		# Hacky workaround - 'nan' is type(float), all valid entries are strings:
-		
-		if (type(snca_type) == str):
-			return snca_dict[snca_type]
-		else:
-			return np.nan
+	unknown = snca_codes.notnull() & ~snca_codes.isin(snca_dict.keys())
 
-	# Assign numerical values
+	if unknown.any():
+		print 'WARNING:  Discarded', unknown.sum(), 'unknown SNCA multiplication codes:', ', '.join(sorted(snca_codes[unknown].unique()))
+
+	# Assign numerical values (absent values stay absent):
 		
-	database['SNCA_multiplication'] = database['SNCA_multiplication'].apply(lambda x: snca_to_value(x, snca_dict))
+	database['SNCA_multiplication'] = snca_codes.map(snca_dict).astype(float)
 		
 	return database
 
@@ -344,6 +393,8 @@ if __name__ == '__main__':
 
 	outputfile = '../PPMI Data/Biospecimen_Analysis/biomarkers_clean.csv'
 
+	replacements = default_replacements
+
 	# Replace by user-supplied names if command line argument is given:
 
 	if (len(sys.argv) > 1):
@@ -368,11 +419,13 @@ if __name__ == '__main__':
 		#
 		# The key 'raw' must have a list of input file names (raw data) as values,
 		# the key 'output' should contain the path&name for the output database, conforming to PPMI format
+		# the optional key 'replacements' holds replacement rules for text entries (see default_replacements)
 		#
 		# (other keys simply go unrecognized)
 
 		raw_bio_file = contents['raw']
 		outputfile   = contents['outputfile']
+		replacements = contents.get('replacements', default_replacements)
 
 	# Load the biomarker files, and join them together, if necessary:
 
@@ -397,7 +450,7 @@ if __name__ == '__main__':
 
 	# Clean out disruptive non-numerical entries:
 
-	clean_bio = clean_entries(clean_bio)
+	clean_bio = clean_entries(clean_bio, replacements)
 	clean_bio = numerify_snca_multiplication(clean_bio)
 
 	# Clean Apolipoprotein E genetic data:
@@ -13,7 +13,339 @@ import numpy as np
 import matplotlib.pyplot as plt
 import matplotlib.image as mpimg
 import StringIO
+import threading
+import struct
+import zlib
+import base64
+from matplotlib.figure import Figure
+from matplotlib.gridspec import GridSpec
+from matplotlib.backends.backend_agg import FigureCanvasAgg
 from scipy.stats import norm
+from scipy.ndimage import convolve1d
+
+# Background image for the Gaussian correlation plot:
+# Every data point is surrounded by a Gaussian 'penumbra' of given width and depth, colored
+# according to its cohort; overlapping penumbras add up, and the sum is mapped onto RGB values.
+#
+# Instead of evaluating a Gaussian over the whole grid for every data point, the points of each
+# cohort are first distributed onto the grid (bilinear weights to the four nearest grid points),
+# and the resulting density is then smoothed once by two one-dimensional Gaussian passes.
+# The cost depends on the grid size only, not on the number of data points.
+#
+# Input parameters:
+# x_values, y_values - numpy arrays of data point coordinates
+# conditions - numpy array of cohort labels for the data points
+# x_min, y_min - lower left corner of the canvas
+# x_count, y_count - number of grid points along each axis
+# resolution - grid spacing (equal along both axes)
+# Gauss_width - width of the Gaussian marker
+# Gauss_depth - maximum color saturation
+# rgb - dictionary of rgb values for each cohort
+#
+# Returns:
+# numpy array (y_count x x_count x 3) of RGB values (row index runs along y)
+
+def gauss_background(x_values, y_values, conditions, x_min, y_min, x_count, y_count,
+                     resolution, Gauss_width, Gauss_depth, rgb):
+
+    # The grid is padded, so that points just outside the canvas still shine in.
+    # (Beyond four widths, the Gaussian has dropped below 1e-7.)
+
+    pad = int(np.ceil(4.0 * Gauss_width / resolution))
+
+    padded_x = x_count + 2 * pad
+    padded_y = y_count + 2 * pad
+
+    # One-dimensional Gaussian kernel (exp(-r^2/w^2) = product of x and y kernels):
+
+    offsets = np.arange(-pad, pad + 1) * resolution
+    kernel = np.exp(-(offsets * offsets) / (Gauss_width * Gauss_width))
+
+    # Fractional grid positions of the data points:
+
+    pos_x = (np.asarray(x_values, dtype = float) - x_min) / resolution + pad
+    pos_y = (np.asarray(y_values, dtype = float) - y_min) / resolution + pad
+
+    inside = (pos_x >= 0) & (pos_x < padded_x - 1) & (pos_y >= 0) & (pos_y < padded_y - 1)
+
+    base_x = np.floor(pos_x[inside]).astype(int)
+    base_y = np.floor(pos_y[inside]).astype(int)
+
+    frac_x = pos_x[inside] - base_x
+    frac_y = pos_y[inside] - base_y
+
+    conditions = np.asarray(conditions)[inside]
+
+    ImageRGB = np.zeros((y_count, x_count, 3))
+
+    for cohort in rgb:
+
+        members = (conditions == cohort)
+
+        if not members.any():
+            continue
+
+        # Distribute points onto the four surrounding grid points:
+
+        density = np.zeros(padded_y * padded_x)
+
+        for shift_y, weight_y in ((0, 1.0 - frac_y[members]), (1, frac_y[members])):
+            for shift_x, weight_x in ((0, 1.0 - frac_x[members]), (1, frac_x[members])):
+                cells = (base_y[members] + shift_y) * padded_x + (base_x[members] + shift_x)
+                density += np.bincount(cells, weights = weight_y * weight_x, minlength = padded_y * padded_x)
+
+        # Smooth along x, then along y:
+
+        density = density.reshape(padded_y, padded_x)
+        density = convolve1d(density, kernel, axis = 1, mode = 'constant')
+        density = convolve1d(density, kernel, axis = 0, mode = 'constant')
+
+        GaussValues = Gauss_depth * density[pad:pad + y_count, pad:pad + x_count]
+
+        # Provide color by superposition
+
+        for channel in range(3):
+            ImageRGB[:, :, channel] += GaussValues * rgb[cohort][channel]
+
+    # Check and correct for saturated colors - RGB values should not exceed unity
+
+    return ImageRGB / (1.0 + ImageRGB)
+
+# ******** Figure templates and image encoding
+
+# Setting up a figure (axes, ticks, labels, legend) takes a good part of the rendering time.
+# Instead of building a new figure for every plot, one figure per plot type is prepared once
+# per process (on an Agg canvas, outside of pyplot), and only the data of its artists -
+# background image, markers, curves, title - is replaced for each new plot.
+#
+# Templates are shared by all callers within a process, so rendering is serialized by a lock.
+
+figure_templates = {}
+template_lock = threading.Lock()
+
+# Cohorts, in display order:
+
+template_cohorts = ['HC', 'PD', 'SWEDD']
+
+# Template for the scatter plots (scatter_gauss, scatter_plain):
+#
+# Input parameters:
+# Canvas limits - x_min, x_max, y_min, y_max
+# Marker sizes for data points and cohort averages - point_size, star_size
+# Dictionary of marker colors for each cohort - colors
+# Shape of the background image (None for a plain white canvas) - image_shape
+#
+# Returns:
+# dictionary of figure, canvas, axes, and artists (keyed by name or cohort)
+
+def scatter_template(x_min, x_max, y_min, y_max, point_size, star_size, colors, image_shape = None):
+
+    fig = Figure(figsize=(8, 8), dpi=150, facecolor='w', edgecolor='k')
+    canvas = FigureCanvasAgg(fig)
+
+    ax = fig.add_subplot(111)
+
+    template = {'figure' : fig, 'canvas' : canvas, 'axes' : ax}
+
+    # Background image (replaced by set_data):
+
+    if (image_shape is not None):
+        template['image'] = ax.imshow(np.zeros(image_shape), interpolation='bilinear', origin='lower',
+                                      extent=[x_min,x_max,y_min,y_max])
+
+    # Markers for data points and cohort averages (replaced by set_offsets):
+
+    for cohort in template_cohorts:
+        points = ax.scatter([], [], s = point_size, c = [colors[cohort]], alpha = .33)
+        star = ax.scatter([], [], s = star_size, c = [colors[cohort]], marker = '*', label = cohort)
+
+        template[cohort] = (points, star)
+
+    ax.set_xlim(x_min, x_max)
+    ax.set_ylim(y_min, y_max)
+
+    return template
+
+# Template for the profile plot (profile_gauss):
+#
+# Input parameters:
+# Canvas limits - x_min, x_max
+# Grid of the distribution curves - x
+# Dictionary of curve and marker colors for each cohort - colors
+#
+# Returns:
+# dictionary of figure, canvas, axes, and artists (keyed by name or cohort)
+
+def profile_template(x_min, x_max, x, colors):
+
+    fig = Figure(figsize=(8, 8), dpi=150, facecolor='w', edgecolor='k')
+    canvas = FigureCanvasAgg(fig)
+
+    grid = GridSpec(4, 1)
+
+    # Upper subplot for distribution curves, lower subplot for pinpoints:
+
+    ax = fig.add_subplot(grid[0:3, 0])
+    ax_points = fig.add_subplot(grid[3, 0])
+
+    ax_points.set_xticks([])
+    ax_points.set_yticks([])
+
+    ax_points.set_xlim(x_min, x_max)
+    ax_points.set_ylim(0, 1)
+
+    template = {'figure' : fig, 'canvas' : canvas, 'axes' : ax}
+
+    # Curves (replaced by set_ydata), markers for data points and averages (replaced by set_offsets):
+
+    for cohort in template_cohorts:
+        curve, = ax.plot(x, np.zeros(len(x)), lw = 2, c = colors[cohort], label = cohort)
+        points = ax_points.scatter([], [], s = 25, c = [colors[cohort]], alpha = .25)
+        star = ax_points.scatter([], [], s = 150, c = [colors[cohort]], marker = '*')
+
+        template[cohort] = (curve, points, star)
+
+    return template
+
+# Find template for a plot type, or set it up:
+#
+# Input parameters:
+# Name of the plot type - name
+# Function that sets up the template, and its arguments - setup, arguments
+#
+# Returns:
+# template dictionary
+
+def get_template(name, setup, *arguments):
+
+    if not (name in figure_templates):
+        figure_templates[name] = setup(*arguments)
+
+    return figure_templates[name]
+
+# Update the markers of a scatter template for a new set of data points:
+#
+# Input parameters:
+# template dictionary - template
+# Data point coordinates in form of pandas series objects - x_series, y_series
+# Corresponding series object (subject condition/cohort) - subj_cond
+#
+# Returns:
+# list of artists for the legend (cohort averages of the cohorts present)
+
+def update_scatter(template, x_series, y_series, subj_cond):
+
+    handles = []
+
+    for cohort in template_cohorts:
+
+        points, star = template[cohort]
+
+        cond_filter = (subj_cond == cohort)
+
+        x_select = x_series[cond_filter]
+        y_select = y_series[cond_filter]
+
+        if (len(x_select) > 0):
+
+            # Little markers for data points, big stars for cohort average
+
+            points.set_offsets(np.column_stack((x_select.values, y_select.values)))
+            star.set_offsets([[x_select.mean(), y_select.mean()]])
+
+            handles.append(star)
+
+        points.set_visible(len(x_select) > 0)
+        star.set_visible(len(x_select) > 0)
+
+    return handles
+
+# Encode the figure of a template as an image.
+#
+# By default, matplotlib's PNG writer is used.  If a compression level is given, the canvas
+# is drawn, and its RGB pixels are encoded by encode_png instead - level 1 is considerably
+# faster than matplotlib's default, at the cost of somewhat larger files.  A lower resolution
+# (e.g. dpi = 75, a quarter of the pixels) yields quick previews.
+#
+# Input parameters:
+# template dictionary - template
+# resolution of the image - dpi
+# zlib compression level 0-9, or None for matplotlib's writer - compression
+#
+# Returns:
+# String containing bitmap image in .PNG format - png_file
+
+def encode_figure(template, dpi = 150, compression = None):
+
+    fig = template['figure']
+
+    if (compression is None):
+        imgdata = StringIO.StringIO()
+        fig.savefig(imgdata, dpi = dpi, format='png')
+
+        return imgdata.getvalue()
+
+    # Draw at requested resolution, and read out the pixels:
+
+    figure_dpi = fig.get_dpi()
+    fig.set_dpi(dpi)
+
+    try:
+        canvas = template['canvas']
+        canvas.draw()
+
+        width, height = canvas.get_width_height()
+        pixels = np.frombuffer(canvas.tostring_rgb(), dtype = np.uint8).reshape(height, width, 3)
+
+    finally:
+        fig.set_dpi(figure_dpi)
+
+    return encode_png(pixels, dpi, compression)
+
+# PNG file chunk:  length, type tag, data, checksum
+
+def png_chunk(tag, data):
+
+    return (struct.pack('>I', len(data)) + tag + data +
+            struct.pack('>I', zlib.crc32(tag + data) & 0xffffffff))
+
+# Minimal PNG writer for RGB images.
+#
+# Every row is stored with the 'Sub' filter (difference to the pixel to the left), which
+# suits the large uniform areas and smooth gradients of plots well, and then deflated.
+#
+# Input parameters:
+# numpy array (height x width x 3) of type uint8 - pixels
+# resolution stored in the file - dpi
+# zlib compression level 0-9 - compression
+#
+# Returns:
+# String containing the image in .PNG format
+
+def encode_png(pixels, dpi, compression):
+
+    height, width, depth = pixels.shape
+
+    rows = pixels.reshape(height, width * depth)
+
+    # Filter type byte, first pixel unchanged, then differences (modulo 256):
+
+    filtered = np.empty((height, width * depth + 1), dtype = np.uint8)
+    filtered[:, 0] = 1
+    filtered[:, 1:depth + 1] = rows[:, :depth]
+    filtered[:, depth + 1:] = rows[:, depth:] - rows[:, :-depth]
+
+    # Header (8 bit RGB), resolution in pixels per meter, image data:
+
+    pixels_per_meter = int(round(dpi / 0.0254))
+
+    return ('\x89PNG\r\n\x1a\n' +
+            png_chunk('IHDR', struct.pack('>IIBBBBB', width, height, 8, 2, 0, 0, 0)) +
+            png_chunk('pHYs', struct.pack('>IIB', pixels_per_meter, pixels_per_meter, 1)) +
+            png_chunk('IDAT', zlib.compress(filtered.tostring(), compression)) +
+            png_chunk('IEND', ''))
+
+# ******** Plot types
 
 # A Gaussian display style for 2D correlations.
 
@@ -25,11 +357,12 @@ from scipy.stats import norm
 # Input parameters:
 # Pairs of values of data points in form of pandas series objects - x_series, y_series
 # Corresponding series object (subject ccondition/cohort) - subj_cond
+# Image resolution and PNG compression level (see encode_figure) - dpi, compression
 #
 # Returns:
 # String containing bitmap image in .PNG format - png_file
 
-def scatter_gauss(x_series, y_series, subj_cond):
+def scatter_gauss(x_series, y_series, subj_cond, dpi = 150, compression = None):
     
     # This section ideally should be controlled by function parameter keys.
     # For now, these were pretty good values for the PPMI study: 
@@ -52,150 +385,57 @@ def scatter_gauss(x_series, y_series, subj_cond):
     image_resolution_x = 0.025
     image_resolution_y = 0.025
     
-    # Number of data points to be displayed
-    
-    scatter_size = len(x_series)
-    
     # Color information - dictionary of rgb values for each color code (saturated)
     # Here only defined for types 0, 1, 2 (HC, PD, SWEDD)
     # (One could extend this for more values & colors, of course.)
 
     rgb = {'HC':[0.0,0.0,1.0], 'PD':[0.0,1.0,0.0], 'SWEDD':[1.0,0.0,0.0]}
-    
-    # Create Numerical Grid for Gaussians
 
-    x = np.arange(x_min, x_max, image_resolution_x)
-    y = np.arange(y_min, y_max, image_resolution_y)
-    X, Y = np.meshgrid(x, y)
-    
-    # Create grids for color functions.
-    # (We'll lave an empty canvas black.)
-    
-    ImageR = np.zeros((len(x),len(y)))
-    ImageG = np.zeros((len(x),len(y)))
-    ImageB = np.zeros((len(x),len(y)))
+    # Marker colors:
+
+    markers = {'HC':'b', 'PD':'g', 'SWEDD':'r'}
     
-    ImageRGB = np.zeros((len(x), len(y), 3))
+    # Number of grid points for background image:
+
+    x_count = len(np.arange(x_min, x_max, image_resolution_x))
+    y_count = len(np.arange(y_min, y_max, image_resolution_y))
     
-    # Add Gaussian 'penumbra' for each data point
+    # Create background image - Gaussian 'penumbra' for each data point
     # (color depends on condition listed)
+
+    ImageRGB = gauss_background(x_series[subj_cond.index].values, y_series[subj_cond.index].values, subj_cond.values,
+                                x_min, y_min, x_count, y_count, image_resolution_x, Gauss_width, Gauss_depth, rgb)
     
-    for subj in subj_cond.index:
-        delta_X = X - x_series[subj]
-        delta_Y = Y - y_series[subj]
-        
-        rel_dist = (delta_X * delta_X + delta_Y * delta_Y) / (Gauss_width * Gauss_width)
-        
-        # An interpolation function would speed up calculation here:
-
-        GaussValues = Gauss_depth * np.exp(-rel_dist)
-        
-        # Provide color by superposition
-        
-        ImageR = ImageR + GaussValues * rgb[subj_cond[subj]][0]
-        ImageG = ImageG + GaussValues * rgb[subj_cond[subj]][1]
-        ImageB = ImageB + GaussValues * rgb[subj_cond[subj]][2]
-      
-    # Check and correct for saturated colors - RGB values should not exceed unity
-        
-    ImageR = ImageR / (1.0 + ImageR)
-    ImageG = ImageG / (1.0 + ImageG)
-    ImageB = ImageB / (1.0 + ImageB)
-    
-    # Combine into RGB color function
-    
-    ImageRGB[:,:,0] = ImageR
-    ImageRGB[:,:,1] = ImageG
-    ImageRGB[:,:,2] = ImageB
-    
-    # Set up figure parameters:
-    fig = plt.figure(num=None, figsize=(8, 8), dpi=150, facecolor='w', edgecolor='k')
+    with template_lock:
 
-    plt.xlim(x_min, x_max)
-    plt.ylim(y_min, y_max)
+        # Figure is set up once, then only updated:
 
-    plt.title(x_series.name + ' - ' + y_series.name)
+        template = get_template('scatter_gauss', scatter_template, x_min, x_max, y_min, y_max, 10, 150,
+                                markers, (y_count, x_count, 3))
+        ax = template['axes']
 
-    # Create figure background - Gaussian distributions
-    
-    ax = plt.subplot()
-    ax.imshow(ImageRGB, interpolation='bilinear', origin='lower', extent=[x_min,x_max,y_min,y_max])
-    fig.add_subplot(ax)
+        ax.set_title(x_series.name + ' - ' + y_series.name)
 
-    # Create pinpoints for individual measurements by condition:
-    # Healthy controls:
+        # Figure background - Gaussian distributions
 
-    ax = plt.subplot()
-    
-    cond_filter = (subj_cond == 'HC')
-    
-    x_select = x_series[cond_filter]
-    y_select = y_series[cond_filter]
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        y_avg = y_select.mean()
-        
-        # Plot little blue markers for data points, big stars for cohort average
-
-        ax.scatter(x_select, y_select, s = 10, c = 'b', alpha = .33)
-        ax.scatter(x_avg, y_avg, s = 150 , c = 'b', marker = '*', label = 'HC')
-    
-    # Same now for Parkinson's cohort:
+        template['image'].set_data(ImageRGB)
 
-    cond_filter = (subj_cond == 'PD')
-    
-    x_select = x_series[(cond_filter)]
-    y_select = y_series[(cond_filter)]
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        y_avg = y_select.mean()
-
-        # Plot little green markers for data points, big stars for cohort average
-       
-        ax.scatter(x_select.tolist(), y_select.tolist(), s = 10, c = 'g', alpha = .33)
-        ax.scatter(x_avg, y_avg, s = 150 , c = 'g', marker = '*', label = 'PD')
-     
-    # And finally, the SWEDD cohort:
-
-    cond_filter = (subj_cond == 'SWEDD')
-    
-    x_select = x_series[(cond_filter)]
-    y_select = y_series[(cond_filter)]
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        y_avg = y_select.mean()
+        # Pinpoints for individual measurements by condition, stars for cohort averages:
 
-        # Plot little red markers for data points, big stars for cohort average
-        
-        ax.scatter(x_select, y_select, s = 10, c = 'r', alpha = .33)
-        ax.scatter(x_avg, y_avg, s = 150 , c = 'r', marker = '*', label = 'SWEDD')    
+        handles = update_scatter(template, x_series, y_series, subj_cond)
 
-    ax.legend(loc = 'upper left', scatterpoints = 1)
-    fig.add_subplot(ax)
+        ax.legend(handles, [h.get_label() for h in handles], loc = 'upper left', scatterpoints = 1)
 
-    # Now, save the graph as a .PNG image.
-    # Don't write it to disk - instead, return it as a string:
-    
-    imgdata = StringIO.StringIO()
-    fig.savefig(imgdata, dpi = 150, format='png')
-    plt.close()
-    
-    # Get the contents of the image file as a string:
-    
-    imgdata.seek(0)
-    png_file = imgdata.buf
+        # Now, encode the graph as a .PNG image.
+        # Don't write it to disk - instead, return it as a string:
+
+        png_file = encode_figure(template, dpi, compression)
     
     return png_file
 
 # The same as the Gaussian scatter plot, just without the fancy background:
 
-def scatter_plain(x_series, y_series, subj_cond):
+def scatter_plain(x_series, y_series, subj_cond, dpi = 150, compression = None):
     
     # This section ideally should be controlled by function parameter keys.
     # For now, these were pretty good values for the PPMI study: 
@@ -207,96 +447,149 @@ def scatter_plain(x_series, y_series, subj_cond):
 
     y_min = -2.5
     y_max = +2.5
-    
-    # Number of data points to be displayed
-    
-    scatter_size = len(x_series)
-    
-    # Color information - dictionary of rgb values for each color code (saturated)
-    # Here only defined for types 0, 1, 2 (HC, PD, SWEDD)
-    # (One could extend this for more values & colors, of course.)
 
-    rgb = {'HC':[0.0,0.0,1.0], 'PD':[0.0,1.0,0.0], 'SWEDD':[1.0,0.0,0.0]}
-       
-    # Set up figure parameters:
-    fig = plt.figure(num=None, figsize=(8, 8), dpi=150, facecolor='w', edgecolor='k')
+    # Marker colors:
 
-    plt.xlim(x_min, x_max)
-    plt.ylim(y_min, y_max)
+    markers = {'HC':'b', 'PD':'g', 'SWEDD':'r'}
+    
+    with template_lock:
 
-    plt.title(x_series.name + ' - ' + y_series.name)
+        # Figure is set up once, then only updated:
 
-    # Create pinpoints for individual measurements by condition:
-    # Healthy controls:
+        template = get_template('scatter_plain', scatter_template, x_min, x_max, y_min, y_max, 20, 175,
+                                markers)
+        ax = template['axes']
 
-    ax = plt.subplot()
-    
-    cond_filter = (subj_cond == 'HC')
-    
-    x_select = x_series[cond_filter]
-    y_select = y_series[cond_filter]
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        y_avg = y_select.mean()
-        
-        # Plot little blue markers for data points, big stars for cohort average
-
-        ax.scatter(x_select, y_select, s = 20, c = 'b', alpha = .33)
-        ax.scatter(x_avg, y_avg, s = 175 , c = 'b', marker = '*', label = 'HC')
-    
-    # Same now for Parkinson's cohort:
+        ax.set_title(x_series.name + ' - ' + y_series.name)
 
-    cond_filter = (subj_cond == 'PD')
-    
-    x_select = x_series[(cond_filter)]
-    y_select = y_series[(cond_filter)]
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        y_avg = y_select.mean()
-
-        # Plot little green markers for data points, big stars for cohort average
-       
-        ax.scatter(x_select.tolist(), y_select.tolist(), s = 20, c = 'g', alpha = .33)
-        ax.scatter(x_avg, y_avg, s = 175, c = 'g', marker = '*', label = 'PD')
-     
-    # And finally, the SWEDD cohort:
-
-    cond_filter = (subj_cond == 'SWEDD')
-    
-    x_select = x_series[(cond_filter)]
-    y_select = y_series[(cond_filter)]
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        y_avg = y_select.mean()
+        # Pinpoints for individual measurements by condition, stars for cohort averages:
 
-        # Plot little red markers for data points, big stars for cohort average
-        
-        ax.scatter(x_select, y_select, s = 20, c = 'r', alpha = .33)
-        ax.scatter(x_avg, y_avg, s = 175, c = 'r', marker = '*', label = 'SWEDD')    
+        handles = update_scatter(template, x_series, y_series, subj_cond)
 
-    ax.legend(loc = 'upper left', scatterpoints = 1)
-    fig.add_subplot(ax)
+        ax.legend(handles, [h.get_label() for h in handles], loc = 'upper left', scatterpoints = 1)
 
-    # Now, save the graph as a .PNG image.
-    # Don't write it to disk - instead, return it as a string:
-    
-    imgdata = StringIO.StringIO()
-    fig.savefig(imgdata, dpi = 150, format='png')
-    plt.close()
-    
-    # Get the contents of the image file as a string:
-    
-    imgdata.seek(0)
-    png_file = imgdata.buf
+        # Now, encode the graph as a .PNG image.
+        # Don't write it to disk - instead, return it as a string:
+
+        png_file = encode_figure(template, dpi, compression)
     
     return png_file
 
+# Smoothened cohort distributions for a 1D profile (the curves shown by profile_gauss).
+# Every data point contributes a normal CDF (or PDF) of given width, centered at its value;
+# the contributions are summed up per cohort and normalized by the cohort size.
+#
+# The sum is found in closed form for all subjects of a cohort at once:  the subjects x grid
+# matrix of standardized distances is evaluated in chunks of subjects, so that memory use
+# stays bounded.  For very large cohorts, the data points are instead distributed onto a
+# lattice aligned with the grid (linear weights to the two nearest lattice points), and the
+# lattice is folded with the CDF or PDF once;  the cost then depends on the grid size only.
+#
+# Input parameters:
+# Data points for a test in form of a pandas series object - x_series
+# Corresponding series object (subject condition/cohort) - subj_cond
+# A list of all subject cohorts present - cohorts
+# A pandas Series object containing the number of subjects in each cohort - data_counts
+# A switch between CDF and PDF (by default, CDF is used)
+# Grid limits and size - x_min, x_max, gridpoints
+# Width of the Gaussian distribution - Gauss_width
+# Method - 'exact' (chunked sum over subjects), 'binned' (lattice), or 'auto' (binned
+#          for cohorts larger than binned_limit)
+#
+# Returns:
+# numpy array of grid points - x
+# dictionary of numpy arrays with function values, keyed by cohort - df_dict
+#
+# No plotting involved, so this can be used by callers that need the numbers only.
+
+def profile_curves(x_series, subj_cond, cohorts, data_counts, cumulative = True,
+                   x_min = -2.5, x_max = 2.5, gridpoints = 250, Gauss_width = 0.2,
+                   method = 'auto', binned_limit = 20000, chunk_size = 4096):
+
+    if not (method in ['auto', 'exact', 'binned']):
+        print 'ERROR:  Unknown profile method', method
+        raise ValueError
+
+    x = np.linspace(x_min, x_max, gridpoints)
+
+    values = np.asarray(x_series[subj_cond.index], dtype = float)
+    conditions = np.asarray(subj_cond)
+
+    # Choosen cumulative distribution function (CDF) or probability density (PDF):
+
+    if (cumulative == True):
+        profile = lambda z: norm.cdf(z)
+    else:
+        profile = lambda z: norm.pdf(z) / Gauss_width
+
+    df_dict = {}
+
+    for c in cohorts:
+
+        members = values[conditions == c]
+
+        if (method == 'binned') or ((method == 'auto') and (len(members) > binned_limit)):
+            df_sum = binned_profile(members, x, Gauss_width, cumulative, profile)
+        else:
+
+            # Sum up contributions of subjects, one chunk at a time:
+
+            df_sum = np.zeros(gridpoints)
+
+            for start in range(0, len(members), chunk_size):
+                chunk = members[start:start + chunk_size]
+                df_sum += profile((x[np.newaxis, :] - chunk[:, np.newaxis]) / Gauss_width).sum(axis = 0)
+
+        # Normalize by cohort size:
+
+        df_dict[c] = df_sum / data_counts[c]
+
+    return x, df_dict
+
+# Lattice approximation for profile_curves (see there).
+#
+# Input parameters:
+# members - numpy array of data points
+# x - grid (equally spaced)
+# Gauss_width - width of the Gaussian distribution
+# cumulative - CDF or PDF
+# profile - function of the standardized distance
+#
+# Returns:
+# numpy array of summed function values on the grid
+
+def binned_profile(members, x, Gauss_width, cumulative, profile):
+
+    step = x[1] - x[0]
+
+    # The lattice extends six widths beyond the grid on either side;
+    # points further out contribute nothing (PDF), or a full unit to the CDF if on the left:
+
+    pad = int(np.ceil(6.0 * Gauss_width / step))
+    size = len(x) + 2 * pad
+
+    pos = (members - x[0]) / step + pad
+
+    inside = (pos >= 0) & (pos < size - 1)
+
+    base = np.floor(pos[inside]).astype(int)
+    frac = pos[inside] - base
+
+    weights = np.bincount(base, weights = 1.0 - frac, minlength = size)
+    weights += np.bincount(base + 1, weights = frac, minlength = size)
+
+    # Fold the lattice with the profile - the kernel matrix is grid x lattice:
+
+    lattice = x[0] + (np.arange(size) - pad) * step
+    kernel = profile((x[:, np.newaxis] - lattice[np.newaxis, :]) / Gauss_width)
+
+    df_sum = kernel.dot(weights)
+
+    if (cumulative == True):
+        df_sum += (pos < 0).sum()
+
+    return df_sum
+
 # A Gaussian display style for 1D profiles of PPMI data.
 
 # Show a smoothened cumulative distribution for each cohort present,
@@ -311,13 +604,15 @@ def scatter_plain(x_series, y_series, subj_cond):
 # A list of all subject cohorts present - cohorts
 # A pandas Series object containing the number of subjects in each cohort - data_counts
 # A switch between CDF and PDF (by default, CDF is shown)
+# Image resolution and PNG compression level (see encode_figure) - dpi, compression
 #
 # Returns:
 # String containing bitmap image in .PNG format - png_file
 #
 # Note: This depends on the normal distribution provided by scipy.stats.norm
 
-def profile_gauss(x_series, subj_cond, cohorts, data_counts, cumulative = True):
+def profile_gauss(x_series, subj_cond, cohorts, data_counts, cumulative = True,
+                  dpi = 150, compression = None):
     
     # This section ideally should be controlled by function parameter keys.
     # For now, these were pretty good values for the PPMI study: 
@@ -339,133 +634,256 @@ def profile_gauss(x_series, subj_cond, cohorts, data_counts, cumulative = True):
     image_resolution = 0.02
     gridpoints = int((x_max - x_min) / image_resolution)
     
-    # Create Numerical Grid for Cumulative Distributions
-
-    x = np.linspace(x_min, x_max, gridpoints)
-       
     # Color information - dictionary of rgb values for each color code (saturated)
     # Here only defined for types 0, 1, 2 (HC, PD, SWEDD)
     # (One could extend this for more values & colors, of course.)
 
     rgb = {'HC':[0.0,0.0,1.0], 'PD':[0.0,1.0,0.0], 'SWEDD':[1.0,0.0,0.0]}
     
-    # Create a discrete function value table for each cohort present in the test set
-    
-    df_dict = {}
-    
-    for c in cohorts:
-        df_dict[c] = np.zeros(gridpoints)
-        
-    # Sum up weighted normal cdf centered around each datapoint:
-        
-    for subj in subj_cond.index:
-                
-        # Choosen cumulative distribution function (CDF) or probability density (PDF):
-        
+    # Discrete function value tables for each cohort present in the test set
+    # (normalized sums of the CDF or PDF centered around each datapoint):
+
+    x, df_dict = profile_curves(x_series, subj_cond, cohorts, data_counts, cumulative,
+                                x_min, x_max, gridpoints, Gauss_width)
+           
+    with template_lock:
+
+        # Figure is set up once, then only updated:
+
+        template = get_template('profile_gauss', profile_template, x_min, x_max, x, rgb)
+        ax = template['axes']
+
+        ax.set_title(x_series.name)
+
+        # Function value limits depend on method chosen:
+
         if (cumulative == True):
-            normal_df = norm.cdf(x, loc = x_series[subj], scale = Gauss_width)
+            y_max = 1.0
         else:
-            normal_df = norm.pdf(x, loc = x_series[subj], scale = Gauss_width)
-        
-        # Add it to proper cohort function (and normalize it):
-        
-        df_dict[subj_cond[subj]] += normal_df / data_counts[subj_cond[subj]]
-           
-    # Subplot for resulting cdf's for cohorts present:
-    
-    fig = plt.figure(num=None, figsize=(8, 8), dpi=150, facecolor='w', edgecolor='k')
-    
-    ax = plt.subplot2grid((4,1), (0,0), rowspan=3)
-    plt.title(x_series.name)
-    
-    # Function value limits depend on method chosen:
+            # Find maximum function value in set of cohorts
+
+            y_max = 0
+            for c in cohorts:
+                y_max = max(y_max, df_dict[c].max())
+
+        ax.axis([x_min, x_max, 0, 1.01 * y_max])
+
+        # Curves for cohorts present, and pinpoints for individual measurements by condition
+        # (at heights .75, .5, .25 for HC, PD, SWEDD):
+
+        handles = []
+
+        for cohort, height in zip(template_cohorts, [.75, .5, .25]):
+
+            curve, points, star = template[cohort]
+
+            x_select = x_series[(subj_cond == cohort)]
+
+            if (cohort in cohorts):
+                curve.set_ydata(df_dict[cohort])
+                handles.append(curve)
+
+            if (len(x_select) > 0):
+
+                # Little markers for data points, big stars for cohort average
+
+                points.set_offsets(np.column_stack((x_select.values, height * np.ones(len(x_select)))))
+                star.set_offsets([[x_select.mean(), height]])
+
+            curve.set_visible(cohort in cohorts)
+            points.set_visible(len(x_select) > 0)
+            star.set_visible(len(x_select) > 0)
+
+        ax.legend(handles, [h.get_label() for h in handles], loc = 'upper left', scatterpoints = 1)
+
+        # Now, encode the graph as a .PNG image.
+        # Don't write it to disk - instead, return it as a string:
+
+        png_file = encode_figure(template, dpi, compression)
+
+    return png_file
+
+# ******** Plot payloads
+
+# Instead of rendering a plot on the server, the frontend may ask for the contents of the plot
+# only, and draw it itself.  The payloads hold exactly what the plot shows, in compact form:
+# coordinates are quantized to integers on the displayed canvas (points outside are dropped),
+# and points are sorted by cohort and position, so that no subject IDs or subject order remain.
+# Integer arrays are packed as base64 strings of little-endian binary data.
+
+# Pack integer array as base64 string
+#
+# Input parameters:
+# numpy array - values
+# numpy type of the binary data (e.g. '<u2' for 16-bit unsigned integers) - dtype
+#
+# Returns:
+# base64 string
+
+def pack_array(values, dtype):
+
+    return base64.b64encode(np.ascontiguousarray(values, dtype = dtype).tostring())
+
+# Quantize coordinates on the canvas:  v_min ... v_max is mapped onto 0 ... levels - 1
+#
+# Input parameters:
+# numpy array - values
+# canvas limits - v_min, v_max
+# number of quantization levels (at most 65536) - levels
+#
+# Returns:
+# numpy array of integers
+
+def quantize(values, v_min, v_max, levels):
+
+    scaled = np.round((values - v_min) / (v_max - v_min) * (levels - 1))
+
+    return np.clip(scaled, 0, levels - 1).astype(int)
+
+# Scatterplot payload (contents of scatter_plain):
+#
+# Input parameters:
+# Pairs of values of data points in form of pandas series objects - x_series, y_series
+# Corresponding series object (subject condition/cohort) - subj_cond
+# Number of quantization levels for coordinates - levels
+#
+# Returns:
+# dictionary with plot title, canvas, cohorts, quantized coordinates and cohort codes of the data
+# points ('x', 'y', 'Codes' - index into 'Cohorts'), and cohort averages
+
+def scatter_payload(x_series, y_series, subj_cond, levels = 4096):
+
+    # Displayed Canvas (same as scatter_plain):
+
+    x_min = -2.5
+    x_max = +2.5
+
+    y_min = -2.5
+    y_max = +2.5
+
+    x_values = x_series[subj_cond.index].values
+    y_values = y_series[subj_cond.index].values
+
+    codes = subj_cond.map(dict((c, n) for n, c in enumerate(template_cohorts))).values
+
+    # Cohort averages (stars) are taken over all points, as in the plot:
+
+    averages = {}
+
+    for n, cohort in enumerate(template_cohorts):
+        if (codes == n).any():
+            averages[cohort] = [float(x_values[codes == n].mean()), float(y_values[codes == n].mean())]
+
+    # Keep points on the canvas, quantize and sort them:
+
+    inside = (x_values >= x_min) & (x_values <= x_max) & (y_values >= y_min) & (y_values <= y_max)
+
+    x_quant = quantize(x_values[inside], x_min, x_max, levels)
+    y_quant = quantize(y_values[inside], y_min, y_max, levels)
+    codes = codes[inside]
+
+    order = np.lexsort((y_quant, x_quant, codes))
+
+    return {'Title' : x_series.name + ' - ' + y_series.name,
+            'Extent' : [x_min, x_max, y_min, y_max],
+            'Levels' : levels,
+            'Cohorts' : template_cohorts,
+            'x' : pack_array(x_quant[order], '<u2'),
+            'y' : pack_array(y_quant[order], '<u2'),
+            'Codes' : pack_array(codes[order], 'u1'),
+            'Averages' : averages}
+
+# Gaussian scatterplot payload (contents of scatter_gauss):
+# Same as scatter_payload, plus the background image, computed directly on a coarser grid
+# (by default, half the resolution of the rendered image), as 8-bit RGB values.
+#
+# Input parameters:
+# Pairs of values of data points in form of pandas series objects - x_series, y_series
+# Corresponding series object (subject condition/cohort) - subj_cond
+# Number of quantization levels for coordinates - levels
+# Grid spacing of the background image - resolution
+#
+# Returns:
+# dictionary (see scatter_payload) with additional key 'Background' - width, height, and
+# RGB values (row by row, starting at y_min)
+
+def gauss_payload(x_series, y_series, subj_cond, levels = 4096, resolution = 0.05):
+
+    # Same parameters as scatter_gauss:
+
+    Gauss_width = 0.2
+    Gauss_depth = 0.1
+
+    rgb = {'HC':[0.0,0.0,1.0], 'PD':[0.0,1.0,0.0], 'SWEDD':[1.0,0.0,0.0]}
+
+    payload = scatter_payload(x_series, y_series, subj_cond, levels)
+
+    x_min, x_max, y_min, y_max = payload['Extent']
+
+    x_count = len(np.arange(x_min, x_max, resolution))
+    y_count = len(np.arange(y_min, y_max, resolution))
+
+    ImageRGB = gauss_background(x_series[subj_cond.index].values, y_series[subj_cond.index].values, subj_cond.values,
+                                x_min, y_min, x_count, y_count, resolution, Gauss_width, Gauss_depth, rgb)
+
+    payload['Background'] = {'Width' : x_count, 'Height' : y_count,
+                             'RGB' : pack_array(np.round(255.0 * ImageRGB), 'u1')}
+
+    return payload
+
+# Profile payload (contents of profile_gauss):
+#
+# Input parameters:
+# same as profile_gauss
+# Number of quantization levels for curves and coordinates - levels
+#
+# Returns:
+# dictionary with plot title, canvas, cohorts, curves (quantized between 0 and 'Top'), and for
+# each cohort the quantized positions of the data points and their average
+
+def profile_payload(x_series, subj_cond, cohorts, data_counts, cumulative = True, levels = 4096):
+
+    # Same parameters as profile_gauss:
+
+    Gauss_width = 0.2
+
+    x_min = -2.5
+    x_max = +2.5
+
+    gridpoints = int((x_max - x_min) / 0.02)
+
+    x, df_dict = profile_curves(x_series, subj_cond, cohorts, data_counts, cumulative,
+                                x_min, x_max, gridpoints, Gauss_width)
+
+    # Upper limit of function values:
 
     if (cumulative == True):
         y_max = 1.0
     else:
-        # Find maximum function value in set of cohorts
+        y_max = max([df_dict[c].max() for c in cohorts] + [0])
 
-        y_max = 0
-        for c in cohorts:
-            y_max = max(y_max, df_dict[c].max())
+    y_top = 1.01 * y_max
 
-    plt.axis([x_min, x_max, 0, 1.01 * y_max])
-    
-    for member in cohorts:
-        ax.plot(x, df_dict[member], lw = 2, c = rgb[member], label = member)
-        
-    ax.legend(loc = 'upper left', scatterpoints = 1)
-    fig.add_subplot(ax)
-    
-    # Create subplot with pinpoints for individual measurements by condition:
-    
-    ax = plt.subplot2grid((4,1), (3,0))
-    ax.set_xticks([])
-    ax.set_yticks([])
-        
-    plt.xlim(x_min, x_max)
-    plt.ylim(0, 1)
-    
-    # Healthy controls:
+    payload = {'Title' : x_series.name,
+               'Extent' : [x_min, x_max, 0, y_top],
+               'Levels' : levels,
+               'Gridpoints' : gridpoints,
+               'Top' : y_top,
+               'Cohorts' : [c for c in template_cohorts if c in cohorts],
+               'Curves' : {},
+               'Points' : {},
+               'Averages' : {}}
 
-    cond_filter = (subj_cond == 'HC')
-    
-    x_select = x_series[cond_filter]
-    y_select = .75 * np.ones(data_counts['HC'])
-     
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-           
-        # Plot little blue markers for data points, big stars for cohort average
-        
-        ax.scatter(x_select, y_select, s = 25, c = rgb['HC'], alpha = .25)
-        ax.scatter(x_avg, .75, s = 150, c = rgb['HC'], marker = '*')
-            
-    # Same now for Parkinson's cohort:
-
-    cond_filter = (subj_cond == 'PD')
-    
-    x_select = x_series[(cond_filter)]
-    y_select = .5 * np.ones(data_counts['PD'])
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        
-        # Plot little green markers for data points, big stars for cohort average
-       
-        ax.scatter(x_select, y_select, s = 25, c = rgb['PD'], alpha = .25)
-        ax.scatter(x_avg, .5, s = 150 , c = rgb['PD'], marker = '*')
-     
-    # And finally, the SWEDD cohort:
-
-    cond_filter = (subj_cond == 'SWEDD')
-    
-    x_select = x_series[(cond_filter)]
-    y_select = .25 * np.ones(data_counts['SWEDD'])
-    
-    if (len(x_select) > 0):
-        
-        x_avg = x_select.mean()
-        
-        # Plot little red markers for data points, big stars for cohort average
-        
-        ax.scatter(x_select, y_select, s = 25, c = rgb['SWEDD'], alpha = .25)
-        ax.scatter(x_avg, 0.25, s = 150 , c = rgb['SWEDD'], marker = '*')
-        
-        fig.add_subplot(ax)
-
-    # Now, save the graph as a .PNG image.
-    # Don't write it to disk - instead, return it as a string:
-    
-    imgdata = StringIO.StringIO()
-    fig.savefig(imgdata, dpi = 150, format='png')
-    plt.close()
-    
-    # Get the contents of the image file as a string:
-    
-    imgdata.seek(0)
-    png_file = imgdata.buf
-    
-    return png_file
\ No newline at end of file
+    for cohort in payload['Cohorts']:
+
+        payload['Curves'][cohort] = pack_array(quantize(df_dict[cohort], 0, y_top, levels), '<u2')
+
+        x_values = x_series[(subj_cond == cohort)].values
+
+        if (len(x_values) > 0):
+            inside = (x_values >= x_min) & (x_values <= x_max)
+
+            payload['Points'][cohort] = pack_array(np.sort(quantize(x_values[inside], x_min, x_max, levels)), '<u2')
+            payload['Averages'][cohort] = float(x_values.mean())
+
+    return payload
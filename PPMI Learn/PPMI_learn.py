@@ -10,17 +10,26 @@
 # - Calculate/display capture ratio for CM plot
 # - Add t-SNE nonlinear embedding algorithm
 
-from sklearn.cross_validation import train_test_split
+from sklearn.cross_validation import train_test_split, StratifiedKFold
 from sklearn.linear_model import LogisticRegression
 from sklearn.neighbors import KNeighborsClassifier
 from sklearn.ensemble import RandomForestClassifier
 from sklearn.metrics import confusion_matrix, roc_curve, auc
-from sklearn.decomposition import PCA
+from sklearn.decomposition import PCA, IncrementalPCA
 from sklearn.manifold import TSNE
 
 import numpy as np
 import pandas as pd
 import StringIO
+import json as js
+import pickle
+import collections
+import threading
+import hashlib
+import zlib
+import os
+import multiprocessing
+from multiprocessing.pool import ThreadPool
 import matplotlib.pyplot as plt
 
 # PPMI analysis intake module:
@@ -29,10 +38,9 @@ import PPMI_Stats_Core as ppmi
 # PPMI graphics engine
 import PPMI_Gaussplots as scg
 
-# Center-of-mass view:
+# Center-of-mass projection:
 #
-# Plot a projection of multi-dimensional data onto the plane of maximum separation
-# of cohort averages
+# Project multi-dimensional data onto the plane of maximum separation of cohort averages
 #
 # Idea:  Use normalized data from features to find average feature vectors for each cohort
 #        Since there are three cohorts, these vectors span a plane in feature space
@@ -43,28 +51,25 @@ import PPMI_Gaussplots as scg
 # Note:  This essentially reproduces the 'Canonical Discriminate Analysis' (CDA)
 #        algorithm in unsupervised learning.
 #
-# The graphical rendering is executed by the scatter_gauss and scatter_plain methods.
-# The title gives information about the 'capture ratio' - the amount of variance of
-# the data contained in the projection.
+# The names of the coordinate series serve as plot title;  they give information about the
+# 'capture ratio' - the amount of variance of the data contained in the projection.
 #
 # Parameters:
 # norm_table - pandas DataFrame containing a normalized data set
 # data_avg - pandas DataFrame containing summary statistics of the same set
-# subj_cond - pandas Series: cohort vs. subject ID
 # cohorts - list of subject cohorts present in data
-# image_type - rendering mechanism.  Should be either 'Gauss' or 'Scatter'
 #
 # Returns: 
-# png_data - string containing the rendered image in PNG format
+# CM_coord_1, CM_coord_2 - pandas Series of projected coordinates (None if not available)
 # 
 
-def center_mass_view(norm_table, data_avg, subj_cond, cohorts, image_type):
+def center_mass_projection(norm_table, data_avg, cohorts):
 
     # Check that indeed all three cohorts are present
 
     if (len(cohorts) < 3):
         print 'WARNING:  Center of mass view requires all three cohorts.'
-        return None
+        return None, None
 
     # Create cohort average vectors in normalized coordinates
 
@@ -106,14 +111,132 @@ def center_mass_view(norm_table, data_avg, subj_cond, cohorts, image_type):
     CM_coord_1 = pd.Series(proj_1, name = 'Center of Mass (CDA) View')
     CM_coord_2 = pd.Series(proj_2, name = Capture_Ratio)
 
+    return CM_coord_1, CM_coord_2
+
+# Center-of-mass view:
+#
+# Plot the center-of-mass projection (see above).
+# The graphical rendering is executed by the scatter_gauss and scatter_plain methods.
+#
+# Parameters:
+# norm_table - pandas DataFrame containing a normalized data set
+# data_avg - pandas DataFrame containing summary statistics of the same set
+# subj_cond - pandas Series: cohort vs. subject ID
+# cohorts - list of subject cohorts present in data
+# image_type - rendering mechanism.  Should be either 'Gauss' or 'Scatter'
+# dpi, compression - image resolution and PNG compression level (see PPMI_Gaussplots)
+#
+# Returns: 
+# png_data - string containing the rendered image in PNG format
+# 
+
+def center_mass_view(norm_table, data_avg, subj_cond, cohorts, image_type, dpi = 150, compression = None):
+
+    CM_coord_1, CM_coord_2 = center_mass_projection(norm_table, data_avg, cohorts)
+
+    if (CM_coord_1 is None):
+        return None
+
     # Send out to graphics rendering engine:
 
     if (image_type == 'Gauss'):
-        return scg.scatter_gauss(CM_coord_1, CM_coord_2, subj_cond)
+        return scg.scatter_gauss(CM_coord_1, CM_coord_2, subj_cond, dpi, compression)
     elif (image_type == 'Scatter'):
-        return scg.scatter_plain(CM_coord_1, CM_coord_2, subj_cond)
+        return scg.scatter_plain(CM_coord_1, CM_coord_2, subj_cond, dpi, compression)
 
-# PCA view (projection on principal components of leading importance)
+# Principal component decomposition of a normalized data set
+#
+# Idea:  The PCA view and the PCA pre-reduction of the t-SNE embedding both need the leading
+#        principal components of the same data.  They are found once, by a truncated randomized
+#        SVD (Halko et al.) for the first 12 components, and kept in the projection cache (see
+#        use_projection_cache) under a hash of the data - so all views of a selection share a
+#        single fit.
+#        For very large selections, the components are found by incremental PCA instead, which
+#        works through the subjects in batches and never forms a centered copy of the data.
+#
+# Parameters:
+# norm_table - pandas DataFrame containing a normalized data set
+# components - number of principal components (default 12, at most the number of features)
+# method - 'randomized', 'incremental', or 'auto' (default):  incremental PCA for selections of
+#          more than incremental_limit values
+# batch_size - number of subjects per batch (incremental PCA, and projection of the data)
+# incremental_limit - size of the data (subjects x features) above which 'auto' turns incremental
+#
+# Returns:
+# scores - numpy array of coordinates along the principal axes (subjects x components)
+# ratio - numpy array, fraction of the variance explained by each component
+#
+
+def pca_decomposition(norm_table, components = 12, method = 'auto', batch_size = 4096, incremental_limit = 10000000):
+
+    norm_data = norm_table.as_matrix()
+    n_samples, n_features = norm_data.shape
+
+    components = min(components, n_samples, n_features)
+    batch_size = max(batch_size, components)
+
+    if (method == 'auto'):
+        if (norm_data.size > incremental_limit):
+            method = 'incremental'
+        else:
+            method = 'randomized'
+
+    # Look up the cache:
+
+    digest = hashlib.sha1(np.ascontiguousarray(norm_data, dtype = float).tobytes())
+    digest.update(js.dumps([n_samples, n_features, components, method]))
+
+    key = 'pca-' + digest.hexdigest()
+
+    cache = projection_cache
+
+    if (cache is not None):
+        decomposition = cache.get(key)
+
+        if (decomposition is not None):
+            return decomposition
+
+    # Batches of subjects (the last one merged with its predecessor if it is too short for
+    # an incremental step):
+
+    starts = range(0, n_samples, batch_size)
+
+    if (len(starts) > 1) and (n_samples - starts[-1] < components):
+        starts = starts[:-1]
+
+    ends = starts[1:] + [n_samples]
+
+    # Find principal axes:
+
+    if (method == 'incremental'):
+        pca = IncrementalPCA(n_components = components)
+
+        for start, end in zip(starts, ends):
+            pca.partial_fit(norm_data[start:end])
+
+    elif (method == 'randomized'):
+        pca = PCA(n_components = components, svd_solver = 'randomized', random_state = 0)
+        pca.fit(norm_data)
+
+    else:
+        print 'ERROR:  Unknown PCA method', method
+        return None
+
+    # Project on principal components, batch by batch:
+
+    scores = np.empty((n_samples, components))
+
+    for start, end in zip(starts, ends):
+        scores[start:end] = np.dot(norm_data[start:end] - pca.mean_, pca.components_.T)
+
+    decomposition = (scores, pca.explained_variance_ratio_)
+
+    if (cache is not None):
+        cache.put(key, decomposition)
+
+    return decomposition
+
+# PCA projection (on principal components of leading importance)
 #
 # Idea:  Use normalized data from features to find the two directions that explain
 #        most of the variance of the data, and use the plane they span for
@@ -121,96 +244,104 @@ def center_mass_view(norm_table, data_avg, subj_cond, cohorts, image_type):
 #        the data in the sense that the sum of the squared distances of all data points
 #        to the plane of projection is minimized.
 #
-# The graphical rendering is executed by the scatter_gauss and scatter_plain methods.
-# The title gives information about the 'capture ratio' - the amount of variance of
-# the data contained in the projection.
+# The names of the coordinate series serve as plot title;  they give information about the
+# 'capture ratio' - the amount of variance of the data contained in the projection.
 #
 # Parameters:
 # norm_table - pandas DataFrame containing a normalized data set
-# subj_cond - pandas Series: cohort vs. subject ID
-# cohorts - list of subject cohorts present in data
-# image_type - rendering mechanism.  Should be either 'Gauss' or 'Scatter'
+# method - decomposition method (optional, see pca_decomposition)
 #
 # Returns: 
-# png_data - string containing the rendered image in PNG format
+# pandas Series of projected coordinates (two)
 # 
 
-def pca_view(norm_table, subj_cond, cohorts, image_type):
+def pca_projection(norm_table, method = 'auto'):
 
     # SVG-PCA analysis: Plot projections onto plane spanned by the two most 
     # significant principal axes (PCA components)
 
-    # Keep only two principal components
-    pca = PCA(n_components=2)
+    # Use the shared decomposition of the normalized data:
+    scores, ratio = pca_decomposition(norm_table, method = method)
 
-    # Use normalized data:    
-    norm_data = norm_table.as_matrix()
-
-    # Find principal axes:
-    pca.fit(norm_data)
-
-    # Project on principal components:
-    pca_data = pca.transform(norm_data)
+    # Keep only two principal components
+    pca_data = scores[:, :2]
 
     # 'Captured' variance in percent:
-    pca_var  = 100.0 * pca.explained_variance_ratio_.sum()
+    pca_var  = 100.0 * ratio[:2].sum()
     pca_note = '(Capture ratio: %.1f%%)' % pca_var
 
     # Prepare for view:
     cols = ['PCA View', pca_note]
     pca_table = pd.DataFrame(pca_data, index = norm_table.index, columns = cols)
+
+    return pca_table[cols[0]], pca_table[cols[1]]
+
+# PCA view:
+#
+# Plot the PCA projection (see above).
+# The graphical rendering is executed by the scatter_gauss and scatter_plain methods.
+#
+# Parameters:
+# norm_table - pandas DataFrame containing a normalized data set
+# subj_cond - pandas Series: cohort vs. subject ID
+# cohorts - list of subject cohorts present in data
+# image_type - rendering mechanism.  Should be either 'Gauss' or 'Scatter'
+# dpi, compression - image resolution and PNG compression level (see PPMI_Gaussplots)
+#
+# Returns: 
+# png_data - string containing the rendered image in PNG format
+# 
+
+def pca_view(norm_table, subj_cond, cohorts, image_type, dpi = 150, compression = None):
+
+    x_series, y_series = pca_projection(norm_table)
     
     # Send out to graphics rendering engine:
 
     if (image_type == 'Gauss'):
-        return scg.scatter_gauss(pca_table[cols[0]], pca_table[cols[1]], subj_cond)
+        return scg.scatter_gauss(x_series, y_series, subj_cond, dpi, compression)
     elif (image_type == 'Scatter'):
-        return scg.scatter_plain(pca_table[cols[0]], pca_table[cols[1]], subj_cond)
+        return scg.scatter_plain(x_series, y_series, subj_cond, dpi, compression)
 
 
-# t-SNE view (stochastic neighbor embedding)
+# t-SNE embedding (stochastic neighbor embedding)
 #
 # Idea:  This is a modern method of representing clustering in feature space in a two-
 #        dimensional 'embedding space' that can be visualized by a scatterplot.
 #        The method is non-linear and the functional used in optimisation is not convex, 
 #        so the t-SNE algorithm can converge to different minima in embedded space.  
-#        It is initialized from a random seed and therefore generally produces different 
-#        results with each run.
+#        Here, it is started from a seeded initialization, so that the same data always
+#        yields the same embedding;  embeddings are kept in a cache (see t_sne_embedding),
+#        and repeated requests are answered from there.
 #        If the feature set has more than 12 dimensions, feature reduction using PCA
-#        is performed first.
+#        is performed first (see pca_decomposition).
 #        Like any embedding method, t-SNE works best with well separated clusters of data.
 #
-# The graphical rendering is executed by the scatter_gauss and scatter_plain methods.
-#
 # Parameters:
 # norm_table - pandas DataFrame containing a normalized data set
 # subj_cond - pandas Series: cohort vs. subject ID
 # cohorts - list of subject cohorts present in data
-# image_type - rendering mechanism.  Should be either 'Gauss' or 'Scatter'
+# preview - return the early-stage embedding only (optional, see t_sne_embedding)
+# method, iterations, seed - settings of the embedding (optional, see t_sne_embedding)
 #
 # Returns: 
-# png_data - string containing the rendered image in PNG format
+# pandas Series of embedded coordinates (two), shifted and normalized
 # 
 
-def t_sne_view(norm_table, subj_cond, cohorts, image_type):
+def t_sne_projection(norm_table, subj_cond, cohorts, preview = False, method = 'barnes_hut', iterations = 1000, seed = 0):
 
     # t-SNE analysis: Use stochastic neighbor embedding to reduce dimensionality of
     # data set to two dimensions in a non-linear, distance dependent fashion
 
-    # Perform PCA data reduction if dimensionality of feature space is large:
+    # Perform PCA data reduction if dimensionality of feature space is large
+    # (shared with the PCA view):
     if len(norm_table.columns) > 12:
-        pca = PCA(n_components = 12)
-        pca.fit(norm_table.as_matrix())
-        
-        raw_data = pca.transform(norm_table.as_matrix())
+        raw_data, ratio = pca_decomposition(norm_table, 12)
     else:
         raw_data = norm_table.as_matrix()
  
     # Transform data into a two-dimensional embedded space:
-    tsne = TSNE(n_components = 2, perplexity = 40.0, early_exaggeration= 2.0, 
-        learning_rate = 100.0, init = 'pca')
-
-    tsne_data = tsne.fit_transform(raw_data)
+    tsne_data = t_sne_embedding(raw_data, preview, method, iterations, seed)
 
     # Prepare for normalization and view:
     cols = ['t-SNE', 'Cluster Visualization']
@@ -219,32 +350,322 @@ def t_sne_view(norm_table, subj_cond, cohorts, image_type):
     # The output is no longer centered or normalized, so shift & scale it before display:
     tsne_avg = ppmi.data_stats(tsne_table, subj_cond, cohorts)
     tsne_norm_table = ppmi.normalize_table(tsne_table, tsne_avg)       
+
+    return tsne_norm_table[cols[0]], tsne_norm_table[cols[1]]
+
+# Length of the exploration stage of t-SNE:  scikit-learn runs the first 250 iterations of every
+# embedding with early exaggeration (the value of its private TSNE._EXPLORATION_N_ITER, also the
+# smallest iteration count it accepts).  Stage 1 of t_sne_embedding runs exactly this stage.
+
+TSNE_EXPLORATION = 250
+
+# Two-dimensional t-SNE embedding of a data array, in two stages:
+#
+# Stage 1 (preview) runs the 250 iterations of the 'early exaggeration' phase, in which the
+# clusters form;  stage 2 continues from the preview, without exaggeration, for the rest of the
+# iteration budget, and refines the arrangement within and between clusters.  The full embedding
+# is always computed this way, so a preview shown first is refined later, rather than replaced by
+# an unrelated picture.
+#
+# Both stages start from seeded random numbers and give the same result for the same data.  They
+# are kept in the projection cache (see use_projection_cache) under a hash of the data and the
+# settings:  repeated requests are answered from the cache, and a full embedding requested after
+# its preview only runs stage 2.
+#
+# Parameters:
+# raw_data - numpy array (subjects x features)
+# preview - return the stage 1 embedding only (default:  full embedding)
+# method - 'barnes_hut' (approximate, O(N log N) - default) or 'exact' (O(N^2))
+# iterations - iteration budget of the full embedding (at least 500)
+# seed - random seed
+#
+# Returns:
+# numpy array of embedded coordinates (subjects x 2)
+
+def t_sne_embedding(raw_data, preview = False, method = 'barnes_hut', iterations = 1000, seed = 0):
+
+    raw_data = np.ascontiguousarray(raw_data, dtype = float)
+    exploration = TSNE_EXPLORATION
+
+    # Cache keys for both stages:
+
+    digest = hashlib.sha1(raw_data.tobytes())
+    digest.update(js.dumps(list(raw_data.shape) + [method, seed]))
+
+    preview_key = 'tsne-' + digest.hexdigest()
+
+    digest.update(js.dumps(iterations))
+    full_key = 'tsne-' + digest.hexdigest()
+
+    cache = projection_cache
+    embedding = None
+
+    if (cache is not None):
+        if not preview:
+            embedding = cache.get(full_key)
+
+            if (embedding is not None):
+                return embedding
+
+        embedding = cache.get(preview_key)
+
+        if preview and (embedding is not None):
+            return embedding
+
+    # Stage 1:  exploration with early exaggeration
+
+    if (embedding is None):
+        tsne = TSNE(n_components = 2, perplexity = 40.0, early_exaggeration = 2.0,
+            learning_rate = 100.0, n_iter = exploration, init = 'pca', method = method,
+            random_state = seed)
+
+        embedding = tsne.fit_transform(raw_data)
+
+        if (cache is not None):
+            cache.put(preview_key, embedding)
+
+    if preview:
+        return embedding
+
+    # Stage 2:  continue from the preview, without exaggeration
+
+    tsne = TSNE(n_components = 2, perplexity = 40.0, early_exaggeration = 1.0,
+        learning_rate = 100.0, n_iter = max(iterations - exploration, exploration),
+        init = embedding, method = method, random_state = seed)
+
+    embedding = tsne.fit_transform(raw_data)
+
+    if (cache is not None):
+        cache.put(full_key, embedding)
+
+    return embedding
+
+# t-SNE view:
+#
+# Plot the t-SNE embedding (see above).
+# The graphical rendering is executed by the scatter_gauss and scatter_plain methods.
+#
+# Parameters:
+# norm_table - pandas DataFrame containing a normalized data set
+# subj_cond - pandas Series: cohort vs. subject ID
+# cohorts - list of subject cohorts present in data
+# image_type - rendering mechanism.  Should be either 'Gauss' or 'Scatter'
+# dpi, compression - image resolution and PNG compression level (see PPMI_Gaussplots)
+# preview - show the early-stage embedding (optional, see t_sne_embedding)
+#
+# Returns: 
+# png_data - string containing the rendered image in PNG format
+# 
+
+def t_sne_view(norm_table, subj_cond, cohorts, image_type, dpi = 150, compression = None, preview = False):
+
+    x_series, y_series = t_sne_projection(norm_table, subj_cond, cohorts, preview)
     
     # Send out to graphics rendering engine:
 
     if (image_type == 'Gauss'):
-        return scg.scatter_gauss(tsne_norm_table[cols[0]], tsne_norm_table[cols[1]], subj_cond)
+        return scg.scatter_gauss(x_series, y_series, subj_cond, dpi, compression)
     elif (image_type == 'Scatter'):
-        return scg.scatter_plain(tsne_norm_table[cols[0]], tsne_norm_table[cols[1]], subj_cond)
+        return scg.scatter_plain(x_series, y_series, subj_cond, dpi, compression)
 
 
-# Receiver-Operating Characteristic
-# Find the ROC curve for a given selection of data,
-# for possible combination of cohorts present
+# Model registry:
+#
+# Fitted classifiers are stored under a key that is a hash (SHA-1) of everything that goes into
+# the fit - the training data (features and labels), the cohort pair, the classifier, and its
+# settings (see model_key).  Requests that train the same classifier on the same data (repeated
+# cross-validated ROC curves, scoring of subjects) take the model from the registry instead of
+# training it again.
+#
+# The registry keeps the most recently used models in memory, up to a number of models.
+# Optionally, models are also written to a directory on disk (as zlib-compressed pickles), which
+# survives the session;  when the files on disk exceed a total size, the least recently used
+# ones are deleted.
+#
+# Parameters:
+# max_models - number of models held in memory (default: 32)
+# directory - path for on-disk storage (optional, default: memory only)
+# max_disk_bytes - size limit for the on-disk storage (default: 256 MB)
+
+class ModelRegistry(object):
+
+    def __init__(self, max_models = 32, directory = None, max_disk_bytes = 256 * 1024 * 1024):
+
+        self.max_models = max_models
+        self.directory = directory
+        self.max_disk_bytes = max_disk_bytes
+
+        self.entries = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        if (directory is not None) and not os.path.isdir(directory):
+            os.makedirs(directory)
+
+    # Look up a model
+    #
+    # Parameter:  key - registry key (see model_key)
+    # Returns:  fitted classifier, or None if not found
+
+    def get(self, key):
+
+        with self.lock:
+            if (key in self.entries):
+
+                # Mark as most recently used:
+
+                model = self.entries.pop(key)
+                self.entries[key] = model
+
+                return model
+
+        if (self.directory is None):
+            return None
+
+        filename = os.path.join(self.directory, key + '.model')
+
+        try:
+            with open(filename, 'rb') as modelfile:
+                model = pickle.loads(zlib.decompress(modelfile.read()))
+
+            # Mark as recently used on disk, too:
+
+            os.utime(filename, None)
+
+        except (IOError, OSError, zlib.error, pickle.UnpicklingError, EOFError):
+            return None
+
+        self.put(key, model, write = False)
+
+        return model
+
+    # Store a model
+    #
+    # Parameters:
+    # key - registry key (see model_key)
+    # model - fitted classifier
+    # write - also store on disk, if a directory was given
+
+    def put(self, key, model, write = True):
+
+        with self.lock:
+            self.entries.pop(key, None)
+            self.entries[key] = model
+
+            # Evict least recently used models:
+
+            while (len(self.entries) > self.max_models):
+                self.entries.popitem(last = False)
+
+        # Concurrent writers of the same model do not interfere (see store_file);  if the file
+        # cannot be written, the model is just not shared:
+
+        if write and (self.directory is not None):
+            filename = os.path.join(self.directory, key + '.model')
+
+            if ppmi.store_file(filename, zlib.compress(pickle.dumps(model, 2))):
+                self.evict()
+
+    # Delete least recently used model files until the directory is within its size limit
+
+    def evict(self):
+
+        ppmi.evict_files(self.directory, ('.model',), self.max_disk_bytes)
+
+# The registry used by the ROC methods and score_subjects (None - always train anew).
+# Each process has its own;  processes can share models through the same directory.
+
+model_registry = None
+
+# Set the model registry for this process
+#
+# Parameter:  registry - ModelRegistry object (or None to switch off)
+
+def use_model_registry(registry):
+
+    global model_registry
+    model_registry = registry
+
+# The cache for projections - PCA decompositions and t-SNE embeddings (see pca_decomposition,
+# t_sne_embedding) - a registry like the one for models, in memory by default.  Processes can
+# share projections through a directory, too.
+
+projection_cache = ModelRegistry(max_models = 16)
+
+# Set the projection cache for this process
+#
+# Parameter:  cache - ModelRegistry object (or None to switch off)
+
+def use_projection_cache(cache):
+
+    global projection_cache
+    projection_cache = cache
+
+# Find the registry key for a classifier fit.
+#
+# Parameters:
+# classifier, trees, depth, seed - see roc_classifier
+# pair - cohort pair (list of two)
+# features, labels - training data
+#
+# Returns:  hexadecimal hash string
+
+def model_key(classifier, trees, depth, seed, pair, features, labels):
+
+    digest = hashlib.sha1()
+
+    digest.update(js.dumps([classifier, trees, depth, seed, list(pair)]))
+    digest.update(np.ascontiguousarray(features, dtype = float).tobytes())
+    digest.update(np.ascontiguousarray(labels, dtype = int).tobytes())
+
+    return digest.hexdigest()
+
+# Fit a classifier to training data, or take the fitted classifier from the model registry
+#
+# Parameters:
+# classifier, trees, depth, seed - see roc_classifier
+# pair - cohort pair (list of two)
+# features, labels - training data
+# jobs - number of processor cores for the random forest (see roc_classifier;  not part of the key)
+#
+# Returns:  fitted classifier (None for unknown classifier)
+
+def fit_classifier(classifier, trees, depth, seed, pair, features, labels, jobs = -1):
+
+    registry = model_registry
+    key = None
+
+    if (registry is not None):
+        key = model_key(classifier, trees, depth, seed, pair, features, labels)
+        clf = registry.get(key)
+
+        if (clf is not None):
+            return clf
+
+    clf = roc_classifier(classifier, trees, depth, seed, jobs)
+
+    if (clf is None):
+        return None
+
+    clf.fit(features, labels)
+
+    if (registry is not None):
+        registry.put(key, clf)
+
+    return clf
+
+# Data for ROC analysis:
+# Features and labels for every pair of cohorts present
 #
 # Parameters:
 # norm_table - pandas Dataframe object containing normalized data sets
 # subj_cond - pandas Series representing cohort (data) vs. subject ID (index)
 # cohorts - list of PPMI cohorts present in data set
-# classifier - string selecting a supervised learning algorithm
 #
-# For now, allow three different classifier settings:
-# 
-#   'Random Forest' - Random Forest classifier with 200 trees, considering all features
-#   'kNN' - k-nearest neighbor clustering algorithm with 5 neighbors
-#   'Logistic Regression' - logistic regression algorithm
+# Returns:
+# list of tuples (pair, features, labels) - cohort pair (list of two), feature array, and
+# labels (0 for leading, 1 for trailing member of pair) - one for each pair
 
-def plot_roc_curve(norm_table, subj_cond, cohorts, classifier):
+def roc_pair_data(norm_table, subj_cond, cohorts):
     
     # We have up to three cohorts in a given data set.
     # ROC analysis requires to compare only pairs of cohorts, so let's find these
@@ -263,13 +684,7 @@ def plot_roc_curve(norm_table, subj_cond, cohorts, classifier):
         print 'WARNING:  ROC analysis requires at least two cohorts.'
         #(return here)
 
-    # Initialize figure
-
-    fig = plt.figure()
-    plt.xlim([-0.005, 1.005])
-    plt.ylim([-0.005, 1.005])
-
-    # Run the supervised learning test for all pairs...
+    pair_data = []
 
     for pair in cohort_pairs:
 
@@ -290,42 +705,324 @@ def plot_roc_curve(norm_table, subj_cond, cohorts, classifier):
         code_filtered   = cond_filtered.apply(lambda condition : pl.index(condition))
         labels_filtered = code_filtered.tolist()
 
+        pair_data.append((pl, feature_filtered, labels_filtered))
+
+    return pair_data
+
+# Training and test sets for ROC analysis:
+# Split the data of every pair of cohorts present into training and test parts.
+# (The same splits may serve several classifiers - see roc_curves.)
+#
+# Parameters:  same as roc_pair_data
+#
+# Returns:
+# list of tuples (pair, X_train, X_test, y_train, y_test) - cohort pair (list of two), feature
+# arrays and labels (0 for leading, 1 for trailing member of pair) - one for each pair
+
+def roc_splits(norm_table, subj_cond, cohorts):
+
+    splits = []
+
+    for pl, feature_filtered, labels_filtered in roc_pair_data(norm_table, subj_cond, cohorts):
+
         # Split list into training and test parts
 
         X_train, X_test, y_train, y_test = train_test_split(feature_filtered, labels_filtered)
 
-        # Now, select classifier algorithm:
-        
-        if (classifier == 'Random Forest'):
-            clf = RandomForestClassifier(n_estimators = 200, max_features = None)
-            
-        elif (classifier == 'kNN'):
-            clf = KNeighborsClassifier(n_neighbors = 5)
-            
-        elif (classifier == 'Logistic Regression'):
-            clf = LogisticRegression()
-            
-        else:
-            print 'WARNING:  Unsupported classifier', classifier
-            return None
-        
-        # Fit to training data
-        
-        clf.fit(X_train, y_train)
+        splits.append((pl, X_train, X_test, y_train, y_test))
+
+    return splits
+
+# Fold assignments for cross-validated ROC analysis:
+# Divide the subjects of every pair of cohorts into stratified folds (each fold has about the
+# same proportion of both cohorts), and repeat with different shuffles if desired.  Every fold
+# serves as test set once, with the remaining folds as training set.
+#
+# The shuffles are seeded, so the same selection always yields the same folds;  all classifiers
+# are then compared on identical training and test sets, and results can be cached.
+#
+# Parameters:
+# norm_table, subj_cond, cohorts - same as roc_pair_data
+# folds - number of folds (reduced for pairs with fewer subjects in the smaller cohort)
+# repeats - number of repetitions with different shuffles
+# seed - random seed of the first repetition
+#
+# Returns:
+# list of tuples (pair, features, labels, assignments) - see roc_pair_data; assignments is a list
+# of (training indices, test indices) for every fold and repetition
+
+def roc_folds(norm_table, subj_cond, cohorts, folds = 5, repeats = 1, seed = 0):
+
+    fold_data = []
+
+    for pl, features, labels in roc_pair_data(norm_table, subj_cond, cohorts):
+
+        labels = np.array(labels)
+
+        # Every fold needs members of both cohorts:
+
+        fold_count = min(folds, (labels == 0).sum(), (labels == 1).sum())
+
+        if (fold_count < 2):
+            print 'WARNING:  Too few subjects for cross-validation of', pl[0], 'vs.', pl[1]
+            continue
+
+        assignments = []
+
+        for repeat in range(repeats):
+            for train, test in StratifiedKFold(labels, n_folds = fold_count, shuffle = True, random_state = seed + repeat):
+                assignments.append((train, test))
+
+        fold_data.append((pl, features, labels, assignments))
+
+    return fold_data
+
+# Classifier for ROC analysis
+#
+# Parameters:
+# classifier - string selecting a supervised learning algorithm
+# trees - number of trees in the random forest (default 200)
+# depth - maximum depth of the trees (default None - grow trees until leaves are pure)
+# seed - random seed for the random forest (default None - different trees every time)
+# jobs - number of processor cores the random forest grows its trees on (default -1 - all cores)
+#
+# For now, allow three different classifier settings:
+# 
+#   'Random Forest' - Random Forest classifier with 200 trees, considering all features
+#                     (trees are grown on all processor cores, unless jobs is given)
+#   'kNN' - k-nearest neighbor clustering algorithm with 5 neighbors
+#   'Logistic Regression' - logistic regression algorithm
+#
+# Fewer and shallower trees make for cheap previews;  the defaults give the full analysis.
+#
+# Returns:
+# new (unfitted) scikit-learn classifier object (None for unknown classifier)
+
+def roc_classifier(classifier, trees = 200, depth = None, seed = None, jobs = -1):
+
+    if (classifier == 'Random Forest'):
+        return RandomForestClassifier(n_estimators = trees, max_depth = depth, max_features = None, n_jobs = jobs,
+                                      random_state = seed)
         
-        # Predict PPMI cohort probabilities for test set of subjects
+    elif (classifier == 'kNN'):
+        return KNeighborsClassifier(n_neighbors = 5)
         
-        prob = clf.predict_proba(X_test)
+    elif (classifier == 'Logistic Regression'):
+        return LogisticRegression()
 
-        # Create ROC curve, determine area under curve (AUC)
-        
-        fpr, tpr, thresholds = roc_curve(y_test, prob[:,1])
-        roc_auc = auc(fpr, tpr)
+    print 'WARNING:  Unsupported classifier', classifier
+    return None
+
+# Apply a function to a list of tasks in a pool of threads (at most one per processor core)
+#
+# scikit-learn does the numerical work outside of the Python interpreter lock, so threads run
+# in parallel.  Threads, unlike processes, are also available when this runs inside a worker
+# process of the statistics core.
+#
+# Parameters:  function, tasks - list of arguments
+# Returns:  list of results, in order of tasks
+
+def thread_map(function, tasks):
+
+    workers = thread_count(tasks)
+
+    if (workers < 2):
+        return [function(task) for task in tasks]
+
+    pool = ThreadPool(workers)
+
+    try:
+        return pool.map(function, tasks)
+
+    finally:
+        pool.close()
+        pool.join()
+
+# Number of threads thread_map uses for a list of tasks
+#
+# Parameter:  tasks - list of arguments
+# Returns:  number of threads (1 - tasks run in the calling thread)
+
+def thread_count(tasks):
+
+    return max(min(len(tasks), multiprocessing.cpu_count()), 1)
+
+# Number of processor cores for each random forest trained by thread_map:  the cores are divided
+# among the threads (at least one each), so that the forests trained at the same time use all cores
+# together - rather than each forest starting a job for every core
+#
+# Parameter:  tasks - list of arguments
+# Returns:  jobs - see roc_classifier
+
+def thread_jobs(tasks):
+
+    return max(multiprocessing.cpu_count() // thread_count(tasks), 1)
+
+# ROC curve for a single pair of cohorts:  train classifier, score test set
+#
+# Parameter:  tuple (classifier, trees, depth, jobs, split) - see roc_classifier, roc_splits
+#
+# Returns:
+# tuple (pair, fpr, tpr, roc_auc) - see roc_curves
+
+def roc_pair(arguments):
+
+    classifier, trees, depth, jobs, split = arguments
+    pl, X_train, X_test, y_train, y_test = split
+
+    # Fit to training data (or find fitted classifier in registry)
+
+    clf = fit_classifier(classifier, trees, depth, None, pl, X_train, y_train, jobs)
+    
+    # Predict PPMI cohort probabilities for test set of subjects
+    
+    prob = clf.predict_proba(X_test)
+
+    # Create ROC curve, determine area under curve (AUC)
+    
+    fpr, tpr, thresholds = roc_curve(y_test, prob[:,1])
+    roc_auc = auc(fpr, tpr)
+
+    return pl, fpr, tpr, roc_auc
+
+# Receiver-Operating Characteristic
+# Find the ROC curves for a given selection of data,
+# for possible combination of cohorts present
+#
+# The classifiers for the cohort pairs are trained concurrently (see thread_map).
+#
+# Parameters:
+# norm_table - pandas Dataframe object containing normalized data sets
+# subj_cond - pandas Series representing cohort (data) vs. subject ID (index)
+# cohorts - list of PPMI cohorts present in data set
+# classifier - string selecting a supervised learning algorithm (see roc_classifier)
+# splits - training and test sets (optional, see roc_splits) - drawn anew if not given
+# trees, depth - size of the random forest (optional, see roc_classifier)
+#
+# Returns:
+# list of tuples (pair, fpr, tpr, roc_auc) - cohort pair (list of two), false and true positive
+# rates (numpy arrays), area under curve - one for each pair (None for unknown classifier)
+
+def roc_curves(norm_table, subj_cond, cohorts, classifier, splits = None, trees = 200, depth = None):
+
+    if (roc_classifier(classifier) is None):
+        return None
+
+    if (splits is None):
+        splits = roc_splits(norm_table, subj_cond, cohorts)
+
+    # Run the supervised learning test for all pairs at once...
+
+    jobs = thread_jobs(splits)
+
+    return thread_map(roc_pair, [(classifier, trees, depth, jobs, split) for split in splits])
+
+# ROC curve for a single fold of cross-validation:  train classifier, score test fold
+#
+# Parameter:  tuple (classifier, trees, depth, seed, jobs, pair, features, labels, train, test)
+#
+# Returns:
+# tuple (fpr, tpr, roc_auc) - false and true positive rates (numpy arrays), area under curve
+
+def roc_fold(arguments):
+
+    classifier, trees, depth, seed, jobs, pair, features, labels, train, test = arguments
+
+    clf = fit_classifier(classifier, trees, depth, seed, pair, features[train], labels[train], jobs)
+
+    prob = clf.predict_proba(features[test])
+
+    fpr, tpr, thresholds = roc_curve(labels[test], prob[:,1])
+
+    return fpr, tpr, auc(fpr, tpr)
+
+# Cross-validated Receiver-Operating Characteristic
+# Find the average ROC curves over all folds (see roc_folds), for every pair of cohorts present
+#
+# The folds of all pairs are trained concurrently (see thread_map).  The curves of the folds are
+# interpolated onto a common grid of false positive rates and averaged;  the band around the
+# average curve, and the uncertainty of the AUC, are one standard deviation across folds.
+#
+# Parameters:
+# norm_table, subj_cond, cohorts, classifier - same as roc_curves
+# fold_data - fold assignments (optional, see roc_folds) - found from folds and repeats if not given
+# trees, depth - size of the random forest (optional, see roc_classifier)
+# folds, repeats - number of folds and repetitions (see roc_folds)
+#
+# Returns:
+# list of tuples (pair, fpr, tpr, tpr_low, tpr_high, auc_mean, auc_std) - cohort pair, grid of
+# false positive rates, average true positive rates with lower and upper edge of the band,
+# average and standard deviation of the AUC - one for each pair (None for unknown classifier)
+
+def roc_cv_curves(norm_table, subj_cond, cohorts, classifier, fold_data = None, trees = 200, depth = None,
+                  folds = 5, repeats = 1):
+
+    if (roc_classifier(classifier) is None):
+        return None
+
+    if (fold_data is None):
+        fold_data = roc_folds(norm_table, subj_cond, cohorts, folds, repeats)
+
+    # Train all folds of all pairs at once (random forests are seeded for reproducible results):
+
+    assignment_list = [(pl, features, labels, train, test) for pl, features, labels, assignments in fold_data
+                       for train, test in assignments]
+
+    jobs = thread_jobs(assignment_list)
+
+    tasks = [(classifier, trees, depth, 0, jobs) + assignment for assignment in assignment_list]
+
+    results = thread_map(roc_fold, tasks)
+
+    # Average over the folds of each pair:
 
-        # Plot curve
+    grid = np.linspace(0.0, 1.0, 101)
+    curves = []
+
+    for pl, features, labels, assignments in fold_data:
+
+        fold_results = results[:len(assignments)]
+        results = results[len(assignments):]
+
+        tpr_folds = np.array([np.interp(grid, fpr, tpr) for fpr, tpr, roc_auc in fold_results])
+        tpr_folds[:, 0] = 0.0
+
+        auc_folds = np.array([roc_auc for fpr, tpr, roc_auc in fold_results])
+
+        tpr_mean = tpr_folds.mean(axis = 0)
+        tpr_std = tpr_folds.std(axis = 0)
+
+        curves.append((pl, grid, tpr_mean, np.maximum(tpr_mean - tpr_std, 0.0), np.minimum(tpr_mean + tpr_std, 1.0),
+                       auc_folds.mean(), auc_folds.std()))
+
+    return curves
+
+# Draw ROC curves, return PNG image
+#
+# Parameters:
+# curves - list of tuples (legend text, fpr, tpr, band) - band is a tuple (lower tpr, upper tpr),
+#          or None
+# title - plot title
+#
+# Returns:
+# png_file - string containing the rendered image in PNG format
+
+def draw_roc_curves(curves, title):
+
+    # Initialize figure
+
+    fig = plt.figure()
+    plt.xlim([-0.005, 1.005])
+    plt.ylim([-0.005, 1.005])
+
+    for legend_text, fpr, tpr, band in curves:
+
+        # Plot curve (and band, shaded in the same color)
         
-        legend_text = 'AUC ' + pl[0] + ' vs. ' + pl[1] + ': %0.2f' % roc_auc
-        plt.plot(fpr, tpr, lw = 2, label=legend_text, alpha = 0.5)
+        line, = plt.plot(fpr, tpr, lw = 2, label=legend_text, alpha = 0.5)
+
+        if (band is not None):
+            plt.fill_between(fpr, band[0], band[1], color = line.get_color(), alpha = 0.15)
 
     # Plot diagonal (random guesses)
     
@@ -335,7 +1032,7 @@ def plot_roc_curve(norm_table, subj_cond, cohorts, classifier):
     
     plt.xlabel('False Positive Rate', fontsize = 14)
     plt.ylabel('True Positive Rate', fontsize = 14)
-    plt.title('ROC Curve (' + classifier + ')', fontsize = 18)
+    plt.title(title, fontsize = 18)
     plt.legend(loc="lower right")
 
     # Now, save the graph as a .PNG image.
@@ -350,4 +1047,190 @@ def plot_roc_curve(norm_table, subj_cond, cohorts, classifier):
     imgdata.seek(0)
     png_file = imgdata.buf
     
-    return png_file
\ No newline at end of file
+    return png_file
+
+# ROC curve plot:
+# Draw the ROC curves for all pairs of cohorts present (see roc_curves), with AUC in the legend
+#
+# Parameters:  same as roc_curves
+#
+# Returns:
+# png_file - string containing the rendered image in PNG format
+
+def plot_roc_curve(norm_table, subj_cond, cohorts, classifier, splits = None, trees = 200, depth = None):
+
+    curves = roc_curves(norm_table, subj_cond, cohorts, classifier, splits, trees, depth)
+
+    if (curves is None):
+        return None
+
+    lines = []
+
+    for pl, fpr, tpr, roc_auc in curves:
+        legend_text = 'AUC ' + pl[0] + ' vs. ' + pl[1] + ': %0.2f' % roc_auc
+        lines.append((legend_text, fpr, tpr, None))
+
+    return draw_roc_curves(lines, 'ROC Curve (' + classifier + ')')
+
+# Cross-validated ROC curve plot:
+# Draw the average ROC curves with bands for all pairs of cohorts present (see roc_cv_curves),
+# with average AUC and its standard deviation in the legend
+#
+# Parameters:  same as roc_cv_curves
+#
+# Returns:
+# png_file - string containing the rendered image in PNG format
+
+def plot_roc_cv(norm_table, subj_cond, cohorts, classifier, fold_data = None, trees = 200, depth = None,
+                folds = 5, repeats = 1):
+
+    curves = roc_cv_curves(norm_table, subj_cond, cohorts, classifier, fold_data, trees, depth, folds, repeats)
+
+    if (curves is None):
+        return None
+
+    lines = []
+
+    for pl, fpr, tpr, tpr_low, tpr_high, auc_mean, auc_std in curves:
+        legend_text = 'AUC ' + pl[0] + ' vs. ' + pl[1] + ': %0.2f $\\pm$ %0.2f' % (auc_mean, auc_std)
+        lines.append((legend_text, fpr, tpr, (tpr_low, tpr_high)))
+
+    return draw_roc_curves(lines, 'ROC Curve (' + classifier + ', CV)')
+
+# ROC curve payload:
+# The ROC curves for all pairs of cohorts present (see roc_curves) as plain numbers, for
+# rendering by the client instead of the server
+#
+# Parameters:  same as roc_curves
+#
+# Returns:
+# dictionary with plot title and list of curves (cohort pair, false and true positive rates,
+# area under curve) - None for unknown classifier
+
+def roc_payload(norm_table, subj_cond, cohorts, classifier, splits = None, trees = 200, depth = None):
+
+    curves = roc_curves(norm_table, subj_cond, cohorts, classifier, splits, trees, depth)
+
+    if (curves is None):
+        return None
+
+    payload = {'Title' : 'ROC Curve (' + classifier + ')', 'Curves' : []}
+
+    for pl, fpr, tpr, roc_auc in curves:
+        payload['Curves'].append({'Pair' : pl, 'FPR' : np.round(fpr, 4).tolist(),
+                                  'TPR' : np.round(tpr, 4).tolist(), 'AUC' : round(roc_auc, 4)})
+
+    return payload
+
+# Cross-validated ROC curve payload:
+# The average ROC curves with bands (see roc_cv_curves) as plain numbers, for rendering by the client
+#
+# Parameters:  same as roc_cv_curves
+#
+# Returns:
+# dictionary with plot title and list of curves (cohort pair, false and true positive rates,
+# lower and upper edge of the band, average and standard deviation of the AUC) - None for
+# unknown classifier
+
+def roc_cv_payload(norm_table, subj_cond, cohorts, classifier, fold_data = None, trees = 200, depth = None,
+                   folds = 5, repeats = 1):
+
+    curves = roc_cv_curves(norm_table, subj_cond, cohorts, classifier, fold_data, trees, depth, folds, repeats)
+
+    if (curves is None):
+        return None
+
+    payload = {'Title' : 'ROC Curve (' + classifier + ', CV)', 'Curves' : []}
+
+    for pl, fpr, tpr, tpr_low, tpr_high, auc_mean, auc_std in curves:
+        payload['Curves'].append({'Pair' : pl, 'FPR' : np.round(fpr, 4).tolist(),
+                                  'TPR' : np.round(tpr, 4).tolist(),
+                                  'TPR Low' : np.round(tpr_low, 4).tolist(),
+                                  'TPR High' : np.round(tpr_high, 4).tolist(),
+                                  'AUC' : round(auc_mean, 4), 'AUC Std' : round(auc_std, 4)})
+
+    return payload
+
+# Score subjects with a classifier trained on a pair of cohorts:
+# The classifier is trained on the subjects of the two cohorts in the data selection (with a
+# seeded random forest), and kept in the model registry, if there is one - so repeated calls on
+# the same selection do not train again.  It then yields, for each subject to be scored, the
+# probability to belong to the second cohort of the pair.
+#
+# A classifier scoring the subjects it was trained on mostly reproduces their labels (a random
+# forest of full depth all but memorizes them).  Subjects of the two cohorts are therefore scored
+# out of fold:  they are divided into seeded, stratified folds (as in roc_folds), and each fold is
+# scored by a classifier trained on the other folds.  Subjects outside the two cohorts (e.g., SWEDD
+# subjects, scored by a HC vs. PD classifier) are scored by the classifier trained on all subjects
+# of the pair, as long as their data is normalized the same way as the selection.
+#
+# Parameters:
+# norm_table - pandas Dataframe object containing normalized data sets (training selection)
+# subj_cond - pandas Series representing cohort (data) vs. subject ID (index)
+# pair - list of two cohorts
+# classifier - string selecting a supervised learning algorithm (see roc_classifier)
+# subjects - pandas Dataframe object with the normalized data of the subjects to be scored
+#            (same columns as norm_table;  default:  all subjects in norm_table)
+# trees, depth - size of the random forest (optional, see roc_classifier)
+# folds - number of folds for the subjects of the pair (reduced for small cohorts, see roc_folds)
+#
+# Returns:
+# pandas Series of probabilities vs. subject ID (None if classifier or pair is not available)
+
+def score_subjects(norm_table, subj_cond, pair, classifier, subjects = None, trees = 200, depth = None, folds = 5):
+
+    pair = list(pair)
+
+    if (len(pair) != 2):
+        print 'WARNING:  Scoring requires a pair of cohorts, not', pair
+        return None
+
+    if (roc_classifier(classifier) is None):
+        return None
+
+    # Training data:  all subjects of the pair, labels 0 and 1 for first and second cohort
+
+    pair_filter = subj_cond.isin(pair)
+
+    features = norm_table[pair_filter].as_matrix()
+    labels = (subj_cond[pair_filter] == pair[1]).astype(int).values
+
+    if (labels.sum() == 0) or (labels.sum() == len(labels)):
+        print 'WARNING:  Scoring requires subjects from both cohorts of', pair
+        return None
+
+    if (subjects is None):
+        subjects = norm_table
+
+    inside = np.asarray(subjects.index.isin(subj_cond.index[pair_filter]))
+    scores = pd.Series(np.nan, index = subjects.index, name = pair[1] + ' probability')
+
+    # Subjects of the pair:  out-of-fold probabilities (every fold needs members of both cohorts)
+
+    if inside.any():
+
+        fold_count = min(folds, (labels == 0).sum(), (labels == 1).sum())
+
+        if (fold_count < 2):
+            print 'WARNING:  Too few subjects to score', pair[0], 'and', pair[1], 'subjects out of fold'
+            return None
+
+        out_of_fold = np.zeros(len(labels))
+
+        for train, test in StratifiedKFold(labels, n_folds = fold_count, shuffle = True, random_state = 0):
+            clf = fit_classifier(classifier, trees, depth, 0, pair, features[train], labels[train])
+            out_of_fold[test] = clf.predict_proba(features[test])[:,1]
+
+        out_of_fold = pd.Series(out_of_fold, index = subj_cond.index[pair_filter])
+        scores[inside] = out_of_fold[subjects.index[inside]].values
+
+    # Other subjects:  classifier trained on all subjects of the pair
+
+    if not inside.all():
+
+        clf = fit_classifier(classifier, trees, depth, 0, pair, features, labels)
+
+        prob = clf.predict_proba(subjects[~inside][norm_table.columns].as_matrix())
+        scores[~inside] = prob[:,1]
+
+    return scores
@@ -0,0 +1,474 @@
+# PPMI Statistics Core Server
+# Long-lived server process for the statistics core (later addition to the PPMI analysis tools)
+#
+# Idea:  Keep the statistics core running as a long-lived process that loads the PPMI data
+#        object once, and answers frontend requests over a local HTTP endpoint.  The JSON
+#        messages are the same as in the core module (see README):
+#
+#   GET  /data      -> {"PPMI All Data" : ...}      (list_available_data)
+#   GET  /counts    -> {"PPMI Data Counts" : ...}   (list_data_counts)
+#   POST /plots     <- {"employdata" : ...}
+#                   -> {"PPMI Tests" : ...}         (list_available_plots)
+#   POST /plot      <- {"employdata" : ..., "PPMI Image" : {"Type" : type, "Option" : option}}
+#                   -> PNG image                    (create_plot)
+#                      (or {"PPMI Plot" : ...} if the image request asks for "Format" : "Payload")
+#   POST /batch     <- {"employdata" : ..., "PPMI Images" : [{"Type" : type, "Option" : option}, ...]}
+#                   -> {"PPMI Images" : [{"PPMI Image" : ..., "Data" : base64 PNG image}, ...]}
+#                      (create_plots - all available plots if "PPMI Images" is missing)
+#   POST /score     <- {"employdata" : ..., "Pair" : [cohort, cohort], "Classifier" : classifier,
+#                       "Subjects" : [subject IDs]}
+#                   -> {"PPMI Scores" : {subject ID : probability of second cohort, ...}}
+#                      (score_subjects - all subjects of the selection if "Subjects" is missing;
+#                       subjects of the pair are scored out of fold)
+#
+# Image requests carry the data selection along, so the server does not need to keep track
+# of frontend sessions.  Prepared selections (normalized tables, statistics) are kept in a
+# small cache, rendered images in a PlotCache.  Rendering and machine learning are handed
+# to a pool of worker processes, so that long calculations do not block other requests.
+# Each worker keeps a registry of trained classifiers and projections (PCA, t-SNE), optionally
+# shared on disk.
+
+import matplotlib
+matplotlib.use('Agg')
+
+import BaseHTTPServer
+import SocketServer
+import multiprocessing
+import collections
+import threading
+import json as js
+import base64
+import os
+import sys
+
+# PPMI analysis core:
+import PPMI_Stats_Core as ppmi
+import PPMI_learn as plearn
+
+# ******** METHODS:
+
+# Load the PPMI data object (numpy format if the file name ends in '.npy', pickled otherwise)
+#
+# Parameter:  File name & path for data object
+# Returns:  same as unpickle_PPMI_data
+
+def load_PPMI_data(filename):
+
+	if (os.path.splitext(filename)[1] == '.npy'):
+		return ppmi.open_PPMI_data(filename)
+
+	return ppmi.unpickle_PPMI_data(filename)
+
+# Prepare a data selection for analysis:  build data table, count cohorts, find statistics,
+# normalize
+#
+# Parameters:
+# employdata - dictionary of cohorts and (event, test) selections (contents of 'employdata' key)
+# data - tuple returned by load_PPMI_data
+#
+# Returns:
+# tuple (norm_table, data_avg, subj_cond, cohorts, data_counts)
+
+def prepare_selection(employdata, data):
+
+	subject_list, subject_condition, event_list, test_list, test_dict, data_cube = data
+
+	cohorts, selections = ppmi.parse_information(employdata)
+
+	# Keep selections in a fixed order, so that equal requests give equal tables:
+
+	selections.sort()
+
+	subj_cond, data_table = ppmi.build_data_table(data_cube, cohorts, selections, subject_list, subject_condition)
+	data_counts, cohorts = ppmi.data_count(subj_cond)
+	data_avg = ppmi.data_stats(data_table, subj_cond, cohorts)
+	norm_table = ppmi.normalize_table(data_table, data_avg)
+
+	return norm_table, data_avg, subj_cond, cohorts, data_counts
+
+# Set up a worker process:  registry for trained classifiers, cache for projections
+# (shared by all workers on disk, if a directory is given - so that the full t-SNE embedding
+# continues from a preview rendered by another worker)
+#
+# Parameter:  model_dir - directory for on-disk model storage (optional)
+
+def start_worker(model_dir):
+
+	plearn.use_model_registry(plearn.ModelRegistry(directory = model_dir))
+
+	if (model_dir is not None):
+		plearn.use_projection_cache(plearn.ModelRegistry(max_models = 16, directory = os.path.join(model_dir, 'projections')))
+
+# HTTP server:  Threaded, so that catalog requests are answered while images are rendered.
+# Holds the PPMI data, the caches and the worker pool.
+#
+# Parameters:
+# address - (host, port) tuple
+# data - tuple returned by load_PPMI_data
+# workers - number of worker processes for rendering
+# cache_dir - directory for on-disk image cache (optional)
+# model_dir - directory for on-disk model registry (optional)
+
+class PPMIServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+
+	daemon_threads = True
+
+	def __init__(self, address, data, workers, cache_dir = None, model_dir = None):
+
+		BaseHTTPServer.HTTPServer.__init__(self, address, PPMIRequestHandler)
+
+		self.data = data
+
+		# Catalog responses never change while the server is running:
+
+		subject_list, subject_condition, event_list, test_list, test_dict, data_cube = data
+
+		self.available_data = ppmi.list_available_data(event_list, test_list, data_cube)
+		self.data_counts = ppmi.list_data_counts(event_list, test_list, data_cube)
+
+		# Caches for prepared selections and images:
+
+		self.selections = collections.OrderedDict()
+		self.selection_limit = 32
+		self.lock = threading.Lock()
+
+		self.plot_cache = ppmi.PlotCache(directory = cache_dir)
+
+		# Worker processes (forked after the data is loaded):
+
+		self.pool = multiprocessing.Pool(processes = workers, initializer = start_worker, initargs = (model_dir,))
+
+	# Find prepared selection, or prepare it:
+	#
+	# Parameter:  employdata - dictionary (contents of 'employdata' key)
+	# Returns:  tuple (norm_table, data_avg, subj_cond, cohorts, data_counts)
+
+	def get_selection(self, employdata):
+
+		key = js.dumps(employdata, sort_keys = True)
+
+		with self.lock:
+			if (key in self.selections):
+				prepared = self.selections.pop(key)
+				self.selections[key] = prepared
+
+				return prepared
+
+		prepared = prepare_selection(employdata, self.data)
+
+		with self.lock:
+			self.selections[key] = prepared
+
+			while (len(self.selections) > self.selection_limit):
+				self.selections.popitem(last = False)
+
+		return prepared
+
+	# Answer image request from the cache, or render it in a worker process:
+	#
+	# Parameters:  image_request - JSON string, prepared - prepared selection
+	# Returns:  PNG image as string (None if the request could not be served)
+
+	def get_plot(self, image_request, prepared):
+
+		key = ppmi.plot_cache_key(image_request, *prepared)
+		image_data = self.plot_cache.get(key)
+
+		if (image_data is None):
+			image_data = self.pool.apply(ppmi.render_plot, (image_request,) + prepared)
+
+			if (image_data is not None):
+				self.plot_cache.put(key, image_data)
+
+		return image_data
+
+	# Answer a batch of image requests - shared intermediate results, rendered in parallel:
+	#
+	# Parameters:  image_requests - list of JSON strings, prepared - prepared selection
+	# Returns:  dictionary {image_request : image data}
+
+	def get_plots(self, image_requests, prepared):
+
+		return ppmi.create_plots(image_requests, *prepared, pool = self.pool, cache = self.plot_cache)
+
+	# Score subjects with a classifier trained on a pair of cohorts (in a worker process):
+	#
+	# Parameters:  prepared - prepared selection, pair, classifier, subjects - list of subject IDs
+	# Returns:  pandas Series of probabilities (None if not available)
+
+	def get_scores(self, prepared, pair, classifier, subjects):
+
+		norm_table, data_avg, subj_cond, cohorts, data_counts = prepared
+
+		subject_table = None
+		if (subjects is not None):
+			subject_table = norm_table.loc[subjects]
+
+		return self.pool.apply(plearn.score_subjects, (norm_table, subj_cond, pair, classifier, subject_table))
+
+	def server_close(self):
+
+		BaseHTTPServer.HTTPServer.server_close(self)
+
+		self.pool.close()
+		self.pool.join()
+
+# Request handler:  Translate HTTP requests into calls of the core methods
+
+class PPMIRequestHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+
+	def do_GET(self):
+
+		if (self.path == '/data'):
+			self.send_content(self.server.available_data, 'application/json')
+
+		elif (self.path == '/counts'):
+			self.send_content(self.server.data_counts, 'application/json')
+
+		else:
+			self.send_error(404, 'Unknown request')
+
+	def do_POST(self):
+
+		# Read JSON message:
+
+		try:
+			length = int(self.headers.getheader('Content-Length', 0))
+			message = js.loads(self.rfile.read(length))
+			employdata = message['employdata']
+
+		except (ValueError, KeyError, TypeError):
+			self.send_error(400, 'Malformed request')
+			return
+
+		# Prepare selection - fails for unknown cohorts, events or tests:
+
+		try:
+			prepared = self.server.get_selection(employdata)
+
+		except (ValueError, KeyError, TypeError):
+			self.send_error(400, 'Invalid data selection')
+			return
+
+		norm_table, data_avg, subj_cond, cohorts, data_counts = prepared
+
+		if (self.path == '/plots'):
+			self.send_content(ppmi.list_available_plots(norm_table, cohorts), 'application/json')
+
+		elif (self.path == '/plot'):
+
+			if not ('PPMI Image' in message):
+				self.send_error(400, 'Missing image request')
+				return
+
+			problem = ppmi.check_image_request(message['PPMI Image'])
+
+			if (problem is not None):
+				self.send_error(400, problem)
+				return
+
+			image_request = js.dumps({'PPMI Image' : message['PPMI Image']}, sort_keys = True)
+
+			try:
+				image_data = self.server.get_plot(image_request, prepared)
+
+			except Exception:
+
+				# Something went wrong in the renderer - report, keep serving:
+
+				print 'Unexpected error:', sys.exc_info()[0], 'for request', image_request
+				self.send_error(500, 'Image could not be rendered')
+				return
+
+			if (image_data is None):
+				self.send_error(400, 'Image not available for this selection')
+
+			elif (message['PPMI Image'].get('Format', 'PNG') == 'Payload'):
+				self.send_content(image_data, 'application/json')
+
+			else:
+				self.send_content(image_data, 'image/png')
+
+		elif (self.path == '/batch'):
+
+			# Requested images, or all images available for the selection:
+
+			if ('PPMI Images' in message):
+				image_list = message['PPMI Images']
+
+				if not isinstance(image_list, list):
+					self.send_error(400, 'Invalid batch request')
+					return
+
+				for image_dict in image_list:
+					problem = ppmi.check_image_request(image_dict)
+
+					if (problem is not None):
+						self.send_error(400, problem)
+						return
+			else:
+				available = js.loads(ppmi.list_available_plots(norm_table, cohorts))['PPMI Tests']
+				image_list = [{'Type' : image_type, 'Option' : option} for image_type in sorted(available) for option in available[image_type]]
+
+			try:
+				image_requests = [js.dumps({'PPMI Image' : image_dict}, sort_keys = True) for image_dict in image_list]
+				images = self.server.get_plots(image_requests, prepared)
+
+			except Exception:
+				print 'Unexpected error:', sys.exc_info()[0], 'for batch request', image_list
+				self.send_error(500, 'Images could not be rendered')
+				return
+
+			# Images as base64 strings, payloads as they are:
+
+			results = []
+
+			for image_dict, image_request in zip(image_list, image_requests):
+
+				entry = {'PPMI Image' : image_dict, 'Data' : None}
+				image_data = images[image_request]
+
+				if (image_data is not None):
+					if (image_dict.get('Format', 'PNG') == 'Payload'):
+						entry.update(js.loads(image_data))
+						del entry['Data']
+					else:
+						entry['Data'] = base64.b64encode(image_data)
+
+				results.append(entry)
+
+			self.send_content(js.dumps({'PPMI Images' : results}), 'application/json')
+
+		elif (self.path == '/score'):
+
+			try:
+				pair = list(message['Pair'])
+				classifier = message['Classifier']
+				subjects = message.get('Subjects')
+
+				if (len(pair) != 2):
+					raise TypeError
+
+				# Subject IDs may be given as numbers or strings (as in JSON object keys):
+
+				if (subjects is not None):
+					subject_ids = dict([(str(subject), subject) for subject in norm_table.index])
+					subjects = [subject_ids[str(subject)] for subject in subjects]
+
+			except (KeyError, TypeError):
+				self.send_error(400, 'Invalid scoring request')
+				return
+
+			try:
+				scores = self.server.get_scores(prepared, pair, classifier, subjects)
+
+			except Exception:
+				print 'Unexpected error:', sys.exc_info()[0], 'for scoring request', pair, classifier
+				self.send_error(500, 'Subjects could not be scored')
+				return
+
+			if (scores is None):
+				self.send_error(400, 'Classifier not available for this selection')
+			else:
+				self.send_content(js.dumps({'PPMI Scores' : scores.to_dict()}), 'application/json')
+
+		else:
+			self.send_error(404, 'Unknown request')
+
+	# Allow requests from frontend pages opened from other origins (e.g. local files):
+
+	def do_OPTIONS(self):
+
+		self.send_response(204)
+		self.send_header('Access-Control-Allow-Origin', '*')
+		self.send_header('Access-Control-Allow-Methods', 'GET, POST, OPTIONS')
+		self.send_header('Access-Control-Allow-Headers', 'Content-Type')
+		self.end_headers()
+
+	def send_content(self, content, content_type):
+
+		self.send_response(200)
+		self.send_header('Content-Type', content_type)
+		self.send_header('Content-Length', str(len(content)))
+		self.send_header('Access-Control-Allow-Origin', '*')
+		self.end_headers()
+
+		self.wfile.write(content)
+
+# ********** MAIN SCRIPT
+
+# Run only if called directly:
+
+if __name__ == '__main__':
+
+	# Default settings for data object, port, number of workers, image and model directories:
+
+	datafile  = '../PPMI Analysis/PPMI_data.npy'
+	port      = 8000
+	workers   = multiprocessing.cpu_count()
+	cache_dir = None
+	model_dir = None
+
+	# Settings may be overridden by options:
+	#
+	#   -d = data object
+	#   -p = port
+	#   -w = number of worker processes
+	#   -c = directory for on-disk image cache
+	#   -m = directory for on-disk model registry
+
+	for entry in sys.argv[1:]:
+
+		if (entry.count('=') == 0) or (len(entry.split('=', 1)[0]) < 2) or (entry[0] != '-'):
+			print 'ERROR:  Unrecognized argument', entry
+			raise SystemExit(0)
+
+		code, value = entry.split('=', 1)
+		code = code[1]
+		value = value.strip()
+
+		if (code == 'd'):
+			datafile = value
+
+		elif (code == 'c'):
+			cache_dir = value
+
+		elif (code == 'm'):
+			model_dir = value
+
+		elif (code in ['p', 'w']):
+
+			# Port and number of workers must be positive integers
+
+			try:
+				number = int(value)
+			except ValueError:
+				number = 0
+
+			if (number < 1):
+				print 'ERROR:  Invalid argument', entry
+				raise SystemExit(0)
+
+			if (code == 'p'):
+				port = number
+			else:
+				workers = number
+
+		else:
+			print 'ERROR:  Unrecognized argument', entry
+			raise SystemExit(0)
+
+	# Load the data once, then serve requests on the local machine only:
+
+	data = load_PPMI_data(datafile)
+	server = PPMIServer(('127.0.0.1', port), data, workers, cache_dir, model_dir)
+
+	print 'Serving PPMI data from', datafile, 'at http://127.0.0.1:' + str(port)
+
+	try:
+		server.serve_forever()
+
+	except KeyboardInterrupt:
+		pass
+
+	server.server_close()
@@ -14,11 +14,11 @@
 # 
 # Unpickle the PPMI data object:
 # Restore subject list and conditions, event and test lists;
-# return data as pandas Panel object:
+# return data as PPMICube object (see below):
 #
-#   First (item) coordinate:  Event
-#   Second (major) coordnate:  Subject
-#   Third (minor) coordinate:  Test 
+#   First coordinate:  Event
+#   Second coordinate:  Subject
+#   Third coordinate:  Test 
 # 
 # Parameter:  File name & path for pickled data object
 # Returns:
@@ -27,12 +27,17 @@
 # event_list - a list of all events (timeline of study)
 # test_list - a list of all study tests stored in the data object (clear text)
 # test_dict - a dictionary PPMI test code : clear text descriptor
-# data_panel - three-dimensional pandas data object.
+# data_cube - three-dimensional PPMICube data object.
 
 import pandas as pd
 import numpy as np
 import json as js
 import pickle
+import os
+import tempfile
+import hashlib
+import collections
+import threading
 
 # PPMI machine learning:
 import PPMI_learn as plearn
@@ -40,6 +45,157 @@ import PPMI_learn as plearn
 # PPMI graphics:
 import PPMI_Gaussplots as pgauss
 
+# PPMI data cube:
+#
+# Three-dimensional data object that replaces the pandas Panel.  The data is kept in its raw
+# numpy array (possibly a memory map), indexed by
+#
+#   First coordinate:  Event
+#   Second coordinate:  Subject
+#   Third coordinate:  Test
+#
+# Labels are translated into array positions by dictionary lookup.  Data for several
+# (event, test) combinations is extracted in a single fancy indexing operation.
+#
+# The number of subjects with data for each (event, test) combination, in total and by cohort,
+# is computed once when the cube is created (unless it is supplied from the stored data object),
+# and kept in the dictionary 'counts':
+#
+#   {'subjects' : (events x tests) array, cohort : (events x tests) array, ...}
+#
+# Parameters:
+# data_array - three-dimensional numpy array
+# event_list, subject_list, test_list - axis labels
+# subject_condition - dictionary of subject cohort membership
+# counts - precomputed availability index (optional)
+
+class PPMICube(object):
+
+	def __init__(self, data_array, event_list, subject_list, test_list, subject_condition, counts = None):
+
+		self.values = data_array
+
+		self.events = list(event_list)
+		self.subjects = list(subject_list)
+		self.tests = list(test_list)
+
+		self.event_index = dict((event, position) for position, event in enumerate(self.events))
+		self.subject_index = dict((subj, position) for position, subj in enumerate(self.subjects))
+		self.test_index = dict((test, position) for position, test in enumerate(self.tests))
+
+		# Condition of each subject, in array order:
+
+		self.conditions = np.array([subject_condition[subj] for subj in self.subjects], dtype = object)
+
+		# Boolean membership masks for each cohort, and a cache for unions of cohorts:
+
+		self.cohort_masks = dict((group, (self.conditions == group)) for group in set(self.conditions))
+		self.mask_cache = {}
+
+		# Availability index:
+
+		if (counts is None):
+			counts = self.availability_index()
+
+		self.counts = counts
+
+	# Find array positions for a list of (event, test) combinations
+	#
+	# Parameter:  selections - list of (event, test) pairs
+	# Returns:  numpy arrays of event and test positions
+
+	def locate(self, selections):
+
+		event_pos = np.empty(len(selections), dtype = int)
+		test_pos = np.empty(len(selections), dtype = int)
+
+		for position, group in enumerate(selections):
+
+			# Make sure test/event really exists:
+
+			try:
+				event_pos[position] = self.event_index[group[0]]
+				test_pos[position] = self.test_index[group[1]]
+			except KeyError:
+				print 'ERROR:  Unknown event or test ', group
+				raise ValueError
+
+		return event_pos, test_pos
+
+	# Boolean mask of the subjects that belong to any of the cohorts listed
+	# (computed once for each combination of cohorts, then served from the cache - do not modify)
+	#
+	# Parameter:  cohorts - list of cohorts
+	# Returns:  boolean numpy array (one entry per subject)
+
+	def cohort_mask(self, cohorts):
+
+		key = frozenset(cohorts)
+
+		if (key not in self.mask_cache):
+			mask = np.zeros(len(self.subjects), dtype = bool)
+
+			for group in key:
+				if (group in self.cohort_masks):
+					mask |= self.cohort_masks[group]
+
+			self.mask_cache[key] = mask
+
+		return self.mask_cache[key]
+
+	# Extract data for a list of (event, test) combinations
+	#
+	# Parameters:
+	# selections - list of (event, test) pairs
+	# subject_mask - boolean array selecting subjects (optional, default: all subjects)
+	#
+	# Returns:  two-dimensional numpy array (subjects x selections)
+
+	def gather(self, selections, subject_mask = None):
+
+		event_pos, test_pos = self.locate(selections)
+
+		if (subject_mask is None):
+			subject_pos = np.arange(len(self.subjects))
+		else:
+			subject_pos = np.flatnonzero(subject_mask)
+
+		return self.values[event_pos[np.newaxis, :], subject_pos[:, np.newaxis], test_pos[np.newaxis, :]]
+
+	# Count subjects with data for each event and test
+	#
+	# Parameter:  subject_mask - boolean array selecting subjects (optional, default: all subjects)
+	# Returns:  integer numpy array (events x tests)
+
+	def availability(self, subject_mask = None):
+
+		if (subject_mask is None):
+			return np.sum(~np.isnan(self.values), axis = 1)
+
+		return np.sum(~np.isnan(self.values[:, subject_mask, :]), axis = 1)
+
+	# Count subjects with data for each event and test, in total and for each cohort
+	# (one event slice at a time, to keep memory use small)
+	#
+	# Returns:  dictionary {'subjects' : array, cohort : array, ...} of integer arrays (events x tests)
+
+	def availability_index(self):
+
+		cohort_list = sorted(self.cohort_masks.keys())
+		cohort_masks = [self.cohort_masks[group] for group in cohort_list]
+
+		counts = dict((group, np.zeros((len(self.events), len(self.tests)), dtype = int)) for group in cohort_list)
+
+		for event_pos in range(len(self.events)):
+			valid = ~np.isnan(self.values[event_pos])
+
+			for group, mask in zip(cohort_list, cohort_masks):
+				counts[group][event_pos] = valid[mask].sum(axis = 0)
+
+		counts['subjects'] = sum(counts.values(), np.zeros((len(self.events), len(self.tests)), dtype = int))
+
+		return counts
+
 def unpickle_PPMI_data(filename = 'PPMI_data.pkl'):
 
 	# Recover the pickled data:
@@ -52,54 +208,92 @@ def unpickle_PPMI_data(filename = 'PPMI_data.pkl'):
 		print 'ERROR:  Could not open pickled data object'
 		raise IOError
 
-	# Create pandas Panel object:
+	# Create data cube:
+
+	data_cube = PPMICube(PPMI_array, event_list, subject_list, test_list, subject_condition)
+
+	return subject_list, subject_condition, event_list, test_list, test_dict, data_cube
+
+# Open the PPMI data object in numpy format (see backend):
+# The data array is memory-mapped read-only, so it is shared between all processes that open it,
+# and only the event/test slices actually used are read from disk.  Axis labels, subject conditions
+# and the test dictionary are read from the JSON sidecar file with the same base name.
+#
+# Parameter:  File name & path for data array (.npy)
+# Returns:  same as unpickle_PPMI_data
+
+def open_PPMI_data(filename = 'PPMI_data.npy'):
+
+	# Read axis labels and conditions:
+
+	sidefile = os.path.splitext(filename)[0] + '.json'
+
+	try:
+		with open(sidefile, 'r') as datafile:
+			sidecar = js.load(datafile)
+
+	except IOError:
+		print 'ERROR:  Could not open PPMI data object', sidefile
+		raise IOError
+
+	subject_list = sidecar['subjects']
+	subject_condition = dict(zip(subject_list, sidecar['conditions']))
+
+	event_list = sidecar['events']
+	test_list = sidecar['tests']
+	test_dict = sidecar['testdict']
+
+	# Availability index, if stored by the backend:
+
+	counts = None
+
+	if ('availability' in sidecar):
+		counts = dict((group, np.array(table, dtype = int)) for group, table in sidecar['availability'].items())
+
+	# Map data array into memory (no copy):
+
+	try:
+		PPMI_array = np.load(filename, mmap_mode = 'r')
+
+	except IOError:
+		print 'ERROR:  Could not open PPMI data object', filename
+		raise IOError
+
+	# Create data cube on top of the memory map:
 
-	data_panel = pd.Panel(data = PPMI_array, items = event_list, major_axis = subject_list, minor_axis = test_list)
+	data_cube = PPMICube(PPMI_array, event_list, subject_list, test_list, subject_condition, counts)
 
-	return subject_list, subject_condition, event_list, test_list, test_dict, data_panel
+	return subject_list, subject_condition, event_list, test_list, test_dict, data_cube
 
 # Write out information about all available data into a JSON formatted string
 #
 # Parameter:  
 # event_list - a list of all events (timeline of study)
 # test_list - a list of all study tests stored in the data object (clear text)
-# data_panel - three-dimensional pandas data object.
+# data_cube - three-dimensional PPMICube data object.
 #
 # Returns:
 # available_data - a JSON string that contains a dictionary of all event-test combinations.
 
-def list_available_data(event_list, test_list, data_panel):
+def list_available_data(event_list, test_list, data_cube):
 	
 	# Placeholder dictionary
 	
 	data_dict = {}
+
+	# Look up available data for every event and test:
+
+	counts = data_cube.counts['subjects']
 	
 	# Step through list of study 'events' (timeline):
 	
 	for event in event_list:
-		
-		# Slice out dataframe from panel:
-		
-		event_frame = data_panel[event]
-		
-		# Create placeholder list:
-		
-		tests_in_event = []
-		
-		# Step through tests:
-		
-		for test in test_list:
-			
-			test_data = event_frame[test]
-			
-			# Check whether there is any data in this test series:
-			
-			contains_data = test_data.notnull().any()
-			
-			# Append if data was found:
-			
-			if (contains_data == True):
-				tests_in_event.append(test)
+
+		event_counts = counts[data_cube.event_index[event]]
+
+		# List tests that contain any data:
+
+		tests_in_event = [test for test in test_list if (event_counts[data_cube.test_index[test]] > 0)]
 				
 		# Add sorted list to data dictionary, if any test was found for event:
 		
@@ -115,27 +309,66 @@ def list_available_data(event_list, test_list, data_panel):
 	
 	return js.dumps(available_data, sort_keys = True)
 
-# Create lists that indicate membership of study subjects to the three 'cohorts':
+# Write out the number of subjects with data for every event-test combination into a JSON formatted string
+#
+# Parameter:  
+# event_list - a list of all events (timeline of study)
+# test_list - a list of all study tests stored in the data object (clear text)
+# data_cube - three-dimensional PPMICube data object.
+#
+# Returns:
+# data_counts - a JSON string that contains a dictionary {event : {test : {'subjects' : count, cohort : count, ...}}}
+#               of all event-test combinations that contain data.
+
+def list_data_counts(event_list, test_list, data_cube):
+
+	# Placeholder dictionary
+
+	data_dict = {}
+
+	groups = sorted(data_cube.counts.keys())
+
+	# Step through list of study 'events' (timeline) and tests:
+
+	for event in event_list:
+
+		event_pos = data_cube.event_index[event]
+		tests_in_event = {}
+
+		for test in test_list:
+
+			test_pos = data_cube.test_index[test]
+
+			# Add counts if data was found:
+
+			if (data_cube.counts['subjects'][event_pos, test_pos] > 0):
+				tests_in_event[test] = dict((group, int(data_cube.counts[group][event_pos, test_pos])) for group in groups)
+
+		if (len(tests_in_event) > 0):
+			data_dict[event] = tests_in_event
+
+	# Dictionary for JSON format
+
+	data_counts = {'PPMI Data Counts': data_dict}
+
+	return js.dumps(data_counts, sort_keys = True)
+
+# Create boolean masks that indicate membership of study subjects to the three 'cohorts':
 # 'HC' (healthy control), 'PD' (Parkinson's Disease), 'SWEDD' (scan w/o evidence of dopaminergic deficiency)
 #
 # Parameter:  subject ID list, Subject:Condition dictionary
-# Returns:  Dictionary containing membership lists for HC, PD, SWEDD cohorts
+# Returns:  Dictionary containing membership masks for HC, PD, SWEDD cohorts
 
 def create_cohort_filters(subject_list, subject_condition):
 	
-	# Turn subject:condition dictionary into a pandas Series object:
-
-	cond_series = pd.Series(subject_condition)
-	
-	# Create membership lists of individual subjects:
+	# Conditions of subjects, in subject list order:
 
-	HC_filter = (cond_series == 'HC').tolist()
-	PD_filter = (cond_series == 'PD').tolist()
-	SW_filter = (cond_series == 'SWEDD').tolist()
+	cond_array = np.array([subject_condition[subj] for subj in subject_list], dtype = object)
 	
-	# 'Zip' this information into a membership dictionary
+	# Create boolean membership masks of individual subjects,
+	# 'zip' this information into a membership dictionary:
 
-	filter_dict = {'HC':HC_filter, 'PD':PD_filter, 'SWEDD':SW_filter}
+	filter_dict = dict((group, (cond_array == group)) for group in ['HC', 'PD', 'SWEDD'])
 
 	return filter_dict
 
@@ -159,6 +392,17 @@ def extract_information(fileinfo = '../PPMI Analysis/employdata.json'):
 	except IOError:
 		print 'ERROR:  Could not read data selection file'
 		raise IOError
+
+	return parse_information(contents)
+
+# Same as extract_information, for a selection that is already available as a dictionary
+# (the contents of the 'employdata' key)
+
+def parse_information(contents):
+
+	# Work on a copy - the caller's dictionary is left intact:
+
+	contents = dict(contents)
 	
 	# Read in cohort information stored in 'cohort' key, then remove
 	
@@ -201,7 +445,7 @@ def extract_information(fileinfo = '../PPMI Analysis/employdata.json'):
 # Extract desired data from general data storage object
 # 
 # Parameters:
-# data_panel - the 3D storage object for PPMI data
+# data_cube - the 3D storage object for PPMI data (PPMICube)
 # cohorts - list of subject cohorts to be included
 # selections - list of event-test combinations to be included
 # subject_list - list of all subject IDs
@@ -210,72 +454,52 @@ def extract_information(fileinfo = '../PPMI Analysis/employdata.json'):
 # Returns:
 # subj_cond - series object containing condition (data) for each subject in table (index)
 # data_table - dataframe containing test results in selection
-#
-# Requires:
-# Create_cohort_filters(...) - library of cohort membership filters
-#
 
-def build_data_table(data_panel, cohorts, selections, subject_list, subject_condition):
-	
-	# Template for data table
+def build_data_table(data_cube, cohorts, selections, subject_list, subject_condition):
 
-	data_table = pd.DataFrame()
+	# Ignore repeated selections:
 
-	# Populate data table with desired test/event combinations
+	selected = set()
+	unique_selections = []
 
 	for group in selections:
-		
-		# Make sure test/event really exists:
+		if (tuple(group) not in selected):
+			selected.add(tuple(group))
+			unique_selections.append(group)
 
-		try:
-			event_data = data_panel[group[0]][group[1]]
-		except:
-			print 'ERROR:  Unknown event or test ', group
-			raise ValueError
+	selections = unique_selections
 
-		# Invent column name for combination:
+	# Create a filter for cohorts - select all subjects in any of the cohorts listed
+	# (cached in the data cube)
 
-		event_name = group[1] + ' [' + group[0] + ']'
+	cohort_filter = data_cube.cohort_mask(cohorts)
 
-		# Store data as column in table
+	# Extract desired test/event combinations for these subjects in one step:
 
-		data_table[event_name] = event_data
+	table_data = data_cube.gather(selections, cohort_filter)
 
-	# Create a filter for cohorts - select all subjects in any of the cohorts listed
-		
-	cohort_filter = [False for subject in subject_list]	
-	
-	# Read in global filter information:
+	# Clean out subjects that have incomplete information for any test (single reduction over the table):
 
-	filter_dict = create_cohort_filters(subject_list, subject_condition)
+	subjects_complete = ~np.isnan(table_data).any(axis = 1)
 
-	# Determine union of membership lists
+	subject_pos = np.flatnonzero(cohort_filter)[subjects_complete]
+	table_data = table_data[subjects_complete]
 
-	for group in cohorts:
-		cohort_filter = [i|j for i,j in zip(cohort_filter, filter_dict[group])]
-
-	# Apply subject filter	
-		
-	data_table = data_table[cohort_filter]	
+	# Invent column names for combinations, and store data in table:
 
-	# Clean out subjects that have incomplete information for any test:
+	event_names = [group[1] + ' [' + group[0] + ']' for group in selections]
+	subjects_in_selection = pd.Index([data_cube.subjects[pos] for pos in subject_pos])
 
-	subjects_complete = (data_table.notnull().all(axis = 1))
-	data_table = data_table[subjects_complete]
+	data_table = pd.DataFrame(table_data, index = subjects_in_selection, columns = event_names)
 
 	# Warn user if selection is empty:
 
 	if (len(data_table) == 0):
 		print 'WARNING:  No subjects available'
 
-	# Retrieve list of subjects in this set, their condition:
-
-	subjects_in_selection = data_table.index
-	conditions_in_selection = [subject_condition[subj] for subj in subjects_in_selection]
-
 	# Create a subject-condition dictionary in the form of a pandas Series object:
 
-	subj_cond = pd.Series(conditions_in_selection, index = subjects_in_selection)
+	subj_cond = pd.Series(data_cube.conditions[subject_pos], index = subjects_in_selection)
 
 	return subj_cond, data_table
 
@@ -325,6 +549,11 @@ def data_count(subj_cond):
 # * Global average over all subjects
 # * Sample standard deviation over subjects
 # * Averages for each cohort (HC, PD, SWEDD)
+# * Number of subjects and sample variance, globally and for each cohort
+# * Sample standard deviation for each cohort
+#
+# All statistics are found in one vectorized pass over the table (missing values are skipped).
+# Statistics for cohorts that are not present in the data are left empty (NaN).
 #
 # Requires:
 # data_table - pandas dataframe containing test results
@@ -332,53 +561,57 @@ def data_count(subj_cond):
 # cohorts	 - list of cohorts present in data
 #
 # Returns:
-# data_avg   - pandas dataframe storing averages and standard deviation
+# data_avg   - pandas dataframe storing averages, standard deviations, variances and counts
 
 def data_stats(data_table, subj_cond, cohorts):  
 
-	# Find global and cohort averages, global deviation
-	
-	# List of tests:
-	
-	column_list = data_table.columns.tolist()
-	
-	# Prepare pandas DataFrame for storage of averages:
-	
-	index_list = ['global mean', 'std dev', 'HC mean', 'PD mean', 'SWEDD mean']
-	
-	data_avg = pd.DataFrame()
-	
-	# Go through test columns:
-		
-	for test in column_list:
-		
-		# Isolate test results:
-		
-		aux_series = data_table[test].astype(float)
-		
-		glob_mean = aux_series.mean()
-		glob_std  = aux_series.std()
-		
-		# Select cohorts - find averages only for existing cohorts
-		
-		if ('HC' in cohorts):
-			hc_mean = aux_series[(subj_cond == 'HC')].mean()
-		else:
-			hc_mean = None
-			
-		if ('PD' in cohorts):
-			pd_mean = aux_series[(subj_cond == 'PD')].mean()
-		else:
-			pd_mean = None
-		
-		if ('SWEDD' in cohorts):
-			sw_mean = aux_series[(subj_cond == 'SWEDD')].mean()
-		else:
-			sw_mean = None
-				
-		# Store information:
-	
-		data_avg[test] = pd.Series([glob_mean, glob_std, hc_mean, pd_mean, sw_mean], index = index_list)
+	# Test results, and condition for each row of the table:
+
+	values = data_table.values.astype(float)
+	conditions = subj_cond.reindex(data_table.index).values
+
+	valid = ~np.isnan(values)
+	filled = np.where(valid, values, 0.0)
+
+	# Group rows:  all subjects first, then one group per cohort
+
+	group_list = ['HC', 'PD', 'SWEDD']
+	membership = np.vstack([np.ones(len(values), dtype = bool)] + [(conditions == group) for group in group_list]).astype(float)
+
+	# Counts, means, and (sample) variances by group, as matrix products:
+
+	counts = membership.dot(valid)
+
+	with np.errstate(divide = 'ignore', invalid = 'ignore'):
+		means = membership.dot(filled) / counts
+
+		deviation = np.where(valid, values[np.newaxis, :, :] - means[:, np.newaxis, :], 0.0)
+		variances = np.einsum('gs,gst->gt', membership, deviation * deviation) / (counts - 1)
+
+	variances[counts < 2] = np.nan
+	std_devs = np.sqrt(variances)
+
+	# Leave out cohorts that are not present:
+
+	for position, group in enumerate(group_list):
+		if not (group in cohorts):
+			means[position + 1] = np.nan
+			variances[position + 1] = np.nan
+			std_devs[position + 1] = np.nan
+
+	# Store information - leading rows as before, extended statistics below:
+
+	index_list = ['global mean', 'std dev', 'HC mean', 'PD mean', 'SWEDD mean',
+	              'count', 'variance', 'HC count', 'PD count', 'SWEDD count',
+	              'HC variance', 'PD variance', 'SWEDD variance',
+	              'HC std dev', 'PD std dev', 'SWEDD std dev']
+
+	stats = np.vstack([means[0], std_devs[0], means[1:],
+	                   counts[0], variances[0], counts[1:],
+	                   variances[1:],
+	                   std_devs[1:]])
+
+	data_avg = pd.DataFrame(stats, index = index_list, columns = data_table.columns)
 	
 	return data_avg
 
@@ -395,25 +628,16 @@ def data_stats(data_table, subj_cond, cohorts):
 def normalize_table(data_table, data_avg):
 	
 	# Take a table of test results and express it in units of std deviations from the mean
-	
-	column_list = data_table.columns.tolist()
-	norm_table = data_table.copy()
-	
-	# Normalize table - express deviation from column average in units of column standard deviation
 	# (Bug fix, 08/19/14:  Remove columns w/o variation.)
-	
-	for column in column_list:
-		avg = data_avg[column]['global mean']
-		std = data_avg[column]['std dev']
-		
-		if (std > 0):
 
-			# Normalize Column
-			norm_table[column] = norm_table[column].apply(lambda x : (float(x) - avg) / std)
+	avg = data_avg.loc['global mean']
+	std = data_avg.loc['std dev']
 
-		else:
-			# Remove Column - all values are constant, anyway
-			norm_table.drop(column, axis = 1, inplace = True)
+	column_list = [column for column in data_table.columns if (std[column] > 0)]
+
+	# Normalize table in one step - remaining columns are constant, anyway
+
+	norm_table = (data_table[column_list].astype(float) - avg[column_list]) / std[column_list]
 
 	return norm_table
 
@@ -482,13 +706,232 @@ def list_available_plots(norm_table, cohorts):
 	
 	return js.dumps(available_tests, sort_keys = True)
 
-	# Respond to image request - run graphics, return PNG image file as string
+# Write a file in one piece:  the data goes to a temporary file of this writer's own (in the same
+# directory), which then replaces the file.  Concurrent writers of the same file do not interfere
+# with each other (the last one wins), and readers never see a partly written file.
+#
+# Parameters:  filename - path & name of the file, data - string to be written
+# Returns:  True if the file was written, False if not (a warning is printed)
+
+def store_file(filename, data):
+
+	directory, name = os.path.split(filename)
+	tempname = None
+
+	try:
+		handle, tempname = tempfile.mkstemp(prefix = name + '.', suffix = '.tmp', dir = directory)
+
+		with os.fdopen(handle, 'wb') as datafile:
+			datafile.write(data)
+
+		os.rename(tempname, filename)
+
+	except (IOError, OSError):
+		print 'WARNING:  Could not write file', filename
+
+		if (tempname is not None) and os.path.exists(tempname):
+			try:
+				os.remove(tempname)
+			except OSError:
+				pass
+
+		return False
+
+	return True
+
+# Delete the least recently used (modified, or marked by os.utime) files in a directory, until
+# the files of the given types are within a total size
+#
+# Parameters:
+# directory - path of the directory
+# extensions - tuple of file name extensions to consider (e.g. ('.png', '.json'))
+# max_bytes - size limit
+
+def evict_files(directory, extensions, max_bytes):
+
+	files = []
+
+	try:
+		names = os.listdir(directory)
+	except OSError:
+		return
+
+	for name in names:
+		if name.endswith(extensions):
+			try:
+				info = os.stat(os.path.join(directory, name))
+				files.append((info.st_mtime, info.st_size, name))
+			except OSError:
+				pass
+
+	files.sort()
+	total = sum([size for mtime, size, name in files])
+
+	for mtime, size, name in files:
+
+		if (total <= max_bytes):
+			break
+
+		try:
+			os.remove(os.path.join(directory, name))
+		except OSError:
+			pass
+
+		total -= size
+
+# Plot cache:
+#
+# Rendered images are stored under a key that is a hash (SHA-1) of everything that goes into
+# the plot - the image request, the normalized data table and its statistics, and the cohort
+# labels.  Repeated requests for the same image (e.g. after a page reload) are answered from
+# the cache instead of being rendered again.
+#
+# The cache keeps the most recently used images in memory, up to a total size in bytes.
+# Optionally, images are also written to a directory on disk, which survives the session
+# and is consulted when an image is not (or no longer) held in memory;  when the files on disk
+# exceed a total size, the least recently used ones are deleted.
+#
+# Parameters:
+# max_bytes - size limit for images held in memory (default: 64 MB)
+# directory - path for on-disk storage (optional, default: memory only)
+# max_disk_bytes - size limit for the on-disk storage (default: 256 MB)
+
+class PlotCache(object):
+
+	def __init__(self, max_bytes = 64 * 1024 * 1024, directory = None, max_disk_bytes = 256 * 1024 * 1024):
+
+		self.max_bytes = max_bytes
+		self.directory = directory
+		self.max_disk_bytes = max_disk_bytes
+
+		self.entries = collections.OrderedDict()
+		self.size = 0
+		self.lock = threading.Lock()
+
+		if (directory is not None) and not os.path.isdir(directory):
+			os.makedirs(directory)
+
+	# Look up an image
+	#
+	# Parameter:  key - cache key (see plot_cache_key)
+	# Returns:  image data, or None if not found
+
+	def get(self, key):
+
+		with self.lock:
+			if (key in self.entries):
+
+				# Mark as most recently used:
+
+				image_data = self.entries.pop(key)
+				self.entries[key] = image_data
+
+				return image_data
+
+		if (self.directory is None):
+			return None
+
+		filename = os.path.join(self.directory, key)
+
+		try:
+			with open(filename, 'rb') as imagefile:
+				image_data = imagefile.read()
+
+			# Mark as recently used on disk, too:
+
+			os.utime(filename, None)
+
+		except (IOError, OSError):
+			return None
+
+		self.put(key, image_data, write = False)
+
+		return image_data
+
+	# Store an image
+	#
+	# Parameters:
+	# key - cache key (see plot_cache_key)
+	# image_data - string containing the image
+	# write - also store on disk, if a directory was given
+
+	def put(self, key, image_data, write = True):
+
+		with self.lock:
+			if (key in self.entries):
+				self.size -= len(self.entries.pop(key))
+
+			# Images bigger than the whole cache are not held in memory:
+
+			if (len(image_data) <= self.max_bytes):
+				self.entries[key] = image_data
+				self.size += len(image_data)
+
+			# Evict least recently used images:
+
+			while (self.size > self.max_bytes):
+				oldest, old_data = self.entries.popitem(last = False)
+				self.size -= len(old_data)
+
+		# Concurrent writers of the same image do not interfere (see store_file);  if the file
+		# cannot be written, the image is just not kept on disk:
+
+		if write and (self.directory is not None):
+			if store_file(os.path.join(self.directory, key), image_data):
+				self.evict()
+
+	# Delete least recently used image files until the directory is within its size limit
+
+	def evict(self):
+
+		evict_files(self.directory, ('.png', '.json'), self.max_disk_bytes)
+
+# Find the cache key for an image request.
+#
+# Parameters:  same as create_plot
+# Returns:  hexadecimal hash string, with the file extension of the image format ('.png' for images,
+#           '.json' for payloads) - also the file name in the on-disk cache
+
+def plot_cache_key(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts):
+
+	digest = hashlib.sha1()
+
+	# Request, in normalized form:
+
+	digest.update(js.dumps(js.loads(image_request), sort_keys = True))
+
+	# Data and statistics, including labels:
+
+	for frame in (norm_table, data_avg):
+		digest.update(np.ascontiguousarray(frame.values, dtype = float).tobytes())
+		digest.update(js.dumps([np.asarray(frame.index).tolist(), np.asarray(frame.columns).tolist()]))
+
+	# Cohort labels:
+
+	digest.update(js.dumps([np.asarray(subj_cond.index).tolist(), subj_cond.tolist(), list(cohorts), data_counts.tolist()]))
+
+	if (js.loads(image_request)['PPMI Image'].get('Format', 'PNG') == 'Payload'):
+		return digest.hexdigest() + '.json'
+
+	return digest.hexdigest() + '.png'
+
+# Respond to image request - run graphics, return PNG image file as string
 #
 # Image requests have the form of a short JSON string:
 #
 #	{"PPMI Image" : {"Type" : type, "Option" : option}}
 #
 # where 'type' is one of {'Correlation', 'Profile', 'Projection', 'ROC Curve'}, and 'option' indicates the subtype.
+# An optional key "Preview" : true asks for a quick, low-resolution image (half resolution, fast
+# PNG compression) of the Profile, Correlation and Projection plots, and for a small random
+# forest in ROC curves.  The size of the forest may also be set by the keys "Trees" and "Depth".
+# t-SNE projections show the early-stage embedding in previews (the full embedding continues from
+# it - see plearn.t_sne_embedding);  the key "Iterations" sets the iteration budget (default 1000).
+# ROC curves are cross-validated if the key "Folds" : k is present (stratified k-fold, repeated
+# "Repeats" times - default once), showing average curves and AUC with a band of one standard
+# deviation.
+# With the optional key "Format" : "Payload", the contents of the plot are returned instead of an
+# image, as JSON string (see render_payload), for rendering by the frontend.
 #
 # Parameters:
 # image_request - JSON command string (see above)
@@ -497,19 +940,154 @@ def list_available_plots(norm_table, cohorts):
 # subj_cond - pandas series containing the subject ID : cohort lookup table
 # cohorts - list of cohorts present in data
 # data_counts - pandas series containing number of subjects in each cohort
+# cache - PlotCache object (optional) - serve repeated requests from there
 #
 # Returns:
-# image_data - string containing the graphics data in PNG format
+# image_data - string containing the graphics data in PNG format (or plot payload in JSON format)
+
+def create_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts, cache = None):
+
+	# Check the cache first:
+
+	if (cache is not None):
+		key = plot_cache_key(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts)
+		image_data = cache.get(key)
+
+		if (image_data is not None):
+			return image_data
+
+		image_data = render_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts)
+
+		if (image_data is not None):
+			cache.put(key, image_data)
+
+		return image_data
+
+	return render_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts)
+
+# Size of the random forest for ROC curves:  200 trees of unlimited depth (full analysis),
+# 50 trees of depth 8 for previews, unless set in the image request
+#
+# Parameter:  image_dict - contents of the "PPMI Image" key of the image request
+# Returns:  trees, depth - number of trees, maximum depth (None for unlimited)
+
+def forest_size(image_dict):
+
+	if image_dict.get('Preview', False):
+		trees, depth = 50, 8
+	else:
+		trees, depth = 200, None
+
+	trees = int(image_dict.get('Trees', trees))
+	depth = image_dict.get('Depth', depth)
+
+	if (depth is not None):
+		depth = int(depth)
+
+	return trees, depth
+
+# Settings of the t-SNE embedding:  preview stage, iteration budget
+#
+# Parameter:  image_dict - contents of the "PPMI Image" key of the image request
+# Returns:  preview, iterations - early-stage embedding only (True/False), iteration budget
+
+def embedding_settings(image_dict):
+
+	return bool(image_dict.get('Preview', False)), int(image_dict.get('Iterations', 1000))
+
+# Cross-validation settings for ROC curves
+#
+# Parameter:  image_dict - contents of the "PPMI Image" key of the image request
+# Returns:  folds, repeats - number of folds (None for a single training/test split), repetitions
+
+def cross_validation(image_dict):
+
+	if not ('Folds' in image_dict):
+		return None, 1
+
+	return int(image_dict['Folds']), int(image_dict.get('Repeats', 1))
+
+# Check the form of an image request before it is rendered:  known plot type, an option, known
+# format, and whole numbers (within range) for the settings of forest, embedding and folds
+#
+# Parameter:  image_dict - contents of the "PPMI Image" key of the image request
+# Returns:  None if the request is well-formed, else a short description of the problem
+
+def check_image_request(image_dict):
+
+	if not isinstance(image_dict, dict):
+		return 'Image request is not a JSON object'
+
+	if not (image_dict.get('Type') in ['Profile', 'Correlation', 'Projection', 'ROC Curve']):
+		return 'Unknown plot type'
+
+	option = image_dict.get('Option')
+
+	if not isinstance(option, basestring):
+		return 'Missing plot option'
+
+	# Projection options name the projection and the display (e.g. 'PCA Gauss'):
+
+	if (image_dict['Type'] == 'Projection') and (len(option.split(' ')) != 2):
+		return 'Invalid projection option'
+
+	if not (image_dict.get('Format', 'PNG') in ['PNG', 'Payload']):
+		return 'Unknown image format'
+
+	# Numerical settings, with smallest allowed value (a depth of None means unlimited):
+
+	for key, smallest in [('Trees', 1), ('Depth', 1), ('Iterations', 1), ('Folds', 2), ('Repeats', 1)]:
+
+		if not (key in image_dict) or ((key == 'Depth') and (image_dict[key] is None)):
+			continue
+
+		try:
+			value = int(image_dict[key])
+		except (TypeError, ValueError):
+			return 'Invalid value for ' + key
+
+		if (value < smallest):
+			return 'Invalid value for ' + key
 
-def create_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts):
+	return None
+
+# Fold assignments from the shared results (None if not present - see plearn.roc_folds)
+
+def shared_folds(shared, folds, repeats):
+
+	if (shared is None):
+		return None
+
+	return shared['folds'].get((folds, repeats))
+
+# Render image for an image request (same parameters as create_plot, without cache)
+# shared - intermediate results shared with other requests (optional, see shared_plot_data)
+
+def render_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts, shared = None):
 	
 	# Turn request into dictionary, then extract option chosen:
 	
 	image_dict   = js.loads(image_request)['PPMI Image']
 	image_type   = image_dict['Type']
 	image_option = image_dict['Option']
+
+	# Client-side rendering - no image needed:
+
+	if (image_dict.get('Format', 'PNG') == 'Payload'):
+		return render_payload(image_dict, norm_table, data_avg, subj_cond, cohorts, data_counts, shared)
+
+	# Full resolution and default PNG encoding, unless a preview is requested:
+
+	dpi = 150
+	compression = None
+
+	if image_dict.get('Preview', False):
+		dpi = 75
+		compression = 1
 	
 	# Select type, and render image:
+
+	image_data = None
 	
 	if (image_type == 'Profile'):
 		
@@ -522,7 +1100,7 @@ def create_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_co
 		if (image_option == 'Probability Density'):
 			cumulative = False
 
-		image_data = pgauss.profile_gauss(test_data, subj_cond, cohorts, data_counts, cumulative)
+		image_data = pgauss.profile_gauss(test_data, subj_cond, cohorts, data_counts, cumulative, dpi, compression)
 		
 	elif (image_type == 'Correlation'):
 				
@@ -534,9 +1112,9 @@ def create_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_co
 		# Select Gaussian background image (default) or plain scatterplot:
 
 		if (image_option == 'Scatterplot'):
-			image_data = pgauss.scatter_plain(test1_data, test2_data, subj_cond)
+			image_data = pgauss.scatter_plain(test1_data, test2_data, subj_cond, dpi, compression)
 		else: 
-			image_data = pgauss.scatter_gauss(test1_data, test2_data, subj_cond)
+			image_data = pgauss.scatter_gauss(test1_data, test2_data, subj_cond, dpi, compression)
 		
 	elif (image_type == 'Projection'):
 		
@@ -546,19 +1124,239 @@ def create_plot(image_request, norm_table, data_avg, subj_cond, cohorts, data_co
 		
 		image_info = image_option.split(' ')
 
-		if (image_info[0] == 'Center-of-Mass'):
-			image_data = plearn.center_mass_view(norm_table, data_avg, subj_cond, cohorts, image_info[1])
+		preview, iterations = embedding_settings(image_dict)
+		x_series, y_series = projection_coordinates(image_info[0], norm_table, data_avg, subj_cond, cohorts, shared, preview, iterations)
 
-		elif (image_info[0] == 'PCA'):
-			image_data = plearn.pca_view(norm_table, subj_cond, cohorts, image_info[1])
+		image_data = None
 
-		elif (image_info[0] == 't-SNE'):
-			image_data = plearn.t_sne_view(norm_table, subj_cond, cohorts, image_info[1])
+		if (x_series is not None):
+			if (image_info[1] == 'Gauss'):
+				image_data = pgauss.scatter_gauss(x_series, y_series, subj_cond, dpi, compression)
+			elif (image_info[1] == 'Scatter'):
+				image_data = pgauss.scatter_plain(x_series, y_series, subj_cond, dpi, compression)
 		
 	elif (image_type == 'ROC Curve'):
 		
 		# Calculate ROC curve with classifier chosen via the image option:
+
+		splits = None
+		if (shared is not None):
+			splits = shared['splits']
 		
-		image_data = plearn.plot_roc_curve(norm_table, subj_cond, cohorts, image_option)
+		trees, depth = forest_size(image_dict)
+		folds, repeats = cross_validation(image_dict)
+
+		if (folds is not None):
+			fold_data = shared_folds(shared, folds, repeats)
+			image_data = plearn.plot_roc_cv(norm_table, subj_cond, cohorts, image_option, fold_data, trees, depth, folds, repeats)
+		else:
+			image_data = plearn.plot_roc_curve(norm_table, subj_cond, cohorts, image_option, splits, trees, depth)
 		
-	return image_data
\ No newline at end of file
+	return image_data
+
+# Collect the contents of the plot for an image request, instead of rendering it:
+#
+#	{"PPMI Plot" : {"Type" : type, "Option" : option, ...}}
+#
+# The remaining keys depend on the plot type - see scatter_payload, gauss_payload, profile_payload
+# in the graphics library, and roc_payload in the machine learning library.
+#
+# Parameters:
+# image_dict - contents of the "PPMI Image" key of the image request
+# shared - intermediate results shared with other requests (optional, see shared_plot_data)
+# (others as in create_plot)
+#
+# Returns:
+# JSON string (None if the plot is not available)
+
+def render_payload(image_dict, norm_table, data_avg, subj_cond, cohorts, data_counts, shared = None):
+
+	image_type   = image_dict['Type']
+	image_option = image_dict['Option']
+
+	payload = None
+
+	if (image_type == 'Profile'):
+
+		test_data = norm_table[norm_table.columns[0]]
+		cumulative = (image_option != 'Probability Density')
+
+		payload = pgauss.profile_payload(test_data, subj_cond, cohorts, data_counts, cumulative)
+
+	elif (image_type in ['Correlation', 'Projection']):
+
+		# Find coordinates:
+
+		if (image_type == 'Correlation'):
+			x_series = norm_table[norm_table.columns[0]]
+			y_series = norm_table[norm_table.columns[1]]
+
+			gauss = (image_option != 'Scatterplot')
+
+		else:
+			image_info = image_option.split(' ')
+
+			preview, iterations = embedding_settings(image_dict)
+			x_series, y_series = projection_coordinates(image_info[0], norm_table, data_avg, subj_cond, cohorts, shared, preview, iterations)
+
+			gauss = (image_info[-1] == 'Gauss')
+
+		# Scatterplot, with or without background:
+
+		if (x_series is not None):
+			if gauss:
+				payload = pgauss.gauss_payload(x_series, y_series, subj_cond)
+			else:
+				payload = pgauss.scatter_payload(x_series, y_series, subj_cond)
+
+	elif (image_type == 'ROC Curve'):
+
+		splits = None
+		if (shared is not None):
+			splits = shared['splits']
+
+		trees, depth = forest_size(image_dict)
+		folds, repeats = cross_validation(image_dict)
+
+		if (folds is not None):
+			fold_data = shared_folds(shared, folds, repeats)
+			payload = plearn.roc_cv_payload(norm_table, subj_cond, cohorts, image_option, fold_data, trees, depth, folds, repeats)
+		else:
+			payload = plearn.roc_payload(norm_table, subj_cond, cohorts, image_option, splits, trees, depth)
+
+	if (payload is None):
+		return None
+
+	payload['Type'] = image_type
+	payload['Option'] = image_option
+
+	return js.dumps({'PPMI Plot' : payload})
+
+# Coordinates of a projection view (from the shared results, if present):
+#
+# Parameters:
+# projection - 'Center-of-Mass', 'PCA', or 't-SNE' (first word of the Projection image option)
+# shared - intermediate results shared with other requests (optional, see shared_plot_data)
+# preview, iterations - settings of the t-SNE embedding (optional, see embedding_settings)
+# (others as in create_plot)
+#
+# Returns:
+# x_series, y_series - pandas Series of coordinates (None if projection is not available)
+
+def projection_coordinates(projection, norm_table, data_avg, subj_cond, cohorts, shared = None, preview = False, iterations = 1000):
+
+	key = (projection, preview, iterations)
+
+	if (shared is not None) and (key in shared['projections']):
+		return shared['projections'][key]
+
+	if (projection == 'Center-of-Mass'):
+		return plearn.center_mass_projection(norm_table, data_avg, cohorts)
+
+	elif (projection == 'PCA'):
+		return plearn.pca_projection(norm_table)
+
+	elif (projection == 't-SNE'):
+		return plearn.t_sne_projection(norm_table, subj_cond, cohorts, preview, iterations = iterations)
+
+	return None, None
+
+# Intermediate results shared by a set of image requests on the same data selection:
+# the coordinates of each projection, and the training/test splits and cross-validation folds
+# for ROC curves, computed once for all requests that need them.  (As a side effect, Gauss and scatter versions of a
+# t-SNE view show the same embedding, and all ROC classifiers are trained on the same splits.)
+#
+# Parameters:
+# image_requests - list of JSON command strings (see create_plot)
+# (others as in create_plot)
+#
+# Returns:
+# shared - dictionary {'projections' : {(projection, preview, iterations) : (x_series, y_series)},
+#                      'splits' : list or None,
+#                      'folds' : {(folds, repeats) : list}}
+
+def shared_plot_data(image_requests, norm_table, data_avg, subj_cond, cohorts):
+
+	shared = {'projections' : {}, 'splits' : None, 'folds' : {}}
+
+	for image_request in image_requests:
+
+		image_dict = js.loads(image_request)['PPMI Image']
+
+		if (image_dict['Type'] == 'Projection'):
+			projection = image_dict['Option'].split(' ')[0]
+			preview, iterations = embedding_settings(image_dict)
+
+			if not ((projection, preview, iterations) in shared['projections']):
+				shared['projections'][(projection, preview, iterations)] = projection_coordinates(projection, norm_table, data_avg, subj_cond, cohorts, None, preview, iterations)
+
+		elif (image_dict['Type'] == 'ROC Curve'):
+			folds, repeats = cross_validation(image_dict)
+
+			if (folds is not None):
+				if not ((folds, repeats) in shared['folds']):
+					shared['folds'][(folds, repeats)] = plearn.roc_folds(norm_table, subj_cond, cohorts, folds, repeats)
+
+			elif (shared['splits'] is None):
+				shared['splits'] = plearn.roc_splits(norm_table, subj_cond, cohorts)
+
+	return shared
+
+# Worker function for create_plots:  render_plot with all arguments in one tuple
+
+def render_shared(arguments):
+
+	return render_plot(*arguments)
+
+# Respond to a batch of image requests on one data selection (e.g., all plots offered by
+# list_available_plots, for an overview page).  Intermediate results are computed once
+# (see shared_plot_data), then the images are rendered - in parallel, if a pool of worker
+# processes is given.
+#
+# Parameters:
+# image_requests - list of JSON command strings (see create_plot)
+# norm_table, data_avg, subj_cond, cohorts, data_counts - as in create_plot
+# pool - multiprocessing.Pool object (optional) - render in worker processes
+# cache - PlotCache object (optional) - serve repeated requests from there
+#
+# Returns:
+# images - dictionary {image_request : image_data} (image_data is None if not available)
+
+def create_plots(image_requests, norm_table, data_avg, subj_cond, cohorts, data_counts, pool = None, cache = None):
+
+	images = {}
+	keys = {}
+
+	# Serve what we can from the cache:
+
+	if (cache is not None):
+		for image_request in image_requests:
+			keys[image_request] = plot_cache_key(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts)
+			image_data = cache.get(keys[image_request])
+
+			if (image_data is not None):
+				images[image_request] = image_data
+
+	missing = [image_request for image_request in sorted(set(image_requests)) if not (image_request in images)]
+
+	if (len(missing) == 0):
+		return images
+
+	# Compute shared results once, then render:
+
+	shared = shared_plot_data(missing, norm_table, data_avg, subj_cond, cohorts)
+
+	arguments = [(image_request, norm_table, data_avg, subj_cond, cohorts, data_counts, shared) for image_request in missing]
+
+	if (pool is not None):
+		rendered = pool.map(render_shared, arguments)
+	else:
+		rendered = [render_shared(entry) for entry in arguments]
+
+	for image_request, image_data in zip(missing, rendered):
+		images[image_request] = image_data
+
+		if (cache is not None) and (image_data is not None):
+			cache.put(keys[image_request], image_data)
+
+	return images